@@ -2,6 +2,10 @@
 import tarfile
 import tempfile
 import os
+import time
+import glob
+import threading
+import multiprocessing
 from datetime import datetime
 from getpass import getpass
 import logging
@@ -9,25 +13,36 @@ import hashlib
 import uuid
 import socket
 import re
-import fnmatch
 import mimetypes
 import calendar
-import functools
+import base64
 from contextlib import closing  # for Python2.6 compatibility
-from gzip import GzipFile
+from StringIO import StringIO
 
 import yaml
-from beefish import decrypt, encrypt_file
+from beefish import encrypt, encrypt_file
 import aaargh
 import grandfatherson
 from byteformat import ByteFormatter
+from boto.glacier.exceptions import UnexpectedHTTPResponseError
 
-from bakthat.backends import GlacierBackend, S3Backend, RotationConfig, SwiftBackend
-from bakthat.conf import config, events, load_config, DEFAULT_DESTINATION, DEFAULT_LOCATION, CONFIG_FILE, EXCLUDE_FILES
-from bakthat.utils import _interval_string_to_seconds
-from bakthat.models import Backups
+from bakthat.backends import BakthatBackend, GlacierBackend, S3Backend, RotationConfig, SwiftBackend, get_backend, \
+    clear_backends
+from bakthat.conf import config, events, load_config, DEFAULT_DESTINATION, DEFAULT_LOCATION, CONFIG_FILE
+from bakthat.utils import _interval_string_to_seconds, _size_string_to_bytes
+from bakthat.models import Backups, Config, Uploads, ArchiveMembers, Chunks, ChunkRefs
 from bakthat.sync import BakSyncer, bakmanager_hook, bakmanager_periodic_backups
 from bakthat.plugin import setup_plugins, plugin_setup
+from bakthat.stream import StreamPipeline, DEFAULT_STREAM_MEMORY, CHUNK_SIZE, stream_upload, tar_stage, file_stage, \
+    encrypt_stage, download_stage, decrypt_stage, decrypt_stream, slice_stage, encrypted_range, copy_stream, consume
+from bakthat.compression import write_tarball, extract_tarball, extract_members, get_codec, benchmark_codecs, \
+    tar_sample, DEFAULT_FRAME_SIZE, dump_index, load_index, index_lookup
+from bakthat.dedup import DedupStore, CHUNKS_PREFIX, DEFAULT_CHUNK_SIZE
+from bakthat.exclude import ExcludeMatcher
+from bakthat.incremental import IncrementalBackup, DEFAULT_MAX_CHAIN, apply_deletions, scan_tree
+from bakthat.pool import WorkerPool, NULL_SLOT
+from bakthat.scheduler import JobScheduler
+from bakthat.inventory import InventoryReader, reconcile_inventory as reconcile_catalog
 
 __version__ = "0.6.0"
 
@@ -54,7 +69,32 @@ def _get_store_backend(conf, destination=None, profile="default"):
     setup_plugins(conf)
     if not destination:
         destination = conf.get("default_destination", DEFAULT_DESTINATION)
-    return STORAGE_BACKEND[destination](conf, profile), destination, conf
+    return get_backend(STORAGE_BACKEND[destination], conf, profile), destination, conf
+
+
+def _source_fingerprint(filename, *settings):
+    """Key of a backup source (path, size and mtime of the file or directory itself)
+    and backup settings, used to find an interrupted upload of the same backup
+    without walking the tree (see :func:`_source_changed`)."""
+    st = os.stat(filename)
+    h = hashlib.sha1(os.path.abspath(filename))
+    h.update(repr(settings))
+    h.update(repr((0 if os.path.isdir(filename) else st.st_size, st.st_mtime)))
+    return h.hexdigest()
+
+
+def _source_changed(filename, exclude, since):
+    """Return True if filename, or an entry of the directory, was modified after since,
+    only called when an interrupted upload of the same source exists.
+
+    Created, deleted and renamed entries update the mtime of their parent directory.
+
+    """
+    if os.stat(filename).st_mtime >= since:
+        return True
+    if os.path.isdir(filename):
+        return any(entry[2] >= since for entry in scan_tree(filename, exclude))
+    return False
 
 
 @app.cmd(help="Delete backups older than the given interval string.")
@@ -66,6 +106,8 @@ def _get_store_backend(conf, destination=None, profile="default"):
 def delete_older_than(filename, interval, profile="default", config=CONFIG_FILE, destination=None, **kwargs):
     """Delete backups matching the given filename older than the given interval string.
 
+    Backups are deleted with batched requests, a failed delete is logged and doesn't stop the other ones.
+
     :type filename: str
     :param filename: File/directory name.
 
@@ -90,16 +132,11 @@ def delete_older_than(filename, interval, profile="default", config=CONFIG_FILE,
 
     interval_seconds = _interval_string_to_seconds(interval)
 
-    deleted = []
-
     backup_date_filter = int(datetime.utcnow().strftime("%s")) - interval_seconds
-    for backup in Backups.search(filename, destination, older_than=backup_date_filter, profile=profile, config=config):
-        real_key = backup.stored_filename
-        log.info("Deleting {0}".format(real_key))
+    backups = list(Backups.search(filename, destination, older_than=backup_date_filter, profile=profile, config=config))
+    log.info("Deleting {0} backups".format(len(backups)))
 
-        storage_backend.delete(real_key)
-        backup.set_deleted()
-        deleted.append(backup)
+    deleted, errors = _delete_backups(storage_backend, backups)
 
     events.on_delete_older_than(session_id, deleted)
 
@@ -114,6 +151,8 @@ def delete_older_than(filename, interval, profile="default", config=CONFIG_FILE,
 def rotate_backups(filename, destination=None, profile="default", config=CONFIG_FILE, **kwargs):
     """Rotate backup using grandfather-father-son rotation scheme.
 
+    Backups are deleted like with :func:`delete_older_than`.
+
     :type filename: str
     :param filename: File/directory name.
 
@@ -140,17 +179,105 @@ def rotate_backups(filename, destination=None, profile="default", config=CONFIG_
 
     """
     storage_backend, destination, conf = _get_store_backend(config, destination, profile)
-    rotate = RotationConfig(conf, profile)
-    if not rotate:
-        raise Exception("You must run bakthat configure_backups_rotation or provide rotation configuration.")
+    rotate_kwargs = _rotation_kwargs(conf, profile)
+
+    session_id = str(uuid.uuid4())
+    events.before_rotate_backups(session_id)
+
+    backups = _rotate_series([(backup.backup_date, backup) for backup in
+                              Backups.search(filename, destination, profile=profile, config=config)], rotate_kwargs)
+
+    deleted, errors = _delete_backups(storage_backend, backups)
+    for backup in deleted:
+        log.info("Deleted {0}".format(backup.stored_filename))
+
+    events.on_rotate_backups(session_id, deleted)
+
+    return deleted
+
+
+@app.cmd(help="Rotate every backup series in a single pass.")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift, every destination by default", default=None)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+@app.cmd_arg('-n', '--dry-run', action="store_true", help="only show the backups to delete")
+def rotate_all(destination=None, profile="default", config=CONFIG_FILE, dry_run=False, **kwargs):
+    """Rotate every backup series (backups of the same filename and destination)
+    using grandfather-father-son rotation scheme.
+
+    The live backups are loaded with a single query, the backups to delete are
+    computed in memory, then deleted in batches like with :func:`delete_older_than`.
+    Backups needed to restore incremental backups that are kept are not deleted.
+
+    :type destination: str
+    :param destination: s3|glacier|swift, every destination by default.
+
+    :type dry_run: bool
+    :param dry_run: Only compute and log the rotation plan, nothing is deleted.
+
+    :rtype: dict
+    :return: A dict (keep: number of backups kept, delete: stored filenames
+        to delete, errors: stored filename => error of the failed deletes).
+
+    """
+    conf = config if isinstance(config, dict) else load_config(config)
+    rotate_kwargs = _rotation_kwargs(conf.get(profile), profile)
+
+    to_delete = {}
+    keep = 0
+    series = Backups.live_series(destination, profile=profile, config=config)
+    for (backend, backend_hash, filename), backups in sorted(series.iteritems()):
+        rotated = _rotate_series([(backup_date, (backup_id, stored_filename))
+                                  for backup_date, backup_id, stored_filename in backups], rotate_kwargs)
+        keep += len(backups) - len(rotated)
+        if rotated:
+            log.info("{0} ({1}): keep {2}, delete {3}".format(filename, backend, len(backups) - len(rotated),
+                                                               len(rotated)))
+            to_delete.setdefault(backend, []).extend(rotated)
+
+    needed = Backups.chain_ancestors(set(stored_filename for rotated in to_delete.values()
+                                         for backup_id, stored_filename in rotated))
+    if needed:
+        kept = 0
+        for backend, rotated in to_delete.items():
+            to_delete[backend] = [(backup_id, stored_filename) for backup_id, stored_filename in rotated
+                                  if stored_filename not in needed]
+            kept += len(rotated) - len(to_delete[backend])
+        keep += kept
+        log.info("Keeping {0} backups needed to restore incremental backups".format(kept))
+
+    plan = dict(keep=keep, delete=[stored_filename for backend in sorted(to_delete)
+                                   for backup_id, stored_filename in to_delete[backend]], errors={})
+    log.info("{0} backups series, keep {1} backups, delete {2}".format(len(series), keep, len(plan["delete"])))
+    if dry_run:
+        for stored_filename in plan["delete"]:
+            log.info("Would delete {0}".format(stored_filename))
+        return plan
 
     session_id = str(uuid.uuid4())
     events.before_rotate_backups(session_id)
 
     deleted = []
+    for backend, rotated in sorted(to_delete.iteritems()):
+        storage_backend = _get_store_backend(conf, backend, profile)[0]
+        ids = [backup_id for backup_id, stored_filename in rotated]
+        for i in range(0, len(ids), 500):
+            backend_deleted, errors = _delete_backups(storage_backend,
+                                                      list(Backups.select().where(Backups.id << ids[i:i + 500])),
+                                                      keep_chains=False)
+            deleted.extend(backend_deleted)
+            plan["errors"].update(errors)
+
+    events.on_rotate_backups(session_id, deleted)
 
-    backups = Backups.search(filename, destination, profile=profile, config=config)
-    backups_date = [datetime.fromtimestamp(float(backup.backup_date)) for backup in backups]
+    return plan
+
+
+def _rotation_kwargs(conf, profile="default"):
+    """Return the grandfatherson keyword arguments from the rotation configuration."""
+    rotate = RotationConfig(conf, profile)
+    if not rotate.conf:
+        raise Exception("You must run bakthat configure_backups_rotation or provide rotation configuration.")
 
     rotate_kwargs = rotate.conf.copy()
     del rotate_kwargs["first_week_day"]
@@ -158,48 +285,157 @@ def rotate_backups(filename, destination=None, profile="default", config=CONFIG_
         rotate_kwargs[k] = int(v)
     rotate_kwargs["firstweekday"] = int(rotate.conf["first_week_day"])
     rotate_kwargs["now"] = datetime.utcnow()
+    return rotate_kwargs
 
-    to_delete = grandfatherson.to_delete(backups_date, **rotate_kwargs)
-    for delete_date in to_delete:
-        try:
-            backup_date = int(delete_date.strftime("%s"))
-            backup = Backups.search(filename, destination, backup_date=backup_date, profile=profile, config=config).get()
 
-            if backup:
-                real_key = backup.stored_filename
-                log.info("Deleting {0}".format(real_key))
+def _rotate_series(backups, rotate_kwargs):
+    """Return the backups of a series to delete, oldest first.
 
-                storage_backend.delete(real_key)
-                backup.set_deleted()
-                deleted.append(backup)
-        except Exception, exc:
-            log.error("Error when deleting {0}".format(backup))
-            log.exception(exc)
+    :type backups: list
+    :param backups: (backup_date, backup) for every backup of the series.
 
-    events.on_rotate_backups(session_id, deleted)
+    """
+    # Dated index, backups of the same date are deleted together
+    dated = {}
+    for backup_date, backup in backups:
+        dated.setdefault(datetime.fromtimestamp(float(backup_date)), []).append(backup)
+    return [backup for date in sorted(grandfatherson.to_delete(dated.keys(), **rotate_kwargs))
+            for backup in dated[date]]
 
-    return deleted
 
+def _delete_backup(storage_backend, backup):
+    """Delete a backup (and its seekable index) from the backend and mark it as deleted."""
+    deleted, errors = _delete_backups(storage_backend, [backup])
+    if errors:
+        raise Exception("Error when deleting {0}: {1}".format(backup.stored_filename, errors.values()[0]))
+    if not deleted:
+        raise Exception("{0} is needed to restore incremental backups, "
+                        "delete them first.".format(backup.stored_filename))
+
+
+def _delete_backups(storage_backend, backups, keep_chains=True):
+    """Delete backups with batched requests (see the backends delete_many), then the seekable
+    indexes of the deleted ones, and mark them as deleted in a single transaction.
+
+    A failed delete doesn't stop the other ones, failures are logged and returned.
+
+    :type keep_chains: bool
+    :param keep_chains: Skip the backups needed to restore incremental backups
+        not deleted (False if the caller already excluded them).
+
+    :rtype: tuple
+    :return: (deleted backups, dict stored filename => error message of the failed ones).
 
-def _get_exclude(exclude_file):
-    """ Load a .gitignore like file to exclude files/dir from backups.
+    """
+    if keep_chains and backups:
+        needed = Backups.chain_ancestors(set(backup.stored_filename for backup in backups))
+        for backup in backups:
+            if backup.stored_filename in needed:
+                log.info("Keeping {0}, needed to restore incremental backups".format(backup.stored_filename))
+        backups = [backup for backup in backups if backup.stored_filename not in needed]
+
+    errors = _delete_many(storage_backend, [backup.stored_filename for backup in backups]) if backups else {}
+    deleted = [backup for backup in backups if backup.stored_filename not in errors]
+
+    indexes = [backup.metadata["seekable"]["index"] for backup in deleted if backup.metadata.get("seekable")]
+    if indexes:
+        for index, error in _delete_many(storage_backend, indexes).items():
+            log.error("Error when deleting {0}: {1}".format(index, error))
+
+    Backups.set_deleted_many(deleted)
+    for keyname, error in sorted(errors.items()):
+        log.error("Error when deleting {0}: {1}".format(keyname, error))
+    if errors:
+        log.error("{0} backups deleted, {1} failed".format(len(deleted), len(errors)))
+
+    manifests = [backup for backup in deleted if backup.metadata.get("dedup")]
+    if manifests:
+        _release_chunks(storage_backend, manifests)
+    return deleted, errors
 
-    :type exclude_file: str
-    :param exclude_file: Path to the exclude file
 
-    :rtype: function
-    :return: A function ready to inject in tar.add(exlude=_exclude)
+def _release_chunks(storage_backend, backups):
+    """Forget the manifests of deleted deduplicated backups, then delete
+    the chunks no manifest references anymore (unless dedup_gc is false).
+
+    Chunks are only deleted when the local catalog holds the manifest of every
+    deduplicated backup of the backend, chunks failing to delete are retried
+    by the next deletion.
 
     """
-    patterns = filter(None, open(exclude_file).read().split("\n"))
+    ChunkRefs.clear_many([backup.stored_filename for backup in backups])
+    if not (getattr(storage_backend, "conf", None) or {}).get("dedup_gc", True):
+        return
+    for backend_hash in sorted(set(backup.backend_hash for backup in backups)):
+        missing = ChunkRefs.missing_manifests(backend_hash)
+        if missing:
+            log.info("{0} deduplicated backups without manifest in the local catalog, "
+                     "unreferenced chunks are kept".format(len(missing)))
+            continue
+        chunks = Chunks.unreferenced(backend_hash)
+        if not chunks:
+            continue
+        errors = _delete_many(storage_backend, [CHUNKS_PREFIX + chunk for chunk in chunks])
+        Chunks.delete_many(backend_hash, [chunk for chunk in chunks if CHUNKS_PREFIX + chunk not in errors])
+        log.info("{0} unreferenced chunks deleted".format(len(chunks) - len(errors)))
+        for keyname, error in sorted(errors.items()):
+            log.error("Error when deleting {0}: {1}".format(keyname, error))
+
+
+def _delete_many(storage_backend, keynames):
+    """Call the backend delete_many, or delete keynames one by one
+    if it's a custom backend without delete_many."""
+    if hasattr(storage_backend, "delete_many"):
+        return storage_backend.delete_many(keynames)
+    return BakthatBackend.delete_many.im_func(storage_backend, keynames)
+
+
+def _upload_index(storage_backend, stored_filename, index, password=None):
+    """Upload the index of a seekable archive next to it (encrypted if the archive is),
+    and return the seekable metadata, holding a copy of the index.
 
-    def _exclude(filename):
-        for pattern in patterns:
-            if re.search(fnmatch.translate(pattern), filename):
-                log.debug("{0} excluded".format(filename))
-                return True
-        return False
-    return _exclude
+    :rtype: dict
+    :return: A dict (index: index stored filename, data: base64 compressed index,
+        members: number of members, frames: number of frames).
+
+    """
+    data = dump_index(index)
+    index_filename = stored_filename + ".index"
+    out = StringIO(data)
+    if password:
+        out = StringIO()
+        encrypt(StringIO(data), out, password)
+        out.seek(0)
+    storage_backend.upload_stream(index_filename, out)
+    return dict(index=index_filename,
+                data=base64.b64encode(data),
+                members=len(index["members"]),
+                frames=len(index["frames"]))
+
+
+def _load_index(storage_backend, backup, password=None):
+    """Return the index of a seekable backup, from the catalog or from the backend."""
+    seekable = backup.metadata["seekable"]
+    if seekable.get("data"):
+        return load_index(base64.b64decode(seekable["data"]))
+
+    data = storage_backend.download_string(seekable["index"])
+    if backup.is_encrypted():
+        out = StringIO()
+        decrypt_stream(StringIO(data), out, password)
+        data = out.getvalue()
+    return load_index(data)
+
+
+def _ask_password():
+    """Prompt for the encryption password, return None if the confirmation doesn't match."""
+    password = getpass("Password (blank to disable encryption): ")
+    if password:
+        password2 = getpass("Password confirmation: ")
+        if password != password2:
+            log.error("Password confirmation doesn't match")
+            return
+    return password
 
 
 @app.cmd(help="Backup a file or a directory, backup the current directory if no arg is provided.")
@@ -212,7 +448,12 @@ def _get_exclude(exclude_file):
 @app.cmd_arg('-k', '--key', type=str, default=None, help="Custom key for periodic backups (works only with BakManager.io hook.)")
 @app.cmd_arg('--exclude-file', type=str, default=None)
 @app.cmd_arg('--s3-reduced-redundancy', action="store_true")
-def backup(filename=os.getcwd(), destination=None, profile="default", config=CONFIG_FILE, prompt="yes", tags=[], key=None, exclude_file=None, s3_reduced_redundancy=False, **kwargs):
+@app.cmd_arg('--stream', action="store_true", help="compress, encrypt and upload on the fly, without temporary files")
+@app.cmd_arg('--compress', type=str, default=None, help="gzip|zstd|lz4|xz with an optional level (e.g. zstd:3), none to disable")
+@app.cmd_arg('--dedup', action="store_true", help="only upload chunks not already stored (s3|swift)")
+@app.cmd_arg('--incremental', action="store_true", help="only backup files changed since the last backup")
+@app.cmd_arg('--seekable', action="store_true", help="compress in independent frames, to restore single files")
+def backup(filename=os.getcwd(), destination=None, profile="default", config=CONFIG_FILE, prompt="yes", tags=[], key=None, exclude_file=None, s3_reduced_redundancy=False, stream=False, compress=None, dedup=False, incremental=False, seekable=False, **kwargs):
     """Perform backup.
 
     :type filename: str
@@ -229,6 +470,27 @@ def backup(filename=os.getcwd(), destination=None, profile="default", config=CON
     :param tags: Tags either in a str space separated,
         either directly a list of str (if calling from Python).
 
+    :type stream: bool
+    :param stream: Compress, encrypt and upload on the fly without temporary files
+        (can also be enabled with the stream profile setting).
+
+    :type compress: str
+    :param compress: Compression codec with an optional level like gzip, zstd:3, lz4, xz,
+        none to disable compression, override the compress profile setting.
+
+    :type dedup: bool
+    :param dedup: Split the archive in content-defined chunks and only upload
+        chunks not already stored (can also be enabled with the dedup profile setting).
+
+    :type incremental: bool
+    :param incremental: Only backup files changed since the last backup of the directory
+        (can also be enabled with the incremental profile setting).
+
+    :type seekable: bool
+    :param seekable: Compress the archive in independent frames and index its members,
+        to restore a single member with ranged downloads
+        (can also be enabled with the seekable profile setting).
+
     :type password: str
     :keyword password: Password, empty string to disable encryption.
 
@@ -242,34 +504,74 @@ def backup(filename=os.getcwd(), destination=None, profile="default", config=CON
     :return: A dict containing the following keys: stored_filename, size, metadata, backend and filename.
 
     """
-    storage_backend, destination, conf = _get_store_backend(config, destination, profile)
-    backup_file_fmt = "{0}.{1}.tgz"
+    if kwargs.get("store_backend"):
+        storage_backend, destination, conf = kwargs["store_backend"]
+    else:
+        storage_backend, destination, conf = _get_store_backend(config, destination, profile)
+
+    access_key = storage_backend.conf.get("access_key")
+    container_key = storage_backend.conf.get(storage_backend.container_key)
+    backend_hash = hashlib.sha512(access_key + container_key).hexdigest()
 
     session_id = str(uuid.uuid4())
     events.before_backup(session_id)
 
     # Check if compression is disabled on the configuration.
-    if conf:
-        compress = conf.get("compress", True)
-    else:
-        compress = config.get(profile).get("compress", True)
+    if compress is None:
+        if conf:
+            compress = conf.get("compress", True)
+        else:
+            compress = config.get(profile).get("compress", True)
 
-    if not compress:
+    codec = get_codec(compress)
+    if codec:
+        backup_file_fmt = "{0}.{1}." + codec.extension
+        compression = codec.name
+    else:
         backup_file_fmt = "{0}.{1}"
+        compression = None
+
+    stream = stream or conf.get("stream", False)
+    compress_workers = int(conf.get("compress_workers", 1))
+
+    dedup = dedup or conf.get("dedup", False)
+    if dedup:
+        # The stored file is the chunks manifest
+        backup_file_fmt = "{0}.{1}.dedup"
 
     log.info("Backing up " + filename)
 
-    if exclude_file and os.path.isfile(exclude_file):
-        EXCLUDE_FILES.insert(0, exclude_file)
+    if exclude_file and not os.path.isfile(exclude_file):
+        exclude_file = None
 
-    _exclude = lambda filename: False
+    _exclude = None
     if os.path.isdir(filename):
-        join = functools.partial(os.path.join, filename)
-        for efile in EXCLUDE_FILES:
-            efile = join(efile)
-            if os.path.isfile(efile):
-                _exclude = _get_exclude(efile)
-                log.info("Using {0} to exclude files.".format(efile))
+        _exclude = ExcludeMatcher(filename, exclude_file)
+
+    incremental = incremental or conf.get("incremental", False)
+    tar_add = None
+    if incremental and not os.path.isdir(filename):
+        log.info("Incremental backups only works with directories, performing a full backup.")
+        incremental = False
+    elif incremental:
+        if codec is None and not dedup:
+            raise Exception("Incremental backups require compression or deduplication.")
+        max_age = conf.get("incremental_max_age")
+        incremental = IncrementalBackup(filename, backend_hash, _exclude,
+                                        use_hash=conf.get("incremental_hash", False),
+                                        max_chain=int(conf.get("incremental_max_chain", DEFAULT_MAX_CHAIN)),
+                                        max_age=max_age and _interval_string_to_seconds(max_age)).scan()
+        tar_add = incremental.add_to_tar
+
+    seekable = seekable or conf.get("seekable", False)
+    frame_size = None
+    if seekable:
+        if codec is None or dedup:
+            raise Exception("Seekable archives require compression and can't be deduplicated.")
+        frame_size = _size_string_to_bytes(conf.get("seekable_frame_size", DEFAULT_FRAME_SIZE))
+    index = None
+    # Archive listing, recorded in the catalog
+    members = []
 
     arcname = filename.strip('/').split('/')[-1]
     now = datetime.utcnow()
@@ -288,61 +590,113 @@ def backup(filename=os.getcwd(), destination=None, profile="default", config=CON
 
     password = kwargs.get("password", os.environ.get("BAKTHAT_PASSWORD"))
     if password is None and prompt.lower() != "no":
-        password = getpass("Password (blank to disable encryption): ")
-        if password:
-            password2 = getpass("Password confirmation: ")
-            if password != password2:
-                log.error("Password confirmation doesn't match")
-                return
-
-    if not compress:
-        log.info("Compression disabled")
-        outname = filename
-        with open(outname) as outfile:
-            backup_data["size"] = os.fstat(outfile.fileno()).st_size
-        bakthat_compression = False
-
-    # Check if the file is not already compressed
-    elif mimetypes.guess_type(arcname) == ('application/x-tar', 'gzip'):
-        log.info("File already compressed")
-        outname = filename
-
-        # removing extension to reformat filename
-        new_arcname = re.sub(r'(\.t(ar\.)?gz)', '', arcname)
-        stored_filename = backup_file_fmt.format(new_arcname, date_component)
-
-        with open(outname) as outfile:
-            backup_data["size"] = os.fstat(outfile.fileno()).st_size
-
-        bakthat_compression = False
-    else:
-        # If not we compress it
-        log.info("Compressing...")
-
-        with tempfile.NamedTemporaryFile(delete=False) as out:
-            with closing(tarfile.open(fileobj=out, mode="w:gz")) as tar:
-                tar.add(filename, arcname=arcname, exclude=_exclude)
-            outname = out.name
-            out.seek(0)
-            backup_data["size"] = os.fstat(out.fileno()).st_size
-        bakthat_compression = True
-
-    bakthat_encryption = False
-    if password:
-        bakthat_encryption = True
-        log.info("Encrypting...")
-        encrypted_out = tempfile.NamedTemporaryFile(delete=False)
-        encrypt_file(outname, encrypted_out.name, password)
-        stored_filename += ".enc"
-
-        # We only remove the file if the archive is created by bakthat
-        if bakthat_compression:
-            os.remove(outname)  # remove non-encrypted tmp file
-
-        outname = encrypted_out.name
-
-        encrypted_out.seek(0)
-        backup_data["size"] = os.fstat(encrypted_out.fileno()).st_size
+        password = _ask_password()
+        if password is None:
+            return
+
+    # Archive creation and encryption, bounded by cpu_slot in backup_many
+    # (streaming backups compress while uploading, in network_slot)
+    with kwargs.get("cpu_slot") or NULL_SLOT:
+        # Resume an interrupted upload of the same backup
+        fingerprint = None
+        pending = None
+        if not dedup:
+            fingerprint = _source_fingerprint(filename, destination, repr(codec), bool(password), stream,
+                                              incremental and incremental.parent, frame_size)
+            pending = Uploads.get_pending(backend_hash, fingerprint)
+            if pending is not None and _source_changed(filename, _exclude, pending.created):
+                log.info("{0} changed since the interrupted upload, starting over".format(filename))
+                if hasattr(storage_backend, "abort_upload"):
+                    try:
+                        storage_backend.abort_upload(pending.keyname, pending.upload_id)
+                    except Exception, exc:
+                        log.warning("Failed to abort upload {0}: {1}".format(pending.upload_id, exc))
+                for tmp_filename in [pending.filename, pending.filename and pending.filename + ".index"]:
+                    if tmp_filename and tmp_filename != os.path.abspath(filename) and os.path.isfile(tmp_filename):
+                        os.remove(tmp_filename)
+                pending.done()
+                pending = None
+        resume_file = pending and pending.filename and pending.filename != os.path.abspath(filename) and \
+            os.path.isfile(pending.filename) and os.path.getsize(pending.filename) == pending.size
+
+        if dedup:
+            # The tarball is chunked on the fly, chunks are compressed individually
+            outname = None
+            bakthat_compression = False
+        elif resume_file:
+            log.info("Reusing {0}".format(pending.filename))
+            outname = pending.filename
+            backup_data["size"] = pending.size
+            bakthat_compression = True
+            if seekable:
+                with open(outname + ".index", "rb") as f:
+                    index = load_index(f.read())
+        elif codec is None:
+            log.info("Compression disabled")
+            outname = filename
+            with open(outname) as outfile:
+                st = os.fstat(outfile.fileno())
+                backup_data["size"] = st.st_size
+            members.append((arcname, st.st_size, int(st.st_mtime), st.st_mode))
+            bakthat_compression = False
+
+        # Check if the file is not already compressed
+        elif mimetypes.guess_type(arcname) == ('application/x-tar', 'gzip'):
+            log.info("File already compressed")
+            outname = filename
+
+            # removing extension to reformat filename
+            new_arcname = re.sub(r'(\.t(ar\.)?gz)', '', arcname)
+            stored_filename = "{0}.{1}.tgz".format(new_arcname, date_component)
+            compression = "gzip"
+
+            with open(outname) as outfile:
+                backup_data["size"] = os.fstat(outfile.fileno()).st_size
+
+            bakthat_compression = False
+        elif stream:
+            # The tarball will be created on the fly while uploading
+            outname = None
+            bakthat_compression = True
+        else:
+            # If not we compress it
+            log.info("Compressing ({0})...".format(compression))
+
+            with tempfile.NamedTemporaryFile(delete=False) as out:
+                index = write_tarball(out, filename, arcname, _exclude, codec, compress_workers, tar_add,
+                                      frame_size=frame_size, members=members)
+                outname = out.name
+                out.seek(0)
+                backup_data["size"] = os.fstat(out.fileno()).st_size
+            bakthat_compression = True
+
+        bakthat_encryption = False
+        if password and (stream or dedup or resume_file):
+            bakthat_encryption = True
+            stored_filename += ".enc"
+        elif password:
+            bakthat_encryption = True
+            log.info("Encrypting...")
+            encrypted_out = tempfile.NamedTemporaryFile(delete=False)
+            encrypt_file(outname, encrypted_out.name, password)
+            stored_filename += ".enc"
+
+            # We only remove the file if the archive is created by bakthat
+            if bakthat_compression:
+                os.remove(outname)  # remove non-encrypted tmp file
+
+            outname = encrypted_out.name
+
+            encrypted_out.seek(0)
+            backup_data["size"] = os.fstat(encrypted_out.fileno()).st_size
+
+        if index is not None and not resume_file:
+            # Kept with the temporary file to resume the upload
+            with open(outname + ".index", "wb") as f:
+                f.write(dump_index(index))
+
+    if pending:
+        stored_filename = pending.keyname
 
     # Handling tags metadata
     if isinstance(tags, list):
@@ -351,24 +705,85 @@ def backup(filename=os.getcwd(), destination=None, profile="default", config=CON
     backup_data["tags"] = tags
 
     backup_data["metadata"] = dict(is_enc=bakthat_encryption,
+                                   compression=compression,
                                    client=socket.gethostname())
     backup_data["stored_filename"] = stored_filename
 
-    access_key = storage_backend.conf.get("access_key")
-    container_key = storage_backend.conf.get(storage_backend.container_key)
-    backup_data["backend_hash"] = hashlib.sha512(access_key + container_key).hexdigest()
-
-    log.info("Uploading...")
-    storage_backend.upload(stored_filename, outname, s3_reduced_redundancy=s3_reduced_redundancy)
-
-    # We only remove the file if the archive is created by bakthat
-    if bakthat_compression or bakthat_encryption:
-        os.remove(outname)
+    backup_data["backend_hash"] = backend_hash
+
+    if incremental:
+        backup_data["metadata"]["incremental"] = dict(incremental.metadata(), arcname=arcname)
+
+    # Upload, bounded by network_slot in backup_many
+    with kwargs.get("network_slot") or NULL_SLOT:
+        if dedup:
+            log.info("Deduplicating...")
+            store = DedupStore(storage_backend, backup_data["backend_hash"], codec, password,
+                               workers=int(conf.get("dedup_workers", 4)),
+                               chunk_size=_size_string_to_bytes(conf.get("dedup_chunk_size", DEFAULT_CHUNK_SIZE)))
+            pipeline = StreamPipeline(_size_string_to_bytes(conf.get("stream_memory", DEFAULT_STREAM_MEMORY)) // 2)
+            pipeline.add_stage(tar_stage(filename, arcname, _exclude, add=tar_add, members=members))
+            result = consume(pipeline, store.backup)
+
+            store.save_manifest(stored_filename, result["manifest"])
+            backup_data["size"] = result["uploaded"]
+            backup_data["metadata"]["dedup"] = dict(chunks=result["chunks"],
+                                                    new_chunks=result["new_chunks"],
+                                                    size=result["size"])
+        elif stream:
+            log.info("Streaming...")
+            memory = _size_string_to_bytes(conf.get("stream_memory", DEFAULT_STREAM_MEMORY))
+            # Half of the memory is used by the stages buffers, the other half by the upload parts
+            pipeline = StreamPipeline(memory // 2)
+            result = {}
+            if bakthat_compression:
+                pipeline.add_stage(tar_stage(filename, arcname, _exclude, codec, compress_workers, tar_add,
+                                             frame_size, result, members))
+            else:
+                pipeline.add_stage(file_stage(outname))
+            if bakthat_encryption:
+                pipeline.add_stage(encrypt_stage(password))
+
+            # The part size is chosen from the source size (directories sizes are unknown)
+            source = outname if not bakthat_compression else filename
+            expected_size = None
+            if os.path.isfile(source):
+                # Room for the tar headers and the encryption or incompressible data overhead
+                expected_size = int(os.path.getsize(source) * 1.01) + CHUNK_SIZE
+
+            backup_data["size"] = stream_upload(storage_backend, stored_filename, pipeline,
+                                                memory=memory // 2,
+                                                expected_size=expected_size,
+                                                s3_reduced_redundancy=s3_reduced_redundancy,
+                                                backend_hash=backend_hash,
+                                                fingerprint=fingerprint)
+            index = result.get("index")
+        else:
+            log.info("Uploading...")
+            # Temporary files are kept if the upload fails, to resume it
+            local_filename = outname if bakthat_compression or bakthat_encryption else None
+            storage_backend.upload(stored_filename, outname, s3_reduced_redundancy=s3_reduced_redundancy,
+                                   backend_hash=backend_hash, fingerprint=fingerprint,
+                                   local_filename=local_filename)
+
+            # We only remove the file if the archive is created by bakthat
+            if bakthat_compression or bakthat_encryption:
+                os.remove(outname)
+                if os.path.isfile(outname + ".index"):
+                    os.remove(outname + ".index")
+
+        if index is not None:
+            backup_data["metadata"]["seekable"] = _upload_index(storage_backend, stored_filename, index, password)
 
     log.debug(backup_data)
 
     # Insert backup metadata in SQLite
     backup = Backups.create(**backup_data)
+    if members:
+        ArchiveMembers.add_many(stored_filename, members)
+
+    if incremental:
+        incremental.commit(stored_filename)
 
     BakSyncer(conf).sync_auto()
 
@@ -381,17 +796,336 @@ def backup(filename=os.getcwd(), destination=None, profile="default", config=CON
     return backup
 
 
+@app.cmd(help="Backup several files or directories concurrently.")
+@app.cmd_arg('paths', type=str, nargs="+", help="files, directories or glob patterns")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift", default=None)
+@app.cmd_arg('--prompt', type=str, help="yes|no", default="yes")
+@app.cmd_arg('-t', '--tags', type=str, help="space separated tags", default="")
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+@app.cmd_arg('--cpu-workers', type=int, default=None, help="number of archives created concurrently (number of CPUs by default)")
+@app.cmd_arg('--network-workers', type=int, default=None, help="number of concurrent uploads (4 by default)")
+@app.cmd_arg('--exclude-file', type=str, default=None)
+@app.cmd_arg('--s3-reduced-redundancy', action="store_true")
+@app.cmd_arg('--stream', action="store_true", help="upload while compressing, without temporary files")
+@app.cmd_arg('--compress', type=str, default=None, help="gzip|zstd|lz4|xz|none with an optional level, e.g. zstd:3")
+@app.cmd_arg('--dedup', action="store_true", help="only upload chunks not already stored")
+@app.cmd_arg('--incremental', action="store_true", help="only backup files changed since the last backup")
+def backup_many(paths, destination=None, profile="default", config=CONFIG_FILE, prompt="yes", tags=[], cpu_workers=None, network_workers=None, **kwargs):
+    """Backup several files or directories in a single process.
+
+    Archives are created by at most cpu_workers threads and uploaded by at most
+    network_workers threads concurrently, the backend is shared (Swift uses
+    a connection per thread). A failed backup doesn't stop the others.
+
+    :type paths: list
+    :param paths: Files, directories or glob patterns.
+
+    :type cpu_workers: int
+    :param cpu_workers: Number of archives created concurrently
+        (backup_cpu_workers setting or number of CPUs by default).
+
+    :type network_workers: int
+    :param network_workers: Number of concurrent uploads (backup_network_workers setting or 4 by default).
+
+    Other arguments are passed to :func:`backup`.
+
+    :rtype: list
+    :return: A list of dict (filename, stored_filename, size, error) for each path.
+
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+
+    filenames = []
+    for pattern in paths:
+        # Unmatched patterns are kept, their backup fails
+        for filename in sorted(glob.glob(os.path.expanduser(pattern))) or [pattern]:
+            if filename not in filenames:
+                filenames.append(filename)
+
+    store_backend = _get_store_backend(config, destination, profile)
+    storage_backend, destination, conf = store_backend
+    if not storage_backend.thread_safe:
+        store_backend = None
+
+    password = kwargs.pop("password", os.environ.get("BAKTHAT_PASSWORD"))
+    if password is None and prompt.lower() != "no":
+        password = _ask_password()
+        if password is None:
+            return
+
+    cpu_workers = int(cpu_workers or conf.get("backup_cpu_workers", multiprocessing.cpu_count()))
+    network_workers = int(network_workers or conf.get("backup_network_workers", 4))
+    cpu_slot = threading.BoundedSemaphore(cpu_workers)
+    network_slot = threading.BoundedSemaphore(network_workers)
+
+    # Paths with the same name get the same stored filename if backed up during the same second,
+    # they are backed up one after the other.
+    groups = []
+    group_index = {}
+    for filename in filenames:
+        arcname = filename.strip('/').split('/')[-1]
+        if arcname not in group_index:
+            group_index[arcname] = len(groups)
+            groups.append([])
+        groups[group_index[arcname]].append(filename)
+
+    def _backup_group(group):
+        results = []
+        for i, filename in enumerate(group):
+            if i:
+                time.sleep(1)
+            try:
+                if not os.path.exists(filename):
+                    raise Exception("{0} doesn't exist.".format(filename))
+                backup_info = backup(filename, destination=destination, profile=profile, config=config,
+                                     prompt="no", tags=tags, password=password or "",
+                                     store_backend=store_backend, cpu_slot=cpu_slot,
+                                     network_slot=network_slot, **kwargs)
+                results.append(dict(filename=filename, stored_filename=backup_info.stored_filename,
+                                    size=backup_info.size, error=None))
+            except Exception, exc:
+                log.exception("Backup of {0} failed".format(filename))
+                results.append(dict(filename=filename, stored_filename=None, size=None, error=str(exc)))
+        return results
+
+    results = []
+    with WorkerPool(cpu_workers + network_workers) as pool:
+        for group_results in pool.imap(_backup_group, groups):
+            results.extend(group_results)
+
+    failed = [result for result in results if result["error"]]
+    log.info("{0} backups, {1} failed".format(len(results), len(failed)))
+    for result in failed:
+        log.error("{filename}: {error}".format(**result))
+
+    return results
+
+
+@app.cmd(help="Abort multipart uploads older than the given interval string.")
+@app.cmd_arg('-i', '--interval', type=str, default="1W", help="Interval string like 1W, 3D (1W by default)")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift", default=None)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+def gc_uploads(interval="1W", destination=None, profile="default", config=CONFIG_FILE, **kwargs):
+    """Abort the multipart uploads (segmented uploads for Swift) started before the given interval,
+    interrupted uploads keep accruing storage cost until they are aborted.
+
+    :type interval: str
+    :param interval: Interval string like 1W, 3D...
+
+    :type destination: str
+    :param destination: s3|glacier|swift
+
+    :rtype: list
+    :return: A list of the aborted uploads (dict with keyname, upload_id and created).
+
+    """
+    storage_backend, destination, conf = _get_store_backend(config, destination, profile)
+    if not hasattr(storage_backend, "list_uploads"):
+        log.error("{0} has no multipart uploads.".format(destination))
+        return []
+
+    older_than = time.time() - _interval_string_to_seconds(interval)
+    aborted = []
+    for upload in storage_backend.list_uploads():
+        if upload["created"] > older_than:
+            continue
+        log.info("Aborting upload of {keyname} ({upload_id})".format(**upload))
+        storage_backend.abort_upload(upload["keyname"], upload["upload_id"])
+        try:
+            state = Uploads.get(Uploads.upload_id == upload["upload_id"])
+        except Uploads.DoesNotExist:
+            pass
+        else:
+            # Remove the temporary file (and its seekable index) kept to resume the upload
+            for tmp_filename in [state.filename, state.filename and state.filename + ".index"]:
+                if tmp_filename and os.path.isfile(tmp_filename):
+                    os.remove(tmp_filename)
+            state.done()
+        aborted.append(upload)
+
+    return aborted
+
+
+@app.cmd(help="Reconcile the local catalog with the Glacier vault inventory.")
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+def reconcile_inventory(profile="default", config=CONFIG_FILE, **kwargs):
+    """Reconcile the inventory and backups tables with the Glacier vault inventory
+    (see :func:`bakthat.inventory.reconcile_inventory`), e.g. after losing the local database.
+
+    The first call initiates an inventory retrieval job (it takes about 4 hours),
+    the inventory is downloaded and parsed on the fly once it's completed.
+
+    :rtype: dict
+    :return: The reconciliation report (archives, recovered, orphaned and missing),
+        None if the inventory job is not completed.
+
+    """
+    storage_backend, destination, conf = _get_store_backend(config, "glacier", profile)
+    access_key = storage_backend.conf.get("access_key")
+    container_key = storage_backend.conf.get(storage_backend.container_key)
+    backend_hash = hashlib.sha512(access_key + container_key).hexdigest()
+
+    job_key = "inventory_job:" + backend_hash
+    job = None
+    job_id = Config.get_key(job_key)
+    if job_id:
+        try:
+            job = storage_backend.retrieve_inventory(job_id)
+        except UnexpectedHTTPResponseError:  # The job output is no more available
+            job = None
+    if job is None or job.status_code == "Failed":
+        job = storage_backend.retrieve_inventory(None)
+        Config.set_key(job_key, job.id)
+        log.info("Inventory job {0} initiated, run reconcile_inventory again once completed (about 4 hours)".format(job.id))
+        return
+    if not job.completed:
+        log.info("Inventory job {0} not completed yet".format(job.id))
+        return
+
+    log.info("Downloading inventory...")
+    pipeline = StreamPipeline(_size_string_to_bytes(conf.get("stream_memory", DEFAULT_STREAM_MEMORY)))
+    pipeline.add_stage(lambda src, dst: storage_backend.download_inventory(job, dst))
+
+    report = consume(pipeline, lambda fileobj: reconcile_catalog(InventoryReader(fileobj), backend_hash))
+    Config.set_key(job_key, None)
+
+    log.info("{archives} archives, {recovered} backups recovered".format(**report))
+    for archive_id, description in report["orphaned"]:
+        log.warning("Orphaned archive: {0} ({1})".format(description or "no description", archive_id))
+    for stored_filename in report["missing"]:
+        log.warning("Missing archive: {0}".format(stored_filename))
+    log.info("{0} orphaned archives, {1} missing archives".format(len(report["orphaned"]), len(report["missing"])))
+    return report
+
+
+@app.cmd(help="Compare compression codecs on a sample of a file or directory.")
+@app.cmd_arg('filename', type=str, default=os.getcwd(), nargs="?")
+@app.cmd_arg('-s', '--sample-size', type=str, default="64M", help="sample size (64M by default)")
+@app.cmd_arg('--codecs', type=str, default="", help="space separated codecs (e.g. \"gzip zstd:3 zstd:19\"), every codec by default")
+def benchmark_compression(filename=os.getcwd(), sample_size="64M", codecs="", **kwargs):
+    """Compare compression codecs on a sample of a file or directory.
+
+    :type filename: str
+    :param filename: File/directory to sample.
+
+    :type sample_size: str
+    :param sample_size: Sample size like 64M, 1G.
+
+    :type codecs: str or list
+    :param codecs: Codecs to compare, space separated in a str
+        or a list of str, with optional levels (e.g. zstd:3).
+
+    :rtype: list
+    :return: A list of dict, one for each codec
+        (codec, size, compressed_size, ratio, compress_time, decompress_time).
+
+    """
+    if isinstance(codecs, (str, unicode)):
+        codecs = codecs.split()
+
+    sample = tar_sample(filename, _size_string_to_bytes(sample_size))
+    bytefmt = ByteFormatter()
+    log.info("Sample size: {0}".format(bytefmt(len(sample))))
+
+    results = benchmark_codecs(sample, codecs)
+    for result in results:
+        log.info("{0:10}\t{1:>10}\t{2:6.1%}\tcompress: {3}/s\tdecompress: {4}/s".format(
+                 result["codec"],
+                 bytefmt(result["compressed_size"]),
+                 result["ratio"],
+                 bytefmt(result["size"] / max(result["compress_time"], 1e-6)),
+                 bytefmt(result["size"] / max(result["decompress_time"], 1e-6))))
+
+    return results
+
+
 @app.cmd(help="Show backups list.")
 @app.cmd_arg('query', type=str, default="", help="search filename for query", nargs="?")
 @app.cmd_arg('-d', '--destination', type=str, default="", help="glacier|s3|swift, show every destination by default")
-@app.cmd_arg('-t', '--tags', type=str, default="", help="tags space separated")
+@app.cmd_arg('-t', '--tags', type=str, default="", help="tags space separated, show backups with all of them")
+@app.cmd_arg('--tags-any', type=str, default="", help="tags space separated, show backups with at least one of them")
+@app.cmd_arg('--tags-none', type=str, default="", help="tags space separated, show backups with none of them")
 @app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (all profiles are displayed by default)")
 @app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
-def show(query="", destination="", tags="", profile="default", config=CONFIG_FILE):
-    backups = Backups.search(query, destination, profile=profile, tags=tags, config=config)
+def show(query="", destination="", tags="", tags_any="", tags_none="", profile="default", config=CONFIG_FILE):
+    backups = Backups.search(query, destination, profile=profile, tags=tags, tags_any=tags_any,
+                             tags_none=tags_none, config=config)
     _display_backups(backups)
 
 
+@app.cmd(help="List the files of a backup.")
+@app.cmd_arg('filename', type=str)
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift", default=None)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+def ls(filename, destination=None, profile="default", config=CONFIG_FILE):
+    """List the files of a backup from the local catalog, without downloading it.
+
+    :type filename: str
+    :param filename: Filename or stored filename, the latest backup is listed.
+
+    :rtype: list
+    :return: A list of (path, size, mtime, mode).
+
+    """
+    if not destination:
+        destination = load_config(config).get(profile, {}).get("default_destination", DEFAULT_DESTINATION)
+    backup = Backups.match_filename(filename, destination, profile=profile, config=config)
+    if not backup:
+        log.error("No file matched.")
+        return
+
+    members = ArchiveMembers.list(backup.stored_filename)
+    _display_members([(backup.stored_filename, backup.backup_date) + tuple(member) for member in members],
+                     show_backup=False)
+    return members
+
+
+@app.cmd(help="Find files in every backup.")
+@app.cmd_arg('pattern', type=str, help="glob pattern, matched against the file name or the full path if it contains a /")
+@app.cmd_arg('-d', '--destination', type=str, default="", help="glacier|s3|swift, search every destination by default")
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+def find(pattern, destination="", profile="default", config=CONFIG_FILE):
+    """Find files in the backups not deleted, from the local catalog.
+
+    :type pattern: str
+    :param pattern: Glob pattern like nginx.conf, *.conf or etc/nginx/*,
+        matched against the full path if it contains a /, else against the file name.
+
+    :rtype: list
+    :return: A list of (stored_filename, backup_date, path, size, mtime, mode), newest backups first.
+
+    """
+    if isinstance(destination, basestring):
+        destination = destination.split()
+
+    backend_hashes = None
+    profile_conf = profile and load_config(config).get(profile)
+    if profile_conf:
+        backend_hashes = [hashlib.sha512(profile_conf.get("access_key", "") + profile_conf.get(key, "")).hexdigest()
+                          for key in ["s3_bucket", "glacier_vault"]]
+
+    results = ArchiveMembers.find(pattern, destination, backend_hashes)
+    _display_members(results)
+    return results
+
+
+def _display_members(members, show_backup=True):
+    bytefmt = ByteFormatter()
+    for stored_filename, backup_date, path, size, mtime, mode in members:
+        line = "{0:o}\t{1:8}\t{2}\t{3}".format(mode, bytefmt(size),
+                                                 datetime.fromtimestamp(float(mtime)).isoformat(), path)
+        if show_backup:
+            line = "{0}\t{1}\t{2}".format(datetime.fromtimestamp(float(backup_date)).isoformat(),
+                                            stored_filename, line)
+        log.info(line)
+
+
 def _display_backups(backups):
     bytefmt = ByteFormatter()
     for backup in backups:
@@ -477,7 +1211,8 @@ def configure_backups_rotation(profile="default"):
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift", default=None)
 @app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
 @app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
-def restore(filename, destination=None, profile="default", config=CONFIG_FILE, **kwargs):
+@app.cmd_arg('-m', '--member', type=str, default=None, help="only restore this file/directory (seekable backups)")
+def restore(filename, destination=None, profile="default", config=CONFIG_FILE, member=None, **kwargs):
     """Restore backup in the current working directory.
 
     :type filename: str
@@ -489,6 +1224,10 @@ def restore(filename, destination=None, profile="default", config=CONFIG_FILE, *
     :type profile: str
     :param profile: Profile name (default by default).
 
+    :type member: str
+    :param member: Path of a file/directory inside the archive, only restore it,
+        fetching only the needed byte ranges (seekable backups only).
+
     :type conf: dict
     :keyword conf: Override/set AWS configuration.
 
@@ -513,53 +1252,292 @@ def restore(filename, destination=None, profile="default", config=CONFIG_FILE, *
     key_name = backup.stored_filename
     log.info("Restoring " + key_name)
 
+    chain = backup.get_incremental_chain()
+    if len(chain) > 1:
+        log.info("Incremental backup, restoring {0} backups".format(len(chain)))
+
     # Asking password before actually download to avoid waiting
-    if key_name and backup.is_encrypted():
+    password = None
+    if key_name and any(item.is_encrypted() for item in chain):
         password = kwargs.get("password")
         if not password:
             password = getpass()
 
-    log.info("Downloading...")
-
     download_kwargs = {}
     if kwargs.get("job_check"):
         download_kwargs["job_check"] = True
         log.info("Job Check: " + repr(download_kwargs))
 
-    out = storage_backend.download(key_name, **download_kwargs)
-    if kwargs.get("job_check"):
-        log.info("Job Check Request")
-        # If it's a job_check call, we return Glacier job data
-        return out
+    if member:
+        # The newest backup of the chain holding the member
+        for item in reversed(chain):
+            if not item.metadata.get("seekable"):
+                log.error("{0} is not seekable, restore the whole backup.".format(item.stored_filename))
+                return
+            if _restore_member(storage_backend, item, member, password, conf):
+                events.on_restore(session_id, backup)
+                return backup
+        log.error("{0} not found in {1}.".format(member, key_name))
+        return
 
-    if out and backup.is_encrypted():
-        log.info("Decrypting...")
-        decrypted_out = tempfile.TemporaryFile()
-        decrypt(out, decrypted_out, password)
-        out = decrypted_out
+    for item in chain:
+        out = _restore_backup(storage_backend, item, password, conf, **download_kwargs)
+        if kwargs.get("job_check"):
+            log.info("Job Check Request")
+            # If it's a job_check call, we return Glacier job data
+            return out
 
-    if out and (key_name.endswith(".tgz") or key_name.endswith(".tgz.enc")):
-        log.info("Uncompressing...")
-        out.seek(0)
-        if not backup.metadata.get("KeyValue"):
-            tar = tarfile.open(fileobj=out)
-            tar.extractall()
-            tar.close()
-        else:
-            with closing(GzipFile(fileobj=out, mode="r")) as f:
-                with open(backup.stored_filename, "w") as out:
-                    out.write(f.read())
-    elif out:
-        log.info("Backup is not compressed")
-        with open(backup.filename, "w") as restored:
-            out.seek(0)
-            restored.write(out.read())
+        if not out and len(chain) > 1:
+            log.info("{0} not available yet, incremental restore stopped".format(item.stored_filename))
+            return
+
+        if item.metadata.get("incremental"):
+            apply_deletions(item.metadata["incremental"].get("arcname", item.filename))
 
     events.on_restore(session_id, backup)
 
     return backup
 
 
+@app.cmd(help="Restore several backups in the current directory, Glacier retrieval jobs are submitted at once.")
+@app.cmd_arg('filenames', type=str, nargs="+")
+@app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift", default=None)
+@app.cmd_arg('-p', '--profile', type=str, default="default", help="profile name (default by default)")
+@app.cmd_arg('-c', '--config', type=str, default=CONFIG_FILE, help="path to config file")
+@app.cmd_arg('-i', '--interval', type=str, default=None, help="Interval string between the first Glacier jobs checks (15m by default)")
+def restore_many(filenames, destination=None, profile="default", config=CONFIG_FILE, interval=None, **kwargs):
+    """Restore several backups (with their incremental chain) in the current working directory.
+
+    Glacier retrieval jobs of every archive are submitted at once and polled together
+    by a :class:`bakthat.scheduler.JobScheduler` (the check interval grows up to
+    glacier_job_max_interval while no job completes), each archive is restored as soon as
+    its job completes. A failed restore doesn't stop the others.
+
+    :type filenames: list
+    :param filenames: Backups to restore.
+
+    :type interval: str
+    :param interval: Interval string between the first Glacier jobs checks
+        (glacier_job_interval setting or 15m by default).
+
+    :rtype: list
+    :return: A list of dict (filename, stored_filename, error) for each filename.
+
+    """
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+
+    storage_backend, destination, conf = _get_store_backend(config, destination, profile)
+
+    results = []
+    chains = []
+    for filename in filenames:
+        backup = Backups.match_filename(filename, destination, profile=profile, config=config)
+        if not backup:
+            results.append(dict(filename=filename, stored_filename=None, error="No file matched."))
+            continue
+        results.append(dict(filename=filename, stored_filename=backup.stored_filename, error=None))
+        chains.append((results[-1], backup, backup.get_incremental_chain()))
+
+    password = None
+    if any(item.is_encrypted() for result, backup, chain in chains for item in chain):
+        password = kwargs.get("password")
+        if not password:
+            password = getpass()
+
+    # stored filename => (result, backup, chain, position in the chain)
+    items = {}
+    restored = set()
+    for result, backup, chain in chains:
+        events.before_restore(str(uuid.uuid4()))
+        for i, item in enumerate(chain):
+            items.setdefault(item.stored_filename, []).append((result, backup, chain, i))
+
+    def _restore(key_name, job=None):
+        """Restore key_name in every chain holding it, the previous backups of the chain
+        must be restored first.
+
+        :rtype: bool
+        :return: True if restored.
+
+        """
+        for result, backup, chain, i in items[key_name]:
+            if result["error"]:
+                raise Exception("{0} restore failed: {1}".format(backup.stored_filename, result["error"]))
+            if any(item.stored_filename not in restored for item in chain[:i]):
+                return False
+
+        result, backup, chain, i = items[key_name][0]
+        item = chain[i]
+        log.info("Restoring " + key_name)
+        try:
+            _restore_backup(storage_backend, item, password, conf, job=job)
+            if item.metadata.get("incremental"):
+                apply_deletions(item.metadata["incremental"].get("arcname", item.filename))
+        except Exception, exc:
+            for result, backup, chain, i in items[key_name]:
+                result["error"] = str(exc)
+            raise
+        restored.add(key_name)
+
+        for result, backup, chain, i in items[key_name]:
+            if i == len(chain) - 1:
+                events.on_restore(str(uuid.uuid4()), backup)
+        return True
+
+    key_names = [item.stored_filename for result, backup, chain in chains for item in chain]
+    key_names = [key_name for i, key_name in enumerate(key_names) if key_name not in key_names[:i]]
+    if hasattr(storage_backend, "list_jobs"):
+        interval = _interval_string_to_seconds(interval or conf.get("glacier_job_interval", "15m"))
+        max_interval = _interval_string_to_seconds(conf.get("glacier_job_max_interval", "2h"))
+        scheduler = JobScheduler(storage_backend, interval, max_interval)
+        scheduler.submit(key_names)
+        log.info("{0} retrieval jobs submitted".format(len(scheduler.pending)))
+        failed = scheduler.run(_restore)
+    else:
+        failed = []
+        for key_name in key_names:
+            try:
+                if not _restore(key_name):
+                    raise Exception("Previous incremental backup not restored")
+            except Exception:
+                log.exception("{0} restore failed".format(key_name))
+                failed.append(key_name)
+
+    for key_name in failed:
+        for result, backup, chain, i in items[key_name]:
+            result["error"] = result["error"] or "{0} restore failed".format(key_name)
+
+    errors = [result for result in results if result["error"]]
+    log.info("{0} backups restored, {1} failed".format(len(results) - len(errors), len(errors)))
+    for result in errors:
+        log.error("{filename}: {error}".format(**result))
+
+    return results
+
+
+def _restore_backup(storage_backend, backup, password, conf, **download_kwargs):
+    """Download, decrypt, uncompress and extract a single backup in the current working directory.
+
+    Every step runs in its own pipeline stage, so extraction starts with the download
+    and memory usage is bounded by the stream_memory setting.
+
+    :rtype: bool
+    :return: True if restored, None if the Glacier job is not completed
+        (or the Glacier job for job_check calls).
+
+    """
+    key_name = backup.stored_filename
+    memory = _size_string_to_bytes(conf.get("stream_memory", DEFAULT_STREAM_MEMORY))
+
+    if backup.metadata.get("dedup"):
+        log.info("Downloading chunks...")
+        store = DedupStore(storage_backend, backup.backend_hash,
+                           get_codec(backup.get_compression()), password,
+                           workers=int(conf.get("dedup_workers", 4)))
+        pipeline = StreamPipeline(memory)
+        pipeline.add_stage(lambda src, dst: store.restore(key_name, dst))
+        consume(pipeline, extract_tarball)
+        return True
+
+    if download_kwargs.get("job_check"):
+        return storage_backend.download(key_name, **download_kwargs)
+
+    stream_kwargs = _stream_kwargs(storage_backend, key_name, memory, download_kwargs.get("job"))
+    if stream_kwargs is None:
+        return
+
+    log.info("Downloading...")
+    pipeline = StreamPipeline(memory // 2)
+    pipeline.add_stage(download_stage(storage_backend, key_name, **stream_kwargs))
+    if backup.is_encrypted():
+        log.info("Decrypting...")
+        pipeline.add_stage(decrypt_stage(password))
+
+    codec = get_codec(backup.get_compression())
+    if codec and not backup.metadata.get("KeyValue"):
+        log.info("Uncompressing ({0})...".format(codec.name))
+        consume(pipeline, lambda fileobj: extract_tarball(codec.decompressor(fileobj)))
+        return True
+
+    if codec:
+        log.info("Uncompressing ({0})...".format(codec.name))
+        filename = backup.stored_filename
+    else:
+        log.info("Backup is not compressed")
+        filename = backup.filename
+
+    def _write(fileobj):
+        if codec:
+            fileobj = codec.decompressor(fileobj)
+        with open(filename, "wb") as restored:
+            copy_stream(fileobj, restored)
+
+    consume(pipeline, _write)
+    return True
+
+
+def _stream_kwargs(storage_backend, key_name, memory, job=None):
+    """Return the backend download_stream kwargs, None if the Glacier job is not completed."""
+    # Half of the memory for the downloaded ranges, the other half for the pipes
+    stream_kwargs = {"memory": memory // 2}
+    if hasattr(storage_backend, "get_job"):
+        # Glacier archives are only available once the retrieval job is completed
+        job = job or storage_backend.get_job(key_name)
+        if not job or not job.completed:
+            log.info("Not completed yet")
+            return
+        stream_kwargs["job"] = job
+    return stream_kwargs
+
+
+def _restore_member(storage_backend, backup, member, password, conf):
+    """Restore a single member (or directory) of a seekable backup in the current working directory,
+    only the frames holding it are downloaded.
+
+    :rtype: list
+    :return: The restored members names, None if member is not in the backup
+        or if the Glacier job is not completed.
+
+    """
+    key_name = backup.stored_filename
+    found = index_lookup(_load_index(storage_backend, backup, password), member)
+    if found is None:
+        return
+    names, start, end, skip = found
+    log.info("Restoring {0} members of {1} (bytes {2}-{3})".format(len(names), key_name, start, end))
+
+    memory = _size_string_to_bytes(conf.get("stream_memory", DEFAULT_STREAM_MEMORY))
+    stream_kwargs = _stream_kwargs(storage_backend, key_name, memory)
+    if stream_kwargs is None:
+        return
+
+    pipeline = StreamPipeline(memory // 2)
+    if backup.is_encrypted():
+        fetch_start, fetch_end, fetch_skip = encrypted_range(start, end)
+        pipeline.add_stage(download_stage(storage_backend, key_name, byte_range=(fetch_start, fetch_end),
+                                          **stream_kwargs))
+        pipeline.add_stage(decrypt_stage(password, padding=False))
+        pipeline.add_stage(slice_stage(fetch_skip, end - start))
+    else:
+        pipeline.add_stage(download_stage(storage_backend, key_name, byte_range=(start, end), **stream_kwargs))
+
+    codec = get_codec(backup.get_compression())
+
+    def _extract(fileobj):
+        fileobj = codec.decompressor(fileobj)
+        # The first member starts inside the first frame
+        remaining = skip
+        while remaining:
+            data = fileobj.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise Exception("Unexpected end of {0}".format(key_name))
+            remaining -= len(data)
+        return extract_members(fileobj, names)
+
+    return consume(pipeline, _extract)
+
+
 @app.cmd(help="Delete a backup.")
 @app.cmd_arg('filename', type=str)
 @app.cmd_arg('-d', '--destination', type=str, help="s3|glacier|swift", default=None)
@@ -606,8 +1584,7 @@ def delete(filename, destination=None, profile="default", config=CONFIG_FILE, **
 
     log.info("Deleting {0}".format(key_name))
 
-    storage_backend.delete(key_name)
-    backup.set_deleted()
+    _delete_backup(storage_backend, backup)
 
     events.on_delete(session_id, backup)
 
@@ -2,22 +2,378 @@
 import tempfile
 import os
 import logging
+import base64
+import hashlib
+import threading
+import uuid
+import time
 import shelve
+import stat
+import calendar
+from collections import deque
+from datetime import datetime
 import json
 import socket
 import httplib
+import urllib
+from itertools import izip
+from StringIO import StringIO
+from Queue import Queue, Full
 
 import boto
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 import math
 from boto.glacier.exceptions import UnexpectedHTTPResponseError
+from boto.glacier.job import Job
+from boto.glacier.layer1 import Layer1
+from boto.glacier.vault import Vault
+from boto.glacier.utils import chunk_hashes, tree_hash, bytes_to_hex
 from boto.exception import S3ResponseError
 
 from bakthat.conf import config, DEFAULT_LOCATION, CONFIG_FILE
-from bakthat.models import Inventory, Jobs
+from bakthat.models import database, Inventory, Jobs, Uploads, Downloads
+from bakthat.models import JOB_IN_PROGRESS, JOB_COMPLETED, JOB_DOWNLOADED, JOB_EXPIRED
+from bakthat.stream import CHUNK_SIZE, copy_stream
+from bakthat.pool import WorkerPool
+from bakthat.utils import _size_string_to_bytes
 
 log = logging.getLogger(__name__)
 
+# S3 minimum size for every part of a multipart upload, except the last one
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_DEFAULT_PART_SIZE = 64 * 1024 * 1024
+S3_DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+S3_DEFAULT_UPLOAD_WORKERS = 4
+S3_DEFAULT_PART_RETRIES = 3
+S3_DEFAULT_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+S3_DEFAULT_DOWNLOAD_WORKERS = 4
+S3_LIST_PAGE_SIZE = 1000
+# Maximum number of keys of a multi-object delete request
+S3_MAX_DELETE_KEYS = 1000
+# Split points (following the prefix) of the keyspace of a parallel listing
+S3_LIST_SHARDS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+SWIFT_DEFAULT_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+SWIFT_DEFAULT_DOWNLOAD_WORKERS = 4
+SWIFT_DEFAULT_PART_RETRIES = 3
+SWIFT_DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+SWIFT_DEFAULT_UPLOAD_WORKERS = 4
+# Default maximum number of segments of a Static Large Object
+SWIFT_MAX_SEGMENTS = 1000
+SWIFT_MAX_SEGMENT_SIZE = 5 * 1024 * 1024 * 1024
+SWIFT_DEFAULT_DELETE_WORKERS = 8
+# Default maximum number of objects of a bulk delete request
+SWIFT_MAX_BULK_DELETES = 10000
+
+# Smallest range fetched by a parallel download
+MIN_RANGE_SIZE = 1024 * 1024
+
+GLACIER_MIN_PART_SIZE = 1024 * 1024
+GLACIER_MAX_PART_SIZE = 4 * 1024 * 1024 * 1024
+GLACIER_MAX_PARTS = 10000
+GLACIER_DEFAULT_PART_SIZE = 64 * 1024 * 1024
+GLACIER_DEFAULT_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+GLACIER_DEFAULT_DOWNLOAD_WORKERS = 4
+GLACIER_DEFAULT_DELETE_WORKERS = 8
+
+# Backend instances, by (backend class, profile, configuration), see get_backend
+_backends = {}
+_backends_lock = threading.Lock()
+# (backend class, access key, container) of the containers known to exist
+_containers = set()
+_containers_lock = threading.Lock()
+# Per thread S3 connections, by credentials
+_s3_connections = threading.local()
+
+
+def _parse_iso_date(date):
+    """Return a timestamp from an ISO 8601 date like 2013-01-01T12:00:00.000Z
+    (milliseconds are optional)."""
+    return calendar.timegm(datetime.strptime(date.split(".")[0].rstrip("Z"), "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+def _retry(func, retries, description):
+    """Call func, retry up to retries times with an exponential backoff."""
+    attempt = 0
+    while 1:
+        try:
+            return func()
+        except Exception, exc:
+            attempt += 1
+            if attempt > retries:
+                raise
+            log.warning("{0} failed ({1}), retrying in {2}s".format(description, exc, 2 ** attempt))
+            time.sleep(2 ** attempt)
+
+
+def delete_concurrently(delete, keynames, workers=4):
+    """Call delete for every keyname with workers threads, a failed delete doesn't stop the other ones.
+
+    :type delete: function
+    :param delete: Function taking a keyname.
+
+    :rtype: dict
+    :return: keyname => error message of the failed deletes.
+
+    """
+    def _delete(keyname):
+        try:
+            delete(keyname)
+        except Exception, exc:
+            return str(exc) or exc.__class__.__name__
+
+    keynames = list(keynames)
+    errors = {}
+    with WorkerPool(workers) as pool:
+        for keyname, error in izip(keynames, pool.imap(_delete, keynames)):
+            if error is not None:
+                errors[keyname] = error
+    return errors
+
+
+def _stream_part_size(part_size, max_parts, min_part_size, max_part_size, memory=None, expected_size=None):
+    """Return the part size of a streamed multipart upload and the number of parts kept in memory.
+
+    part_size is raised so max_parts parts hold expected_size, it's only lowered
+    if a single part doesn't fit in memory, the memory budget limits the number
+    of parts in flight instead.
+
+    Raise an Exception if expected_size can't be uploaded within these limits.
+
+    :type memory: int
+    :param memory: Memory budget of the upload parts, no limit if None.
+
+    :type expected_size: int
+    :param expected_size: Expected (or estimated) size of the stream, None if unknown.
+
+    :rtype: tuple
+    :return: (part size, maximum number of parts in memory, None for no limit).
+
+    """
+    needed = int(math.ceil(expected_size / float(max_parts))) if expected_size else 0
+    part_size = max(part_size, needed, min_part_size)
+    if memory and part_size > memory:
+        if needed > memory:
+            raise Exception("Uploading {0} bytes takes parts of {1} bytes (at most {2} parts), "
+                            "more than the memory budget, increase stream_memory".format(expected_size, needed,
+                                                                                       max_parts))
+        part_size = max(memory, min_part_size)
+    if part_size > max_part_size:
+        raise Exception("Uploading {0} bytes takes parts of {1} bytes (at most {2} parts), "
+                        "the maximum part size is {3} bytes".format(expected_size, part_size, max_parts,
+                                                                    max_part_size))
+    return part_size, max(1, memory // part_size) if memory else None
+
+
+def upload_parts(fileobj, part_size, upload_part, checksum, workers=4, upload=None, done=None, data=None,
+                 max_in_memory=None, max_parts=None):
+    """Read fileobj in parts and upload them concurrently,
+    at most workers parts are read ahead.
+
+    Checksums are computed by the workers too, so hashing runs in parallel
+    (hashlib releases the GIL) instead of slowing down the reading thread.
+
+    :type upload_part: function
+    :param upload_part: Function taking (part_num, data, checksum) uploading a part.
+
+    :type checksum: function
+    :param checksum: Function returning the checksum of a part.
+
+    :type upload: Uploads
+    :param upload: Upload state, completed parts are recorded in it
+        (from the calling thread, the SQLite connection can't be shared between threads).
+
+    :type done: dict
+    :param done: part number => checksum of the parts already uploaded,
+        skipped if their checksum still matches.
+
+    :type data: str
+    :param data: First part, if already read.
+
+    :type max_in_memory: int
+    :param max_in_memory: Maximum number of parts in memory (read, queued or uploading),
+        bounds the memory used to max_in_memory * part_size.
+
+    :type max_parts: int
+    :param max_parts: Maximum number of parts of the upload.
+
+    :rtype: list
+    :return: A list of (checksum, size) for every part, in order.
+
+    """
+    done = done or {}
+    parts = []
+    pending = deque()
+    if max_in_memory:
+        workers = min(workers, max_in_memory)
+    slots = threading.Semaphore(max_in_memory) if max_in_memory else None
+
+    def _read():
+        if slots is not None:
+            slots.acquire()
+        data = fileobj.read(part_size)
+        if not data and slots is not None:
+            slots.release()
+        return data
+
+    def _upload(part_num, data):
+        try:
+            part_checksum = checksum(data)
+            if done.get(part_num) == part_checksum:
+                log.info("Part {0} already uploaded".format(part_num))
+                return part_checksum, False
+            upload_part(part_num, data, part_checksum)
+            return part_checksum, True
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def _complete(part_num, size, task):
+        part_checksum, uploaded = task.get()
+        if uploaded and upload is not None:
+            upload.add_part(part_num, part_checksum)
+        parts.append((part_checksum, size))
+
+    try:
+        with WorkerPool(workers, max_pending=workers) as pool:
+            part_num = 0
+            if data is None:
+                data = _read()
+            elif slots is not None:
+                slots.acquire()
+            while data:
+                part_num += 1
+                if max_parts and part_num > max_parts:
+                    raise Exception("The upload takes more than {0} parts of {1} bytes, increase the part size "
+                                    "(and stream_memory to keep several parts in flight)".format(max_parts,
+                                                                                                 part_size))
+                pending.append((part_num, len(data), pool.submit(_upload, part_num, data)))
+                # Stop reading the source as soon as a part failed
+                while pending and pending[0][2].ready():
+                    _complete(*pending.popleft())
+                data = _read()
+
+        while pending:
+            _complete(*pending.popleft())
+    except Exception:
+        # Record the parts uploaded before the failure
+        if upload is not None:
+            for part_num, size, task in pending:
+                if task.ready() and task.error is None:
+                    part_checksum, uploaded = task.get()
+                    if uploaded:
+                        upload.add_part(part_num, part_checksum)
+        raise
+    return parts
+
+
+def _is_regular_file(fileobj):
+    """Return True if fileobj is backed by a regular file (ranges can be written in place)."""
+    try:
+        return stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+
+def download_ranges(size, fetch_range, dst, part_size, workers=4, retries=3, memory=None, offset=0,
+                    done=None, on_done=None):
+    """Download size bytes (starting at offset) with concurrent ranged requests and write them to dst.
+
+    If dst is a regular file, it's preallocated and every range is written in place
+    as soon as it's fetched, otherwise ranges are written in order (for streaming
+    consumers), at most workers ranges are kept in memory.
+
+    :type fetch_range: function
+    :param fetch_range: Function taking (start, end) and returning the bytes
+        of the range (end included), called from the worker threads.
+
+    :type retries: int
+    :param retries: Number of retries for each range.
+
+    :type memory: int
+    :param memory: Optional memory budget, lowers the part size if needed.
+
+    :type done: set
+    :param done: (start, end) of the ranges already written to dst (regular files only), skipped.
+
+    :type on_done: function
+    :param on_done: Function taking (start, end) called once a range is written to dst
+        (regular files only), from the calling thread, even if another range failed.
+
+    """
+    done = done or set()
+    if memory:
+        part_size = min(part_size, memory // max(1, workers))
+    part_size = max(MIN_RANGE_SIZE, part_size)
+    ranges = [(start, min(start + part_size, offset + size) - 1)
+              for start in xrange(offset, offset + size, part_size)]
+
+    def _fetch(byte_range):
+        start, end = byte_range
+
+        def _get():
+            data = fetch_range(start, end)
+            if len(data) != end - start + 1:
+                raise IOError("Range {0}-{1}: got {2} bytes".format(start, end, len(data)))
+            return data
+
+        return _retry(_get, retries, "Range {0}-{1} download".format(start, end))
+
+    if not _is_regular_file(dst):
+        with WorkerPool(workers, max_pending=workers) as pool:
+            for data in pool.imap(_fetch, ranges):
+                dst.write(data)
+        return
+
+    dst.flush()
+    fd = dst.fileno()
+    position = dst.tell()
+    os.ftruncate(fd, position + size)
+    lock = threading.Lock()
+
+    def _fetch_to_file(byte_range):
+        data = _fetch(byte_range)
+        # Python 2 has no os.pwrite, lseek + write under a lock is the same positioned write
+        with lock:
+            os.lseek(fd, position + byte_range[0] - offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+    def _complete(byte_range, task):
+        task.get()
+        if on_done is not None:
+            on_done(*byte_range)
+
+    pending = deque()
+    try:
+        with WorkerPool(workers) as pool:
+            for byte_range in ranges:
+                if byte_range in done:
+                    continue
+                pending.append((byte_range, pool.submit(_fetch_to_file, byte_range)))
+                while pending and pending[0][1].ready():
+                    _complete(*pending.popleft())
+            while pending:
+                _complete(*pending.popleft())
+    except Exception:
+        # Record the ranges written before the failure
+        if on_done is not None:
+            for byte_range, task in pending:
+                if task.ready() and task.error is None:
+                    on_done(*byte_range)
+        raise
+    dst.seek(position + size)
+
+
+def _glacier_part_size(part_size):
+    """Round part_size up to a megabyte multiplied by a power of 2, as required by
+    multipart uploads and to get the tree hash of a job output range."""
+    part_size = max(GLACIER_MIN_PART_SIZE, part_size)
+    return GLACIER_MIN_PART_SIZE * 2 ** int(math.ceil(math.log(part_size / float(GLACIER_MIN_PART_SIZE), 2)))
+
 
 class glacier_shelve(object):
     """Context manager for shelve.
@@ -35,11 +391,54 @@ class glacier_shelve(object):
         self.shelve.close()
 
 
+def get_backend(backend_class, conf={}, profile="default"):
+    """Return the backend_class instance of this profile and configuration,
+    created on the first call and reused afterwards (along with its connections).
+
+    :type backend_class: class
+    :param backend_class: BakthatBackend subclass.
+
+    :type conf: dict
+    :param conf: Custom configuration
+
+    :type profile: str
+    :param profile: Profile name
+
+    """
+    key = (backend_class, profile, json.dumps(conf, sort_keys=True, default=repr))
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = backend_class(conf, profile)
+        return _backends[key]
+
+
+def clear_backends():
+    """Forget the cached backends and containers, e.g. after a configuration change."""
+    with _backends_lock:
+        _backends.clear()
+    with _containers_lock:
+        _containers.clear()
+
+
+def _get_s3_connection(access_key, secret_key):
+    """Return the S3 connection of the current thread for these credentials
+    (boto connections are not thread safe), shared by every S3 backend."""
+    connections = _s3_connections.__dict__
+    if (access_key, secret_key) not in connections:
+        connections[access_key, secret_key] = boto.connect_s3(access_key, secret_key)
+    return connections[access_key, secret_key]
+
+
 class BakthatBackend(object):
     """Handle Configuration for Backends.
 
     The profile is only useful when no conf is None.
 
+    thread_safe is True if the backend can be shared between threads.
+
+    Creating a backend doesn't make any request, the container is checked
+    (and created if needed) by :meth:`ensure_container` before the first upload.
+
     :type conf: dict
     :param conf: Custom configuration
 
@@ -47,6 +446,8 @@ class BakthatBackend(object):
     :param profile: Profile name
 
     """
+    thread_safe = False
+
     def __init__(self, conf={}, profile="default"):
         self.conf = conf
         if not conf:
@@ -56,6 +457,40 @@ class BakthatBackend(object):
             if not "access_key" in self.conf or not "secret_key" in self.conf:
                 log.error("Missing access_key/secret_key in {0} profile ({1}).".format(profile, CONFIG_FILE))
 
+    def ensure_container(self, container=None):
+        """Check the container (self.container by default) exists, create it otherwise.
+
+        Only the first call of the process for a given container makes a request.
+
+        """
+        container = container or self.container
+        key = (self.__class__.__name__, self.conf.get("access_key"), container)
+        if key in _containers:
+            return
+        with _containers_lock:
+            if key not in _containers:
+                self._create_container(container)
+                _containers.add(key)
+
+    def _create_container(self, container):
+        """Create container if it doesn't exist (does nothing for backends without containers)."""
+        pass
+
+    def delete_many(self, keynames):
+        """Delete keynames, a failed delete doesn't stop the other ones.
+
+        :rtype: dict
+        :return: keyname => error message of the keys that couldn't be deleted.
+
+        """
+        errors = {}
+        for keyname in keynames:
+            try:
+                self.delete(keyname)
+            except Exception, exc:
+                errors[keyname] = str(exc) or exc.__class__.__name__
+        return errors
+
 
 class RotationConfig(BakthatBackend):
     """Hold backups rotation configuration."""
@@ -65,72 +500,413 @@ class RotationConfig(BakthatBackend):
 
 
 class S3Backend(BakthatBackend):
-    """Backend to handle S3 upload/download."""
+    """Backend to handle S3 upload/download.
+
+    Files bigger than s3_multipart_threshold and streams are uploaded
+    with a multipart upload, s3_upload_workers parts of s3_part_size
+    are uploaded concurrently.
+
+    Objects bigger than s3_download_part_size are downloaded with
+    s3_download_workers concurrent ranged GETs.
+
+    """
+    thread_safe = True
+
     def __init__(self, conf={}, profile="default"):
         BakthatBackend.__init__(self, conf, profile)
 
-        con = boto.connect_s3(self.conf["access_key"], self.conf["secret_key"])
+        self.part_size = max(S3_MIN_PART_SIZE, _size_string_to_bytes(self.conf.get("s3_part_size", S3_DEFAULT_PART_SIZE)))
+        self.multipart_threshold = _size_string_to_bytes(self.conf.get("s3_multipart_threshold",
+                                                                       S3_DEFAULT_MULTIPART_THRESHOLD))
+        self.upload_workers = int(self.conf.get("s3_upload_workers", S3_DEFAULT_UPLOAD_WORKERS))
+        self.part_retries = int(self.conf.get("s3_part_retries", S3_DEFAULT_PART_RETRIES))
+        self.download_part_size = _size_string_to_bytes(self.conf.get("s3_download_part_size",
+                                                                      S3_DEFAULT_DOWNLOAD_PART_SIZE))
+        self.download_workers = int(self.conf.get("s3_download_workers", S3_DEFAULT_DOWNLOAD_WORKERS))
+        self._local = threading.local()
 
-        region_name = self.conf["region_name"]
-        if region_name == DEFAULT_LOCATION:
-            region_name = ""
+        self.container = self.conf["s3_bucket"]
+        self.container_key = "s3_bucket"
+
+    @property
+    def bucket(self):
+        return self._get_bucket()
 
+    def _create_container(self, container):
+        con = _get_s3_connection(self.conf["access_key"], self.conf["secret_key"])
         try:
-            self.bucket = con.get_bucket(self.conf["s3_bucket"])
+            con.get_bucket(container)
         except S3ResponseError, e:
             if e.code == "NoSuchBucket":
-                self.bucket = con.create_bucket(self.conf["s3_bucket"], location=region_name)
+                region_name = self.conf["region_name"]
+                if region_name == DEFAULT_LOCATION:
+                    region_name = ""
+                con.create_bucket(container, location=region_name)
             else:
                 raise e
 
-        self.container = self.conf["s3_bucket"]
-        self.container_key = "s3_bucket"
-
     def download(self, keyname):
-        k = Key(self.bucket)
-        k.key = keyname
-
         encrypted_out = tempfile.TemporaryFile()
-        k.get_contents_to_file(encrypted_out)
+        self.download_stream(keyname, encrypted_out)
         encrypted_out.seek(0)
 
         return encrypted_out
 
+    def download_stream(self, keyname, dst, byte_range=None, **kwargs):
+        """Download keyname to dst, see :func:`download_ranges` for big objects.
+
+        :type byte_range: tuple
+        :param byte_range: Optional (start, end) range to download, end excluded.
+
+        :type memory: int
+        :param memory: Optional memory budget, lowers the range size if needed.
+
+        """
+        k = self.bucket.get_key(keyname)
+        if k is None:
+            raise Exception("{0} not found".format(keyname))
+        start, end = byte_range or (0, k.size)
+
+        if self.download_workers > 1 and end - start > self.download_part_size:
+            download_ranges(end - start, lambda first, last: self.download_range(keyname, first, last, k.etag),
+                            dst, self.download_part_size, self.download_workers,
+                            self.part_retries, kwargs.get("memory"), start)
+        elif byte_range:
+            if end > start:
+                dst.write(self.download_range(keyname, start, end - 1, k.etag))
+        else:
+            k.get_contents_to_file(dst)
+
+    def download_range(self, keyname, start, end, etag=None):
+        """Return the bytes start-end (included) of keyname,
+        fails if the object changed since etag."""
+        k = Key(self._get_bucket())
+        k.key = keyname
+        headers = {"Range": "bytes={0}-{1}".format(start, end)}
+        if etag:
+            headers["If-Match"] = etag
+        return k.get_contents_as_string(headers=headers)
+
     def cb(self, complete, total):
         """Upload callback to log upload percentage."""
         percent = int(complete * 100.0 / total)
         log.info("Upload completion: {0}%".format(percent))
 
     def upload(self, keyname, filename, **kwargs):
+        size = os.path.getsize(filename)
+        if size >= self.multipart_threshold:
+            # The part size is raised to keep under the 10000 parts limit
+            with open(filename, "rb") as fileobj:
+                return self.upload_stream(keyname, fileobj, expected_size=size, size=size, **kwargs)
+
+        self.ensure_container()
         k = Key(self.bucket)
         k.key = keyname
         upload_kwargs = {"reduced_redundancy": kwargs.get("s3_reduced_redundancy", False)}
         if kwargs.get("cb", True):
-            upload_kwargs = dict(cb=self.cb, num_cb=10)
+            upload_kwargs.update(cb=self.cb, num_cb=10)
         k.set_contents_from_filename(filename, **upload_kwargs)
         k.set_acl("private")
 
-    def ls(self):
-        return [key.name for key in self.bucket.get_all_keys()]
+    def _get_bucket(self):
+        """Return a bucket for the current thread (boto connections are not thread safe)."""
+        if not hasattr(self._local, "bucket"):
+            con = _get_s3_connection(self.conf["access_key"], self.conf["secret_key"])
+            self._local.bucket = con.get_bucket(self.container, validate=False)
+        return self._local.bucket
+
+    def _upload_part(self, keyname, upload_id, part_num, data, hex_md5):
+        """Upload a part with its Content-MD5 (checked by S3), retried up to part_retries times."""
+        def _upload():
+            mp = MultiPartUpload(self._get_bucket())
+            mp.key_name = keyname
+            mp.id = upload_id
+            key = mp.upload_part_from_file(StringIO(data), part_num,
+                                           md5=(hex_md5, base64.b64encode(hex_md5.decode("hex"))))
+            if key.etag and key.etag.strip('"') != hex_md5:
+                raise Exception("Part {0} checksum mismatch ({1} != {2})".format(part_num, key.etag, hex_md5))
+            log.info("Part {0} uploaded ({1} bytes)".format(part_num, len(data)))
+
+        _retry(_upload, self.part_retries, "Part {0} upload".format(part_num))
+
+    def _resume(self, keyname, kwargs):
+        """Return the Uploads state and the parts already uploaded
+        if an upload of the same source can be resumed."""
+        if not kwargs.get("fingerprint"):
+            return None, {}
+        upload = Uploads.get_pending(kwargs["backend_hash"], kwargs["fingerprint"], keyname)
+        if upload is None:
+            return None, {}
+
+        mp = MultiPartUpload(self.bucket)
+        mp.key_name = keyname
+        mp.id = upload.upload_id
+        try:
+            remote = dict((part.part_number, part.etag.strip('"')) for part in mp)
+        except S3ResponseError, exc:
+            log.info("Upload {0} can't be resumed ({1}), starting over".format(upload.upload_id, exc.code))
+            upload.done()
+            return None, {}
+
+        done = dict((part_num, etag) for part_num, etag in upload.get_parts().iteritems()
+                    if remote.get(part_num) == etag)
+        log.info("Resuming upload of {0}, {1} parts already uploaded".format(keyname, len(done)))
+        return upload, done
+
+    def upload_stream(self, keyname, fileobj, **kwargs):
+        """Upload a file-like object of unknown size using a multipart upload.
+
+        Parts are read sequentially and uploaded by s3_upload_workers threads,
+        at most twice as many parts as workers are kept in memory, and no more
+        than the memory budget holds.
+
+        If fingerprint (and backend_hash) is given, the upload state is saved
+        in the uploads table, and an interrupted upload of a source with the
+        same fingerprint is resumed, parts whose md5 still matches are skipped.
+
+        :type part_size: int
+        :param part_size: Size of each part (s3_part_size by default).
+
+        :type memory: int
+        :param memory: Optional memory budget, limits the number of parts in flight
+            (lowers the part size only if a single part doesn't fit).
+
+        :type expected_size: int
+        :param expected_size: Estimated size of the stream, the part size is raised
+            to upload it in 10000 parts (fails before uploading anything if it can't).
+
+        :type fingerprint: str
+        :param fingerprint: Source fingerprint, enables resuming.
+
+        """
+        part_size, max_in_memory = _stream_part_size(kwargs.get("part_size", self.part_size), S3_MAX_PARTS,
+                                                     S3_MIN_PART_SIZE, S3_MAX_PART_SIZE, kwargs.get("memory"),
+                                                     kwargs.get("expected_size"))
+        reduced_redundancy = kwargs.get("s3_reduced_redundancy", False)
+
+        data = None
+        upload, done = self._resume(keyname, kwargs)
+        if upload is not None:
+            upload_id, part_size = upload.upload_id, upload.part_size
+            if max_in_memory:
+                max_in_memory = max(1, kwargs["memory"] // part_size)
+        else:
+            self.ensure_container()
+            data = fileobj.read(part_size)
+            if len(data) < part_size:
+                k = Key(self.bucket)
+                k.key = keyname
+                k.set_contents_from_string(data, reduced_redundancy=reduced_redundancy)
+                k.set_acl("private")
+                return
+
+            upload_id = self.bucket.initiate_multipart_upload(keyname, reduced_redundancy=reduced_redundancy).id
+            if kwargs.get("fingerprint"):
+                upload = Uploads.create(backend_hash=kwargs["backend_hash"], fingerprint=kwargs["fingerprint"],
+                                        backend="s3", keyname=keyname, upload_id=upload_id, part_size=part_size,
+                                        filename=kwargs.get("local_filename"), size=kwargs.get("size"),
+                                        created=int(time.time()))
+
+        mp = MultiPartUpload(self.bucket)
+        mp.key_name = keyname
+        mp.id = upload_id
+        try:
+            parts = upload_parts(fileobj, part_size,
+                                 lambda part_num, data, checksum: self._upload_part(keyname, upload_id, part_num, data, checksum),
+                                 lambda data: hashlib.md5(data).hexdigest(),
+                                 self.upload_workers, upload, done, data, max_in_memory, S3_MAX_PARTS)
+            completed = mp.complete_upload()
+        except Exception:
+            if upload is not None:
+                log.error("Upload of {0} interrupted, run the backup again to resume it".format(keyname))
+            else:
+                mp.cancel_upload()
+            raise
+
+        if upload is not None:
+            upload.done()
+
+        # S3 multipart ETag is the md5 of the parts md5 followed by the number of parts
+        digests = "".join(checksum.decode("hex") for checksum, size in parts)
+        expected = "{0}-{1}".format(hashlib.md5(digests).hexdigest(), len(parts))
+        if completed.etag and completed.etag.strip('"') != expected:
+            self.delete(keyname)
+            raise Exception("Upload checksum mismatch ({0} != {1})".format(completed.etag, expected))
+        self.bucket.set_acl("private", keyname)
+
+    def list_uploads(self):
+        """Return the multipart uploads in progress, as a list of dict (keyname, upload_id, created)."""
+        return [dict(keyname=mp.key_name, upload_id=mp.id, created=_parse_iso_date(mp.initiated))
+                for mp in self.bucket.list_multipart_uploads()]
+
+    def abort_upload(self, keyname, upload_id):
+        self.bucket.cancel_multipart_upload(keyname, upload_id)
+
+    def upload_string(self, keyname, data):
+        self.ensure_container()
+        k = Key(self.bucket)
+        k.key = keyname
+        k.set_contents_from_string(data)
+        k.set_acl("private")
+
+    def download_string(self, keyname):
+        k = Key(self.bucket)
+        k.key = keyname
+        return k.get_contents_as_string()
+
+    def exists(self, keyname):
+        return self.bucket.get_key(keyname) is not None
+
+    def ls(self, prefix="", delimiter="", workers=1, shards=S3_LIST_SHARDS, page_size=S3_LIST_PAGE_SIZE):
+        """Iterate over the key names, pages are fetched lazily following the continuation markers.
+
+        With workers > 1, the keyspace is split in ranges at prefix + each character of shards
+        (keys between two split points are in the same range, whatever their characters),
+        listed concurrently, names are then yielded in the order pages are received.
+
+        :type prefix: str
+        :param prefix: Only list the keys starting with prefix.
+
+        :type delimiter: str
+        :param delimiter: Keys sharing a prefix up to the delimiter are listed
+            once as this common prefix (like a directory).
+
+        :type workers: int
+        :param workers: Number of ranges listed concurrently.
+
+        :rtype: iterator
+        :return: Key names (sorted unless workers > 1).
+
+        """
+        if workers > 1:
+            pages = self._list_shards(prefix, delimiter, workers, shards, page_size)
+        else:
+            pages = self._list_pages(prefix, delimiter, page_size=page_size)
+        for page in pages:
+            for name in page:
+                yield name
+
+    def _list_pages(self, prefix="", delimiter="", marker="", end=None, page_size=S3_LIST_PAGE_SIZE):
+        """Yield the sorted names of each page of keys (and common prefixes) after marker,
+        up to end (included)."""
+        while 1:
+            rs = _retry(lambda: self._get_bucket().get_all_keys(prefix=prefix, delimiter=delimiter,
+                                                              marker=marker, max_keys=page_size),
+                        self.part_retries, "Listing of {0}".format(prefix or self.container))
+            # Common prefixes come after the keys
+            names = sorted(key.name for key in rs)
+            if not names:
+                return
+            if end is not None and names[-1] > end:
+                yield [name for name in names if name <= end]
+                return
+            yield names
+            if not rs.is_truncated:
+                return
+            marker = rs.next_marker or names[-1]
+
+    def _list_shards(self, prefix, delimiter, workers, shards, page_size):
+        """Yield the pages of every range between two split points, listed by workers threads."""
+        bounds = [""] + [prefix + char for char in sorted(set(shards))] + [None]
+        pages = Queue(workers * 2)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+
+        def _list(marker, end):
+            try:
+                for page in self._list_pages(prefix, delimiter, marker, end, page_size):
+                    if not _put(page):
+                        return
+            except Exception, exc:
+                _put(exc)
+            else:
+                _put(None)
+
+        pool = WorkerPool(workers, len(bounds))
+        try:
+            for marker, end in zip(bounds, bounds[1:]):
+                pool.submit(_list, marker, end)
+            remaining = len(bounds) - 1
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            # Stop the workers if the iteration is interrupted
+            stop.set()
+            pool.close()
 
     def delete(self, keyname):
         k = Key(self.bucket)
         k.key = keyname
         self.bucket.delete_key(k)
 
+    def delete_many(self, keynames):
+        """Delete keynames with multi-object delete requests of up to 1000 keys,
+        see :meth:`BakthatBackend.delete_many`."""
+        keynames = list(keynames)
+        errors = {}
+        for i in range(0, len(keynames), S3_MAX_DELETE_KEYS):
+            chunk = keynames[i:i + S3_MAX_DELETE_KEYS]
+            try:
+                result = _retry(lambda: self.bucket.delete_keys(chunk, quiet=True),
+                                self.part_retries, "Delete of {0} keys".format(len(chunk)))
+            except Exception, exc:
+                errors.update((keyname, str(exc)) for keyname in chunk)
+                continue
+            for error in result.errors:
+                errors[error.key] = "{0}: {1}".format(error.code, error.message)
+        return errors
+
 
 class GlacierBackend(BakthatBackend):
-    """Backend to handle Glacier upload/download."""
+    """Backend to handle Glacier upload/download.
+
+    Archives are uploaded with a multipart upload, glacier_upload_workers
+    parts of glacier_part_size are uploaded concurrently.
+
+    Job outputs are downloaded to glacier_download_dir, glacier_download_workers
+    ranges of glacier_download_part_size are downloaded concurrently.
+
+    """
+    thread_safe = True
+
     def __init__(self, conf={}, profile="default"):
         BakthatBackend.__init__(self, conf, profile)
 
         con = boto.connect_glacier(aws_access_key_id=self.conf["access_key"], aws_secret_access_key=self.conf["secret_key"], region_name=self.conf["region_name"])
 
-        self.vault = con.create_vault(self.conf["glacier_vault"])
+        # Not described, only the name is needed
+        self.vault = Vault(con.layer1)
+        self.vault.name = self.conf["glacier_vault"]
         self.backup_key = "bakthat_glacier_inventory"
         self.container = self.conf["glacier_vault"]
         self.container_key = "glacier_vault"
 
+        self.part_size = _size_string_to_bytes(self.conf.get("glacier_part_size", GLACIER_DEFAULT_PART_SIZE))
+        self.upload_workers = int(self.conf.get("glacier_upload_workers", S3_DEFAULT_UPLOAD_WORKERS))
+        self.part_retries = int(self.conf.get("glacier_part_retries", S3_DEFAULT_PART_RETRIES))
+        self.download_part_size = _glacier_part_size(_size_string_to_bytes(
+            self.conf.get("glacier_download_part_size", GLACIER_DEFAULT_DOWNLOAD_PART_SIZE)))
+        self.download_workers = int(self.conf.get("glacier_download_workers", GLACIER_DEFAULT_DOWNLOAD_WORKERS))
+        self.download_dir = self.conf.get("glacier_download_dir", tempfile.gettempdir())
+        self.delete_workers = int(self.conf.get("glacier_delete_workers", GLACIER_DEFAULT_DELETE_WORKERS))
+
+    def _create_container(self, container):
+        # Creating an existing vault does nothing
+        self.vault.layer1.create_vault(container)
+
     def load_archives(self):
         return []
 
@@ -139,8 +915,9 @@ class GlacierBackend(BakthatBackend):
         if config.get("aws", "s3_bucket"):
             archives = self.load_archives()
 
-            s3_bucket = S3Backend(self.conf).bucket
-            k = Key(s3_bucket)
+            s3_backend = get_backend(S3Backend, self.conf)
+            s3_backend.ensure_container()
+            k = Key(s3_backend.bucket)
             k.key = self.backup_key
 
             k.set_contents_from_string(json.dumps(archives))
@@ -149,7 +926,7 @@ class GlacierBackend(BakthatBackend):
 
     def load_archives_from_s3(self):
         """Fetch latest inventory backup from S3."""
-        s3_bucket = S3Backend(self.conf).bucket
+        s3_bucket = get_backend(S3Backend, self.conf).bucket
         try:
             k = Key(s3_bucket)
             k.key = self.backup_key
@@ -169,25 +946,145 @@ class GlacierBackend(BakthatBackend):
 #            raise Exception("You must set s3_bucket in order to backup/restore inventory to/from S3.")
 
     def restore_inventory(self):
-        """Restore inventory from S3 to local shelve."""
-        if config.get("aws", "s3_bucket"):
-            loaded_archives = self.load_archives_from_s3()
+        """Restore inventory from S3 to the local inventory table.
 
-            with glacier_shelve() as d:
-                archives = {}
-                for a in loaded_archives:
-                    print a
-                    archives[a["filename"]] = a["archive_id"]
-                d["archives"] = archives
+        Use :func:`bakthat.reconcile_inventory` to rebuild it from the vault inventory.
+
+        """
+        if self.conf.get("s3_bucket"):
+            loaded_archives = self.load_archives_from_s3()
+            with database.transaction():
+                database.get_cursor().executemany("INSERT OR REPLACE INTO inventory (archive_id, filename) "
+                                                  "VALUES (?, ?)",
+                                                  [(a["archive_id"], a["filename"]) for a in loaded_archives])
         else:
             raise Exception("You must set s3_bucket in order to backup/restore inventory to/from S3.")
 
     def upload(self, keyname, filename, **kwargs):
-        archive_id = self.vault.concurrent_create_archive_from_file(filename, keyname)
-        Inventory.create(filename=keyname, archive_id=archive_id)
+        size = os.path.getsize(filename)
+        # The part size is raised to keep under the 10000 parts limit
+        with open(filename, "rb") as fileobj:
+            self.upload_stream(keyname, fileobj, expected_size=size, size=size, **kwargs)
 
         #self.backup_inventory()
 
+    def _upload_part(self, upload_id, part_size, part_num, data, part_tree_hash):
+        start = (part_num - 1) * part_size
+
+        def _upload():
+            self.vault.layer1.upload_part(self.vault.name, upload_id, hashlib.sha256(data).hexdigest(),
+                                          part_tree_hash, (start, start + len(data) - 1), data)
+            log.info("Part {0} uploaded ({1} bytes)".format(part_num, len(data)))
+
+        _retry(_upload, self.part_retries, "Part {0} upload".format(part_num))
+
+    def _resume(self, keyname, kwargs):
+        """Return the Uploads state and the parts already uploaded
+        if an upload of the same source can be resumed."""
+        if not kwargs.get("fingerprint"):
+            return None, {}
+        upload = Uploads.get_pending(kwargs["backend_hash"], kwargs["fingerprint"], keyname)
+        if upload is None:
+            return None, {}
+
+        remote = {}
+        marker = None
+        try:
+            while 1:
+                response = self.vault.layer1.list_parts(self.vault.name, upload.upload_id, marker=marker)
+                for part in response["Parts"]:
+                    start = int(part["RangeInBytes"].split("-")[0])
+                    remote[start // upload.part_size + 1] = part["SHA256TreeHash"]
+                marker = response.get("Marker")
+                if not marker:
+                    break
+        except UnexpectedHTTPResponseError, exc:
+            log.info("Upload {0} can't be resumed ({1}), starting over".format(upload.upload_id, exc))
+            upload.done()
+            return None, {}
+
+        done = dict((part_num, part_tree_hash) for part_num, part_tree_hash in upload.get_parts().iteritems()
+                    if remote.get(part_num) == part_tree_hash)
+        log.info("Resuming upload of {0}, {1} parts already uploaded".format(keyname, len(done)))
+        return upload, done
+
+    def upload_stream(self, keyname, fileobj, **kwargs):
+        """Upload a file-like object of unknown size with a Glacier multipart upload,
+        glacier_upload_workers parts are uploaded concurrently.
+
+        The part size and the number of parts in memory are chosen from the memory
+        budget and expected_size like with :meth:`S3Backend.upload_stream`, the part
+        size is then rounded to a power of 2 megabytes (down if it doesn't fit in memory).
+
+        Interrupted uploads are resumed like with :meth:`S3Backend.upload_stream`,
+        parts are checked with their tree hash.
+
+        """
+        memory = kwargs.get("memory")
+        expected_size = kwargs.get("expected_size")
+        part_size = _glacier_part_size(_stream_part_size(kwargs.get("part_size", self.part_size), GLACIER_MAX_PARTS,
+                                                         GLACIER_MIN_PART_SIZE, GLACIER_MAX_PART_SIZE, memory,
+                                                         expected_size)[0])
+        if memory and part_size > memory and part_size > GLACIER_MIN_PART_SIZE:
+            part_size //= 2
+            if expected_size and part_size * GLACIER_MAX_PARTS < expected_size:
+                raise Exception("Uploading {0} bytes takes parts of {1} bytes (at most {2} parts), "
+                                "more than the memory budget, increase stream_memory".format(
+                                    expected_size, part_size * 2, GLACIER_MAX_PARTS))
+
+        upload, done = self._resume(keyname, kwargs)
+        if upload is not None:
+            upload_id, part_size = upload.upload_id, upload.part_size
+        else:
+            self.ensure_container()
+            response = self.vault.layer1.initiate_multipart_upload(self.vault.name, part_size, keyname)
+            upload_id = response["UploadId"]
+            if kwargs.get("fingerprint"):
+                upload = Uploads.create(backend_hash=kwargs["backend_hash"], fingerprint=kwargs["fingerprint"],
+                                        backend="glacier", keyname=keyname, upload_id=upload_id, part_size=part_size,
+                                        filename=kwargs.get("local_filename"), size=kwargs.get("size"),
+                                        created=int(time.time()))
+
+        try:
+            parts = upload_parts(fileobj, part_size,
+                                 lambda part_num, data, checksum: self._upload_part(upload_id, part_size, part_num, data, checksum),
+                                 lambda data: bytes_to_hex(tree_hash(chunk_hashes(data))),
+                                 self.upload_workers, upload, done, None,
+                                 memory and max(1, memory // part_size), GLACIER_MAX_PARTS)
+            # Parts are aligned on a power of 2 megabytes, so the archive
+            # tree hash is the tree hash of the parts tree hashes
+            archive_tree_hash = bytes_to_hex(tree_hash([checksum.decode("hex") for checksum, size in parts]))
+            response = self.vault.layer1.complete_multipart_upload(self.vault.name, upload_id, archive_tree_hash,
+                                                                   sum(size for checksum, size in parts))
+        except Exception:
+            if upload is not None:
+                log.error("Upload of {0} interrupted, run the backup again to resume it".format(keyname))
+            else:
+                self.vault.layer1.abort_multipart_upload(self.vault.name, upload_id)
+            raise
+
+        if upload is not None:
+            upload.done()
+        Inventory.create(filename=keyname, archive_id=response["ArchiveId"])
+
+    def list_uploads(self):
+        """Return the multipart uploads in progress, as a list of dict (keyname, upload_id, created)."""
+        uploads = []
+        marker = None
+        while 1:
+            response = self.vault.layer1.list_multipart_uploads(self.vault.name, marker=marker)
+            for upload in response["UploadsList"]:
+                uploads.append(dict(keyname=upload["ArchiveDescription"],
+                                    upload_id=upload["MultipartUploadId"],
+                                    created=_parse_iso_date(upload["CreationDate"])))
+            marker = response.get("Marker")
+            if not marker:
+                break
+        return uploads
+
+    def abort_upload(self, keyname, upload_id):
+        self.vault.layer1.abort_multipart_upload(self.vault.name, upload_id)
+
     def get_job_id(self, filename):
         """Get the job_id corresponding to the filename.
 
@@ -207,14 +1104,60 @@ class GlacierBackend(BakthatBackend):
         job = Jobs.get(Jobs.filename == filename)
         job.delete_instance()
 
-    def download(self, keyname, job_check=False):
-        """Initiate a Job, check its status, and download the archive if it's completed."""
+    def initiate_job(self, keyname):
+        """Initiate the retrieval job of keyname.
+
+        :rtype: boto.glacier.job.Job
+        :return: The job, None if keyname is not in the inventory.
+
+        """
         archive_id = Inventory.get_archive_id(keyname)
         if not archive_id:
             log.error("{0} not found !")
             # check if the file exist on S3 ?
             return
 
+        job = self.vault.retrieve_archive(archive_id)
+        Jobs.update_job_id(keyname, job.id)
+        return job
+
+    def update_job_state(self, keyname, job):
+        """Save the state of the job of keyname in the jobs table.
+
+        :rtype: str
+        :return: The job state.
+
+        """
+        if job is None or job.status_code == "Failed":
+            state = JOB_EXPIRED
+        elif job.completed:
+            state = JOB_COMPLETED
+        else:
+            state = JOB_IN_PROGRESS
+        Jobs.set_state(keyname, state)
+        return state
+
+    def list_jobs(self):
+        """Return the jobs of the vault (in progress or completed less than a day ago)
+        with a single listing.
+
+        :rtype: dict
+        :return: job id => boto.glacier.job.Job
+
+        """
+        jobs = {}
+        marker = None
+        while 1:
+            response = self.vault.layer1.list_jobs(self.vault.name, marker=marker)
+            for job_data in response["JobList"]:
+                job = Job(self.vault, job_data)
+                jobs[job.id] = job
+            marker = response.get("Marker")
+            if not marker:
+                return jobs
+
+    def get_job(self, keyname):
+        """Return the retrieval job of keyname, initiate it if needed."""
         job = None
 
         job_id = Jobs.get_job_id(keyname)
@@ -224,25 +1167,97 @@ class GlacierBackend(BakthatBackend):
             try:
                 job = self.vault.get_job(job_id)
             except UnexpectedHTTPResponseError:  # Return a 404 if the job is no more available
-                self.delete_job(keyname)
+                self.update_job_state(keyname, None)
 
-        if not job:
-            job = self.vault.retrieve_archive(archive_id)
-            job_id = job.id
-            Jobs.update_job_id(keyname, job_id)
+        if job:
+            self.update_job_state(keyname, job)
+        else:
+            job = self.initiate_job(keyname)
+            if not job:
+                return
 
         log.info("Job {action}: {status_code} ({creation_date}/{completion_date})".format(**job.__dict__))
 
-        if job.completed:
-            log.info("Downloading...")
-            encrypted_out = tempfile.TemporaryFile()
+        return job
+
+    def _download_part(self, job, start, end):
+        """Return the bytes start-end (included) of the job output, checked against their tree hash."""
+        response = job.get_output(byte_range=(start, end))
+        data = response.read()
+        if "TreeHash" not in response:
+            raise Exception("No tree hash for range {0}-{1}".format(start, end))
+        actual_tree_hash = bytes_to_hex(tree_hash(chunk_hashes(data)))
+        if actual_tree_hash != response["TreeHash"]:
+            raise Exception("Range {0}-{1} tree hash mismatch ({2} != {3})".format(start, end, actual_tree_hash,
+                                                                                   response["TreeHash"]))
+        return data
 
-            # Boto related, download the file in chunk
+    def download_job(self, keyname, job):
+        """Download the output of a completed retrieval job to a file in glacier_download_dir.
+
+        glacier_download_workers ranges are downloaded concurrently and checked against
+        their tree hash, completed ranges are saved in the downloads table, so an
+        interrupted download of the same job is resumed.
+
+        :rtype: Downloads
+        :return: The download state, call its done method once the file is consumed.
+
+        """
+        filename = os.path.join(self.download_dir, "bakthat-{0}".format(hashlib.sha1(job.id).hexdigest()))
+        download = Downloads.start(job.id, keyname, filename, job.archive_size)
+        done = download.get_parts()
+        if done:
+            log.info("Resuming download of {0}, {1} ranges already downloaded".format(keyname, len(done)))
+
+        with open(filename, "r+b" if os.path.isfile(filename) else "wb") as f:
+            download_ranges(job.archive_size, lambda start, end: self._download_part(job, start, end), f,
+                            self.download_part_size, self.download_workers, self.part_retries,
+                            done=done, on_done=download.add_part)
+        return download
+
+    def download_stream(self, keyname, dst, job=None, byte_range=None, **kwargs):
+        """Download the output of a completed retrieval job and write it to dst
+        (see :meth:`download_job`).
+
+        :type job: boto.glacier.job.Job
+        :param job: The retrieval job, fetched with :meth:`get_job` if not given.
+
+        :type byte_range: tuple
+        :param byte_range: Optional (start, end) range of the job output to download,
+            end excluded, tree hashes are not checked.
+
+        """
+        job = job or self.get_job(keyname)
+        if not job or not job.completed:
+            raise Exception("{0} retrieval job is not completed yet".format(keyname))
+
+        if byte_range:
             chunk_size = 4 * 1024 * 1024
-            num_chunks = int(math.ceil(job.archive_size / float(chunk_size)))
-            job._download_to_fileob(encrypted_out, num_chunks, chunk_size, True, (socket.error, httplib.IncompleteRead))
+            for start in xrange(byte_range[0], byte_range[1], chunk_size):
+                end = min(start + chunk_size, byte_range[1]) - 1
+                dst.write(_retry(lambda: job.get_output(byte_range=(start, end)).read(),
+                                 self.part_retries, "Range {0}-{1} download".format(start, end)))
+            return
 
-            encrypted_out.seek(0)
+        download = self.download_job(keyname, job)
+        with open(download.filename, "rb") as f:
+            copy_stream(f, dst)
+        download.done()
+        Jobs.set_state(keyname, JOB_DOWNLOADED)
+
+    def download(self, keyname, job_check=False):
+        """Initiate a Job, check its status, and download the archive if it's completed."""
+        job = self.get_job(keyname)
+        if not job:
+            return
+
+        if job.completed:
+            log.info("Downloading...")
+            download = self.download_job(keyname, job)
+            encrypted_out = open(download.filename, "rb")
+            # The open file stays readable, like a TemporaryFile
+            download.done()
+            Jobs.set_state(keyname, JOB_DOWNLOADED)
             return encrypted_out
         else:
             log.info("Not completed yet")
@@ -257,6 +1272,19 @@ class GlacierBackend(BakthatBackend):
         else:
             return self.vault.get_job(jobid)
 
+    def download_inventory(self, job, dst):
+        """Write the output of a completed inventory job (a JSON document) to dst, chunk by chunk.
+
+        boto loads JSON job outputs in memory, the raw HTTP response is read instead.
+
+        """
+        layer1 = self.vault.layer1
+        uri = "/{0}/vaults/{1}/jobs/{2}/output".format(layer1.account_id, self.vault.name, job.id)
+        response = super(Layer1, layer1).make_request("GET", uri, headers={"x-amz-glacier-version": layer1.Version})
+        if response.status != 200:
+            raise UnexpectedHTTPResponseError((200,), response)
+        copy_stream(response, dst)
+
     def retrieve_archive(self, archive_id, jobid):
         """Initiate a job to retrieve Galcier archive or download archive."""
         if jobid is None:
@@ -276,6 +1304,31 @@ class GlacierBackend(BakthatBackend):
 
             #self.backup_inventory()
 
+    def delete_many(self, keynames):
+        """Delete the archives of keynames with glacier_delete_workers concurrent requests,
+        and remove them from the inventory in a single transaction,
+        see :meth:`BakthatBackend.delete_many`."""
+        keynames = list(keynames)
+        archives = {}
+        cursor = database.get_cursor()
+        for i in range(0, len(keynames), 500):
+            chunk = keynames[i:i + 500]
+            archives.update(cursor.execute("SELECT filename, archive_id FROM inventory WHERE filename IN ({0})".format(
+                ", ".join("?" * len(chunk))), chunk).fetchall())
+
+        errors = dict((keyname, "No archive in the inventory") for keyname in keynames if keyname not in archives)
+
+        def _delete(keyname):
+            _retry(lambda: self.vault.layer1.delete_archive(self.vault.name, archives[keyname]),
+                   self.part_retries, "Delete of {0}".format(keyname))
+
+        errors.update(delete_concurrently(_delete, archives.keys(), self.delete_workers))
+        with database.transaction():
+            database.get_cursor().executemany("DELETE FROM inventory WHERE archive_id = ?",
+                                              [(archive_id,) for keyname, archive_id in archives.items()
+                                               if keyname not in errors])
+        return errors
+
     def upgrade_from_shelve(self):
         try:
             with glacier_shelve() as d:
@@ -290,40 +1343,104 @@ class GlacierBackend(BakthatBackend):
             log.exception(exc)
 
 class SwiftBackend(BakthatBackend):
-    """Backend to handle OpenStack Swift upload/download."""
-    def __init__(self, conf={}, profile="default"):
-        BakthatBackend.__init__(self, conf, profile)
+    """Backend to handle OpenStack Swift upload/download.
+
+    Objects bigger than swift_segment_size are uploaded as Static Large Objects,
+    swift_upload_workers segments are uploaded concurrently to swift_segment_container
+    (<container>_segments by default).
 
-        from swiftclient import Connection, ClientException
+    Objects bigger than swift_download_part_size are downloaded with
+    swift_download_workers concurrent ranged GETs (Swift serves the ranges
+    of a Static Large Object from its segments).
 
-        self.con = Connection(self.conf["auth_url"], self.conf["access_key"], 
-                              self.conf["secret_key"],
-                              auth_version=self.conf["auth_version"],
-                              insecure=True)
+    """
+    thread_safe = True
 
-        region_name = self.conf["region_name"]
-        if region_name == DEFAULT_LOCATION:
-            region_name = ""
+    def __init__(self, conf={}, profile="default"):
+        BakthatBackend.__init__(self, conf, profile)
 
-        try:
-            self.con.head_container(self.conf["s3_bucket"])
-        except ClientException, e:
-            self.con.put_container(self.conf["s3_bucket"])
+        self.download_part_size = _size_string_to_bytes(self.conf.get("swift_download_part_size",
+                                                                      SWIFT_DEFAULT_DOWNLOAD_PART_SIZE))
+        self.download_workers = int(self.conf.get("swift_download_workers", SWIFT_DEFAULT_DOWNLOAD_WORKERS))
+        self.part_retries = int(self.conf.get("swift_part_retries", SWIFT_DEFAULT_PART_RETRIES))
+        self.segment_size = _size_string_to_bytes(self.conf.get("swift_segment_size", SWIFT_DEFAULT_SEGMENT_SIZE))
+        self.upload_workers = int(self.conf.get("swift_upload_workers", SWIFT_DEFAULT_UPLOAD_WORKERS))
+        self.delete_workers = int(self.conf.get("swift_delete_workers", SWIFT_DEFAULT_DELETE_WORKERS))
+        self._local = threading.local()
+        self._bulk_delete = None
 
         self.container = self.conf["s3_bucket"]
         self.container_key = "s3_bucket"
+        self.segment_container = self.conf.get("swift_segment_container", self.container + "_segments")
 
-    def download(self, keyname):
-        headers, data = self.con.get_object(self.container, keyname,
-                                            resp_chunk_size=65535)
+    def _connect(self):
+        from swiftclient import Connection
+
+        return Connection(self.conf["auth_url"], self.conf["access_key"],
+                          self.conf["secret_key"],
+                          auth_version=self.conf["auth_version"],
+                          insecure=True)
+
+    def _get_connection(self):
+        """Return a connection for the current thread (swiftclient connections are not thread safe),
+        it authenticates on its first request."""
+        if not hasattr(self._local, "con"):
+            self._local.con = self._connect()
+        return self._local.con
+
+    @property
+    def con(self):
+        return self._get_connection()
+
+    def _create_container(self, container):
+        from swiftclient import ClientException
 
+        try:
+            self.con.head_container(container)
+        except ClientException:
+            self.con.put_container(container)
+
+    def download(self, keyname):
         encrypted_out = tempfile.TemporaryFile()
-        for chunk in data:
-            encrypted_out.write(chunk)
+        self.download_stream(keyname, encrypted_out)
         encrypted_out.seek(0)
 
         return encrypted_out
 
+    def download_stream(self, keyname, dst, byte_range=None, **kwargs):
+        """Download keyname to dst, see :func:`download_ranges` for big objects.
+
+        :type byte_range: tuple
+        :param byte_range: Optional (start, end) range to download, end excluded.
+
+        :type memory: int
+        :param memory: Optional memory budget, lowers the range size if needed.
+
+        """
+        if byte_range:
+            start, end = byte_range
+        else:
+            start, end = 0, int(self.con.head_object(self.container, keyname)["content-length"])
+
+        if self.download_workers > 1 and end - start > self.download_part_size:
+            download_ranges(end - start, lambda first, last: self.download_range(keyname, first, last),
+                            dst, self.download_part_size, self.download_workers,
+                            self.part_retries, kwargs.get("memory"), start)
+        elif byte_range:
+            if end > start:
+                dst.write(self.download_range(keyname, start, end - 1))
+        else:
+            headers, data = self.con.get_object(self.container, keyname,
+                                                resp_chunk_size=CHUNK_SIZE)
+            for chunk in data:
+                dst.write(chunk)
+
+    def download_range(self, keyname, start, end):
+        """Return the bytes start-end (included) of keyname."""
+        headers, data = self._get_connection().get_object(self.container, keyname,
+                                                          headers={"Range": "bytes={0}-{1}".format(start, end)})
+        return data
+
     def cb(self, complete, total):
         """Upload callback to log upload percentage."""
         """Swift client does not support callbak"""
@@ -331,12 +1448,242 @@ class SwiftBackend(BakthatBackend):
         log.info("Upload completion: {0}%".format(percent))
 
     def upload(self, keyname, filename, **kwargs):
-        fp = open(filename, "rb")
-        self.con.put_object(self.container, keyname, fp)
+        size = os.path.getsize(filename)
+        # The segment size is raised to keep under the segments limit
+        with open(filename, "rb") as fileobj:
+            self.upload_stream(keyname, fileobj, expected_size=size, size=size, **kwargs)
+
+    def _segment_name(self, keyname, upload_id, part_num):
+        return "{0}/{1}/{2:08d}".format(keyname, upload_id, part_num)
+
+    def _upload_segment(self, keyname, upload_id, part_num, data, hex_md5):
+        def _upload():
+            # Swift checks the segment md5
+            self._get_connection().put_object(self.segment_container,
+                                              self._segment_name(keyname, upload_id, part_num),
+                                              data, etag=hex_md5)
+            log.info("Segment {0} uploaded ({1} bytes)".format(part_num, len(data)))
+
+        _retry(_upload, self.part_retries, "Segment {0} upload".format(part_num))
+
+    def _list_segments(self, keyname, upload_id):
+        """Return a dict part number => md5 of the uploaded segments."""
+        prefix = "{0}/{1}/".format(keyname, upload_id)
+        headers, objects = self.con.get_container(self.segment_container, prefix=prefix, full_listing=True)
+        return dict((int(obj["name"][len(prefix):]), obj["hash"]) for obj in objects)
+
+    def _delete_segments(self, keyname, upload_id):
+        for part_num in self._list_segments(keyname, upload_id):
+            self.con.delete_object(self.segment_container, self._segment_name(keyname, upload_id, part_num))
+
+    def list_uploads(self):
+        """Return the segmented uploads in progress, as a list of dict (keyname, upload_id, created).
+
+        Swift doesn't list them, they are the interrupted uploads kept in the uploads table.
+
+        """
+        backend_hash = hashlib.sha512(self.conf.get("access_key") + self.container).hexdigest()
+        q = Uploads.select().where(Uploads.backend == "swift", Uploads.backend_hash == backend_hash)
+        return [dict(keyname=upload.keyname, upload_id=upload.upload_id, created=upload.created) for upload in q]
+
+    def abort_upload(self, keyname, upload_id):
+        self._delete_segments(keyname, upload_id)
+
+    def _resume(self, keyname, kwargs):
+        """Return the Uploads state and the segments already uploaded
+        if an upload of the same source can be resumed."""
+        if not kwargs.get("fingerprint"):
+            return None, {}
+        upload = Uploads.get_pending(kwargs["backend_hash"], kwargs["fingerprint"], keyname)
+        if upload is None:
+            return None, {}
+
+        remote = self._list_segments(keyname, upload.upload_id)
+        done = dict((part_num, hex_md5) for part_num, hex_md5 in upload.get_parts().iteritems()
+                    if remote.get(part_num) == hex_md5)
+        log.info("Resuming upload of {0}, {1} segments already uploaded".format(keyname, len(done)))
+        return upload, done
+
+    def upload_stream(self, keyname, fileobj, **kwargs):
+        """Upload a file-like object of unknown size.
+
+        Sources smaller than swift_segment_size are uploaded with a single PUT,
+        bigger ones are split in segments uploaded by swift_upload_workers threads,
+        and a Static Large Object manifest is written once every segment is uploaded.
+
+        Interrupted uploads are resumed like with :meth:`S3Backend.upload_stream`,
+        segments whose md5 still matches are skipped.
+
+        :type segment_size: int
+        :param segment_size: Size of each segment (swift_segment_size by default).
+
+        :type memory: int
+        :param memory: Optional memory budget, limits the number of segments in flight
+            like with :meth:`S3Backend.upload_stream`.
+
+        :type expected_size: int
+        :param expected_size: Estimated size of the stream, the segment size is raised
+            to upload it in 1000 segments (fails before uploading anything if it can't).
+
+        :type fingerprint: str
+        :param fingerprint: Source fingerprint, enables resuming.
+
+        """
+        segment_size, max_in_memory = _stream_part_size(kwargs.get("segment_size", self.segment_size),
+                                                        SWIFT_MAX_SEGMENTS, MIN_RANGE_SIZE, SWIFT_MAX_SEGMENT_SIZE,
+                                                        kwargs.get("memory"), kwargs.get("expected_size"))
+
+        data = None
+        upload, done = self._resume(keyname, kwargs)
+        if upload is not None:
+            upload_id, segment_size = upload.upload_id, upload.part_size
+            if max_in_memory:
+                max_in_memory = max(1, kwargs["memory"] // segment_size)
+        else:
+            self.ensure_container()
+            data = fileobj.read(segment_size)
+            if len(data) < segment_size:
+                self.con.put_object(self.container, keyname, data)
+                return
+
+            self.ensure_container(self.segment_container)
+            upload_id = uuid.uuid4().hex
+            if kwargs.get("fingerprint"):
+                upload = Uploads.create(backend_hash=kwargs["backend_hash"], fingerprint=kwargs["fingerprint"],
+                                        backend="swift", keyname=keyname, upload_id=upload_id,
+                                        part_size=segment_size, filename=kwargs.get("local_filename"),
+                                        size=kwargs.get("size"), created=int(time.time()))
+
+        try:
+            parts = upload_parts(fileobj, segment_size,
+                                 lambda part_num, data, checksum: self._upload_segment(keyname, upload_id, part_num, data, checksum),
+                                 lambda data: hashlib.md5(data).hexdigest(),
+                                 self.upload_workers, upload, done, data, max_in_memory, SWIFT_MAX_SEGMENTS)
+            manifest = [dict(path="/{0}/{1}".format(self.segment_container,
+                                                    self._segment_name(keyname, upload_id, part_num)),
+                             etag=checksum, size_bytes=size)
+                        for part_num, (checksum, size) in enumerate(parts, 1)]
+            self.con.put_object(self.container, keyname, json.dumps(manifest),
+                                query_string="multipart-manifest=put")
+        except Exception:
+            if upload is not None:
+                log.error("Upload of {0} interrupted, run the backup again to resume it".format(keyname))
+            else:
+                self._delete_segments(keyname, upload_id)
+            raise
+
+        if upload is not None:
+            upload.done()
+
+    def upload_string(self, keyname, data):
+        self.ensure_container()
+        self.con.put_object(self.container, keyname, data)
+
+    def download_string(self, keyname):
+        headers, data = self.con.get_object(self.container, keyname)
+        return data
+
+    def exists(self, keyname):
+        from swiftclient import ClientException
+        try:
+            self.con.head_object(self.container, keyname)
+            return True
+        except ClientException:
+            return False
 
     def ls(self):
         headers, objects = self.con.get_container(self.conf["s3_bucket"])
         return [key['name'] for key in objects]
 
     def delete(self, keyname):
-        self.con.delete_object(self.container, keyname)
+        """Delete keyname, and its segments if it's a Static Large Object."""
+        headers = self.con.head_object(self.container, keyname)
+        if headers.get("x-static-large-object", "").lower() == "true":
+            self.con.delete_object(self.container, keyname, query_string="multipart-manifest=delete")
+        else:
+            self.con.delete_object(self.container, keyname)
+
+    def _get_bulk_delete(self):
+        """Return the bulk delete capability of the cluster, None if it doesn't support it."""
+        if self._bulk_delete is None:
+            try:
+                self._bulk_delete = self.con.get_capabilities().get("bulk_delete") or {}
+            except Exception, exc:
+                log.info("Can't get the cluster capabilities ({0})".format(exc))
+                self._bulk_delete = {}
+        return self._bulk_delete or None
+
+    def delete_many(self, keynames):
+        """Delete keynames with bulk delete requests, then the segments of the Static Large Objects,
+        see :meth:`BakthatBackend.delete_many`.
+
+        Without bulk delete support, swift_delete_workers objects are deleted concurrently.
+
+        """
+        keynames = list(keynames)
+        bulk_delete = self._get_bulk_delete()
+        if bulk_delete is None:
+            return delete_concurrently(self.delete, keynames, self.delete_workers)
+
+        max_deletes = int(bulk_delete.get("max_deletes_per_request", SWIFT_MAX_BULK_DELETES))
+        errors = self._delete_objects(self.container, keynames, max_deletes)
+
+        deleted = set(keynames) - set(errors)
+        try:
+            segments = self._list_objects_segments(deleted)
+        except Exception, exc:
+            log.error("Can't list the segments of the deleted objects ({0})".format(exc))
+            segments = []
+        for segment, error in self._delete_objects(self.segment_container, segments, max_deletes).items():
+            log.error("Error when deleting segment {0}: {1}".format(segment, error))
+        return errors
+
+    def _delete_objects(self, container, names, max_deletes):
+        """Delete the names objects of container with bulk delete requests, missing objects are ignored.
+
+        :rtype: dict
+        :return: name => error message of the objects that couldn't be deleted.
+
+        """
+        errors = {}
+        for i in range(0, len(names), max_deletes):
+            chunk = names[i:i + max_deletes]
+            # Errors may be reported with the quoted or unquoted paths
+            paths = {}
+            quoted = []
+            for name in chunk:
+                path = u"/{0}/{1}".format(container, name).encode("utf-8")
+                quoted.append(urllib.quote(path))
+                paths[path] = paths[quoted[-1]] = name
+            try:
+                headers, body = _retry(lambda: self.con.post_account(
+                    headers={"Content-Type": "text/plain", "Accept": "application/json"},
+                    query_string="bulk-delete", data="\n".join(quoted)),
+                    self.part_retries, "Delete of {0} objects".format(len(chunk)))
+                result = json.loads(body)
+            except Exception, exc:
+                errors.update((name, str(exc)) for name in chunk)
+                continue
+            for path, status in result.get("Errors", []):
+                errors[paths.get(path.encode("utf-8"), path)] = status
+            if not result.get("Errors") and not result.get("Response Status", "200").startswith("2"):
+                errors.update((name, result["Response Status"]) for name in chunk)
+        return errors
+
+    def _list_objects_segments(self, keynames):
+        """Return the segments of the keynames Static Large Objects,
+        named <keyname>/<upload id>/<part number>, listed by keyname prefix."""
+        from swiftclient import ClientException
+
+        segments = []
+        for keyname in keynames:
+            try:
+                headers, objects = self.con.get_container(self.segment_container, prefix=keyname + "/",
+                                                          full_listing=True)
+            except ClientException, exc:
+                if exc.http_status == 404:
+                    return []
+                raise
+            # Skip the segments of keys nested under keyname
+            segments.extend(obj["name"] for obj in objects if obj["name"].rsplit("/", 2)[0] == keyname)
+        return segments
@@ -0,0 +1,752 @@
+# -*- encoding: utf-8 -*-
+import bisect
+import json
+import logging
+import math
+import stat
+import struct
+import tarfile
+import time
+import zlib
+from contextlib import closing  # for Python2.6 compatibility
+from StringIO import StringIO
+
+from bakthat.pool import WorkerPool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Uncompressed size of each frame of a seekable archive
+DEFAULT_FRAME_SIZE = 4 * 1024 * 1024
+DEFAULT_LEVEL = 6
+CHUNK_SIZE = 16 * 1024
+
+# Members smaller than this are always compressed
+MIN_DETECT_SIZE = 64 * 1024
+ENTROPY_SAMPLE_SIZE = 4096
+# bits per byte, compressed/encrypted data is close to 8
+ENTROPY_THRESHOLD = 7.5
+
+# (offset, magic bytes) of already compressed formats
+MAGIC_NUMBERS = [
+    (0, "\x1f\x8b"),  # gzip
+    (0, "\x28\xb5\x2f\xfd"),  # zstd
+    (0, "\xfd7zXZ\x00"),  # xz
+    (0, "BZh"),  # bzip2
+    (0, "\x04\x22\x4d\x18"),  # lz4
+    (0, "7z\xbc\xaf\x27\x1c"),  # 7z
+    (0, "Rar!\x1a\x07"),  # rar
+    (0, "PK\x03\x04"),  # zip, jar, docx, odt...
+    (0, "\xff\xd8\xff"),  # jpeg
+    (0, "\x89PNG\r\n\x1a\n"),  # png
+    (0, "GIF8"),  # gif
+    (8, "WEBP"),  # webp
+    (4, "ftyp"),  # mp4, mov, heic
+    (0, "\x1a\x45\xdf\xa3"),  # mkv, webm
+    (0, "ID3"),  # mp3
+    (0, "OggS"),  # ogg
+    (0, "fLaC"),  # flac
+]
+
+# magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, 0, 0, 255)
+
+
+def gzip_member(data, level=DEFAULT_LEVEL):
+    """Compress data as a standalone gzip member.
+
+    Members can be concatenated, the result is still a valid gzip file.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return GZIP_HEADER + deflated + trailer
+
+
+def entropy(data):
+    """Shannon entropy of data in bits per byte."""
+    size = float(len(data))
+    if not size:
+        return 0.0
+    result = 0.0
+    for i in range(256):
+        count = data.count(chr(i))
+        if count:
+            p = count / size
+            result -= p * math.log(p, 2)
+    return result
+
+
+def is_compressible(sample):
+    """Guess if data starting with sample is worth compressing,
+    from known magic numbers and the entropy of the sample."""
+    for offset, magic in MAGIC_NUMBERS:
+        if sample[offset:offset + len(magic)] == magic:
+            return False
+    return entropy(sample[:ENTROPY_SAMPLE_SIZE]) < ENTROPY_THRESHOLD
+
+
+class ParallelGzipFile(object):
+    """Write-only file-like object compressing blocks in parallel (pigz style).
+
+    The input is split in independent blocks, each one compressed as a gzip member
+    on a thread pool (zlib releases the GIL), members are written in order,
+    the output is a standard multi-member gzip file.
+
+    The underlying fileobj is not closed.
+
+    :type fileobj: file
+    :param fileobj: File-like object to write the gzip stream to.
+
+    :type workers: int
+    :param workers: Number of compression threads.
+
+    :type block_size: int
+    :param block_size: Uncompressed size of each block.
+
+    :type level: int
+    :param level: Compression level.
+
+    """
+    def __init__(self, fileobj, workers=4, block_size=DEFAULT_BLOCK_SIZE, level=DEFAULT_LEVEL):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.level = self.compress_level = level
+        self.pool = WorkerPool(workers)
+        self._buffer = []
+        self._buffer_size = 0
+        self._pending = []
+        self._empty = True
+        self.closed = False
+
+    def _submit(self):
+        data = "".join(self._buffer)
+        self._buffer, self._buffer_size = [], 0
+        self._pending.append(self.pool.submit(gzip_member, data, self.level))
+        self._empty = False
+        self._write_ready(self.pool.max_pending)
+
+    def _write_ready(self, max_pending):
+        """Write compressed members in order, keeping at most max_pending in flight."""
+        while self._pending and (len(self._pending) >= max_pending or self._pending[0].ready()):
+            self.fileobj.write(self._pending.pop(0).get())
+
+    def write(self, data):
+        while data:
+            chunk = data[:self.block_size - self._buffer_size]
+            data = data[len(chunk):]
+            self._buffer.append(chunk)
+            self._buffer_size += len(chunk)
+            if self._buffer_size >= self.block_size:
+                self._submit()
+
+    def store(self, stored):
+        """Store (deflate level 0) the next blocks if stored is True, the output is still a standard gzip file."""
+        level = 0 if stored else self.compress_level
+        if level != self.level:
+            if self._buffer_size:
+                self._submit()
+            self.level = level
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer_size or self._empty:
+            self._submit()
+        self._write_ready(1)
+        self.pool.close()
+        self.closed = True
+
+
+class CompressedWriter(object):
+    """Write-only file-like object compressing data with a codec,
+    the underlying fileobj is not closed.
+
+    :type fileobj: file
+    :param fileobj: File-like object to write the compressed stream to.
+
+    :type codec: Codec
+    :param codec: Compression codec.
+
+    :type workers: int
+    :param workers: Number of compression threads (zstd only).
+
+    """
+    def __init__(self, fileobj, codec, workers=1):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.workers = workers
+        self.compressobj = codec.compressobj(workers)
+        self.stored = False
+        self._dirty = False
+        self.closed = False
+
+    def store(self, stored):
+        """Switch to the codec incompressible_level if stored is True,
+        a new stream is started, concatenated streams are decompressed transparently."""
+        if stored == self.stored or self.codec.incompressible_level is None:
+            return
+        if self._dirty:
+            self.fileobj.write(self.compressobj.flush())
+        level = self.codec.incompressible_level if stored else None
+        self.compressobj = self.codec.compressobj(self.workers, level)
+        self.stored = stored
+        self._dirty = False
+
+    def write(self, data):
+        self._dirty = True
+        out = self.compressobj.compress(data)
+        if out:
+            self.fileobj.write(out)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.write(self.compressobj.flush())
+            self.closed = True
+
+
+class SeekableWriter(object):
+    """Write-only file-like object compressing data in independent frames
+    (a complete gzip member, zstd/lz4 frame or xz stream each), so the
+    archive can be decompressed from the start of any frame.
+
+    The frames attribute holds the (compressed offset, uncompressed offset)
+    of every frame, the underlying fileobj is not closed.
+
+    :type fileobj: file
+    :param fileobj: File-like object to write the compressed stream to.
+
+    :type codec: Codec
+    :param codec: Compression codec.
+
+    :type frame_size: int
+    :param frame_size: Uncompressed size of each frame.
+
+    :type workers: int
+    :param workers: Number of compression threads (zstd only).
+
+    """
+    def __init__(self, fileobj, codec, frame_size=DEFAULT_FRAME_SIZE, workers=1):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.frame_size = frame_size
+        self.workers = workers
+        self.frames = []
+        self.compressed_size = 0
+        self.position = 0
+        self.stored = False
+        self.compressobj = None
+        self._frame_end = 0
+        self.closed = False
+
+    def _write(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.compressed_size += len(data)
+
+    def _end_frame(self):
+        if self.compressobj is not None:
+            self._write(self.compressobj.flush())
+            self.compressobj = None
+
+    def _start_frame(self):
+        level = self.codec.incompressible_level if self.stored else None
+        self.compressobj = self.codec.compressobj(self.workers, level)
+        self.frames.append((self.compressed_size, self.position))
+        self._frame_end = self.position + self.frame_size
+
+    def store(self, stored):
+        """Compress the next frames with the codec incompressible_level if stored is True."""
+        if stored == self.stored or self.codec.incompressible_level is None:
+            return
+        self._end_frame()
+        self.stored = stored
+
+    def write(self, data):
+        while data:
+            if self.compressobj is None:
+                self._start_frame()
+            chunk, data = data[:self._frame_end - self.position], data[self._frame_end - self.position:]
+            self._write(self.compressobj.compress(chunk))
+            self.position += len(chunk)
+            if self.position >= self._frame_end:
+                self._end_frame()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            if self.compressobj is None and not self.frames:
+                self._start_frame()
+            self._end_frame()
+            self.closed = True
+
+
+class DecompressedReader(object):
+    """Read-only file-like object decompressing a stream on the fly.
+
+    Concatenated streams (like multi-member gzip) are supported,
+    a new decompressobj is created each time a stream ends.
+
+    :type fileobj: file
+    :param fileobj: Compressed file-like object, no need to be seekable.
+
+    :type decompressobj: function
+    :param decompressobj: Factory returning a new decompressobj.
+
+    """
+    def __init__(self, fileobj, decompressobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.decompressobj = decompressobj
+        self.chunk_size = chunk_size
+        self._d = decompressobj()
+        self._buffer = []
+        self._buffered = 0
+        self._eof = False
+
+    def _feed(self, data):
+        while data:
+            if getattr(self._d, "eof", False):
+                self._d = self.decompressobj()
+            out = self._d.decompress(data)
+            if out:
+                self._buffer.append(out)
+                self._buffered += len(out)
+            data = getattr(self._d, "unused_data", None)
+            if data and not hasattr(self._d, "eof"):
+                # zlib decompressobj has no eof attribute
+                self._d = self.decompressobj()
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or self._buffered < size):
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self._eof = True
+                break
+            self._feed(data)
+
+        data = "".join(self._buffer)
+        if size < 0:
+            size = len(data)
+        out, rest = data[:size], data[size:]
+        self._buffer = [rest] if rest else []
+        self._buffered = len(rest)
+        return out
+
+    def close(self):
+        pass
+
+
+class Codec(object):
+    """Base class for compression codecs.
+
+    Subclasses implement compressobj and decompressobj,
+    returning objects with compress/flush and decompress methods.
+
+    incompressible_level is the (fastest) level used for incompressible
+    tarball members, None if the codec can't switch level between streams.
+
+    :type level: int
+    :param level: Compression level, codec default if None.
+
+    """
+    name = None
+    extension = None
+    default_level = None
+    incompressible_level = None
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else int(level)
+
+    def __repr__(self):
+        return "<Codec: {0}:{1}>".format(self.name, self.level)
+
+    def compressobj(self, workers=1, level=None):
+        raise NotImplementedError
+
+    def decompressobj(self):
+        raise NotImplementedError
+
+    def compressor(self, fileobj, workers=1):
+        """Return a write-only file-like object compressing to fileobj."""
+        return CompressedWriter(fileobj, self, workers)
+
+    def decompressor(self, fileobj):
+        """Return a read-only file-like object decompressing fileobj."""
+        return DecompressedReader(fileobj, self.decompressobj)
+
+    def compress(self, data):
+        c = self.compressobj()
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        return self.decompressor(StringIO(data)).read()
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    extension = "tgz"
+    default_level = DEFAULT_LEVEL
+    incompressible_level = 0
+
+    def compressobj(self, workers=1, level=None):
+        level = self.level if level is None else level
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressobj(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def compressor(self, fileobj, workers=1):
+        if workers > 1:
+            return ParallelGzipFile(fileobj, workers, level=self.level)
+        return Codec.compressor(self, fileobj)
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = "tar.zst"
+    default_level = 3
+    incompressible_level = -10
+
+    def _zstandard(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression requires the zstandard module (pip install zstandard).")
+        return zstandard
+
+    def compressobj(self, workers=1, level=None):
+        zstd = self._zstandard()
+        level = self.level if level is None else level
+        threads = workers if workers > 1 else 0
+        return zstd.ZstdCompressor(level=level, threads=threads).compressobj()
+
+    def decompressobj(self):
+        return self._zstandard().ZstdDecompressor().decompressobj()
+
+    def decompressor(self, fileobj):
+        # zstandard decompressobj can't read concatenated frames
+        return self._zstandard().ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+class _Lz4CompressObj(object):
+    """compress/flush interface for LZ4FrameCompressor."""
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.begin = compressor.begin()
+
+    def compress(self, data):
+        out, self.begin = self.begin + self.compressor.compress(data), ""
+        return out
+
+    def flush(self):
+        return self.begin + self.compressor.flush()
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    extension = "tar.lz4"
+    default_level = 0
+
+    def _lz4frame(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise Exception("lz4 compression requires the lz4 module (pip install lz4).")
+        return lz4.frame
+
+    def compressobj(self, workers=1, level=None):
+        return _Lz4CompressObj(self._lz4frame().LZ4FrameCompressor(compression_level=self.level))
+
+    def decompressobj(self):
+        return self._lz4frame().LZ4FrameDecompressor()
+
+
+class XzCodec(Codec):
+    name = "xz"
+    extension = "txz"
+    default_level = 6
+
+    def _lzma(self):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise Exception("xz compression requires the backports.lzma module (pip install backports.lzma).")
+        return lzma
+
+    def compressobj(self, workers=1, level=None):
+        return self._lzma().LZMACompressor(preset=self.level)
+
+    def decompressobj(self):
+        return self._lzma().LZMADecompressor()
+
+
+CODECS = dict(gzip=GzipCodec, zstd=ZstdCodec, lz4=Lz4Codec, xz=XzCodec)
+DEFAULT_CODEC = "gzip"
+
+
+def get_codec(spec):
+    """Return a Codec instance from a compression setting.
+
+    :type spec: str or bool
+    :param spec: codec[:level] like "zstd:3" or "gzip",
+        True for the default codec, False/None/"none" to disable compression.
+
+    :rtype: Codec
+    :return: A Codec instance, or None if compression is disabled.
+
+    """
+    if spec is True:
+        spec = DEFAULT_CODEC
+    if not spec or str(spec).lower() in ("none", "false", "no"):
+        return None
+
+    name, _, level = str(spec).lower().partition(":")
+    if name not in CODECS:
+        raise Exception("Unknown compression codec {0}, choose from {1}.".format(name, ", ".join(sorted(CODECS))))
+    return CODECS[name](level or None)
+
+
+class _SampleFull(Exception):
+    pass
+
+
+class _SampleBuffer(object):
+    """Write-only buffer raising _SampleFull once size bytes are written."""
+    def __init__(self, size):
+        self.size = size
+        self.buffer = StringIO()
+
+    def write(self, data):
+        self.buffer.write(data[:self.size - self.buffer.tell()])
+        if self.buffer.tell() >= self.size:
+            raise _SampleFull()
+
+
+def tar_sample(filename, size):
+    """Return the first size bytes of an uncompressed tarball of filename."""
+    out = _SampleBuffer(size)
+    try:
+        write_tarball(out, filename, filename.strip("/").split("/")[-1])
+    except _SampleFull:
+        pass
+    return out.buffer.getvalue()
+
+
+def benchmark_codecs(sample, codecs=None):
+    """Compress/decompress sample with each codec.
+
+    :type sample: str
+    :param sample: Data to compress.
+
+    :type codecs: list
+    :param codecs: Codecs specs (every registered codec by default).
+
+    :rtype: list
+    :return: A list of dict (codec, size, compressed_size, ratio, compress_time, decompress_time),
+        codecs not available are skipped.
+
+    """
+    results = []
+    for spec in codecs or sorted(CODECS):
+        codec = get_codec(spec)
+        try:
+            start = time.time()
+            compressed = codec.compress(sample)
+            compress_time = time.time() - start
+            start = time.time()
+            codec.decompress(compressed)
+            decompress_time = time.time() - start
+        except Exception, exc:
+            log.error("Skipping {0}: {1}".format(codec.name, exc))
+            continue
+        results.append(dict(codec="{0}:{1}".format(codec.name, codec.level),
+                            size=len(sample),
+                            compressed_size=len(compressed),
+                            ratio=len(compressed) / float(max(1, len(sample))),
+                            compress_time=compress_time,
+                            decompress_time=decompress_time))
+    return results
+
+
+class DetectingTarFile(tarfile.TarFile):
+    """TarFile sampling each member, incompressible members
+    are stored with the compressor incompressible level."""
+    compressor = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        if self.compressor is not None and fileobj is not None and tarinfo.isreg():
+            compressible = True
+            if tarinfo.size >= MIN_DETECT_SIZE:
+                try:
+                    pos = fileobj.tell()
+                    compressible = is_compressible(fileobj.read(ENTROPY_SAMPLE_SIZE))
+                    fileobj.seek(pos)
+                except (IOError, AttributeError):
+                    pass
+            self.compressor.store(not compressible)
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+
+
+class IndexingTarFile(DetectingTarFile):
+    """DetectingTarFile recording the name, uncompressed offset
+    and size (headers and padding included) of every member."""
+    def addfile(self, tarinfo, fileobj=None):
+        offset = self.offset
+        DetectingTarFile.addfile(self, tarinfo, fileobj)
+        self.members_offsets.append((tarinfo.name, offset, self.offset - offset))
+
+
+def build_index(frames, compressed_size, members):
+    """Return the index of a seekable archive, every member is located by
+    the compressed offset of its first frame and its offset inside that frame.
+
+    :rtype: dict
+    :return: A dict (frames: list of [compressed offset, uncompressed offset],
+        size: compressed size, members: list of [name, frame offset, offset in frame, size]).
+
+    """
+    starts = [uncompressed for compressed, uncompressed in frames]
+    index_members = []
+    for name, offset, size in members:
+        frame = frames[bisect.bisect_right(starts, offset) - 1]
+        index_members.append([name, frame[0], offset - frame[1], size])
+    return dict(frames=[list(frame) for frame in frames], size=compressed_size, members=index_members)
+
+
+def dump_index(index):
+    return zlib.compress(json.dumps(index, separators=(",", ":")))
+
+
+def load_index(data):
+    return json.loads(zlib.decompress(data))
+
+
+def index_lookup(index, path):
+    """Find path (a member or a directory) in a seekable archive index.
+
+    :rtype: tuple
+    :return: (names, start, end, skip): the matching member names, the compressed
+        range to fetch (end excluded, on frame boundaries), and the number of
+        uncompressed bytes to skip before the first member. None if no member matches.
+
+    """
+    path = path.strip("/")
+    if path.startswith("./"):
+        path = path[2:]
+    frames = dict((compressed, uncompressed) for compressed, uncompressed in index["frames"])
+
+    names, first, last = [], None, None
+    for name, frame_offset, offset, size in index["members"]:
+        if name.strip("/") != path and not name.startswith(path + "/"):
+            continue
+        names.append(name)
+        start = frames[frame_offset] + offset
+        if first is None or start < first[0]:
+            first = (start, frame_offset, offset)
+        if last is None or start + size > last:
+            last = start + size
+
+    if not names:
+        return None
+
+    end = index["size"]
+    for compressed, uncompressed in index["frames"]:
+        if uncompressed >= last:
+            end = compressed
+            break
+    return names, first[1], end, first[2]
+
+
+# File type bits of each tar member type, to store a stat like mode
+TAR_TYPES = {tarfile.DIRTYPE: stat.S_IFDIR,
+             tarfile.SYMTYPE: stat.S_IFLNK,
+             tarfile.CHRTYPE: stat.S_IFCHR,
+             tarfile.BLKTYPE: stat.S_IFBLK,
+             tarfile.FIFOTYPE: stat.S_IFIFO}
+
+
+def member_entry(tarinfo):
+    """Return (path, size, mtime, mode) of a tar member, mode includes the file type bits."""
+    return (tarinfo.name, tarinfo.size, int(tarinfo.mtime),
+            TAR_TYPES.get(tarinfo.type, stat.S_IFREG) | tarinfo.mode)
+
+
+def write_tarball(fileobj, filename, arcname, exclude=None, codec=None, workers=1, add=None, detect=True,
+                  frame_size=None, members=None):
+    """Write a tarball of filename to fileobj, compressed with codec if any.
+
+    Compression is performed in parallel if workers > 1 (gzip and zstd only),
+    if detect is True, incompressible members (already compressed files,
+    media, random data) are stored with the codec fastest level
+    (deflate level 0 for gzip, still a standard tgz).
+
+    If frame_size is set, the tarball is seekable: it's compressed
+    in independent frames (see :class:`SeekableWriter`) and its index
+    is returned (see :func:`build_index`).
+
+    add is an optional function taking (tar, arcname) to select
+    the members instead of adding filename recursively.
+
+    If members is a list, it's extended with the :func:`member_entry` of every member.
+    """
+    def _add(tar):
+        if add:
+            add(tar, arcname)
+        else:
+            tar.add(filename, arcname=arcname, exclude=exclude)
+        if members is not None:
+            members.extend(member_entry(tarinfo) for tarinfo in tar.getmembers())
+
+    if codec is None:
+        with closing(tarfile.open(fileobj=fileobj, mode="w|")) as tar:
+            _add(tar)
+        return
+
+    if frame_size:
+        with closing(SeekableWriter(fileobj, codec, frame_size, workers)) as cfile:
+            with closing(IndexingTarFile.open(fileobj=cfile, mode="w|")) as tar:
+                tar.compressor = cfile
+                tar.members_offsets = []
+                _add(tar)
+        return build_index(cfile.frames, cfile.compressed_size, tar.members_offsets)
+
+    with closing(codec.compressor(fileobj, workers)) as cfile:
+        tarfile_class = DetectingTarFile if detect else tarfile.TarFile
+        with closing(tarfile_class.open(fileobj=cfile, mode="w|")) as tar:
+            if detect:
+                tar.compressor = cfile
+            _add(tar)
+
+
+def extract_tarball(fileobj, path="."):
+    """Extract a tarball read sequentially from fileobj (no need to be seekable)."""
+    with closing(tarfile.open(fileobj=fileobj, mode="r|")) as tar:
+        tar.extractall(path)
+
+
+def extract_members(fileobj, names, path="."):
+    """Extract the given members of a tarball read sequentially from fileobj,
+    fileobj is read until EOF even if the last member comes first."""
+    remaining = set(name.encode("utf-8") if isinstance(name, unicode) else name for name in names)
+    with closing(tarfile.open(fileobj=fileobj, mode="r|")) as tar:
+        for tarinfo in tar:
+            if tarinfo.name in remaining:
+                tar.extract(tarinfo, path)
+                remaining.discard(tarinfo.name)
+            if not remaining:
+                break
+    while fileobj.read(CHUNK_SIZE):
+        pass
+    return names
+
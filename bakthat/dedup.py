@@ -0,0 +1,233 @@
+# -*- encoding: utf-8 -*-
+import hashlib
+import hmac
+import json
+import logging
+import struct
+from StringIO import StringIO
+
+from beefish import encrypt, decrypt
+
+from bakthat.compression import get_codec
+from bakthat.models import Chunks, ChunkRefs
+from bakthat.pool import WorkerPool
+
+log = logging.getLogger(__name__)
+
+CHUNKS_PREFIX = "bakthat_chunks/"
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Gear table for the rolling hash, derived from md5 so every host
+# (and every Python version) cuts chunks at the same boundaries.
+GEAR = [struct.unpack(">I", hashlib.md5(str(i)).digest()[:4])[0] for i in range(256)]
+
+
+class Chunker(object):
+    """Split a stream in content-defined chunks (gear rolling hash, FastCDC style).
+
+    A boundary is found when the high bits of the rolling hash are zero,
+    so inserting or removing data only changes the chunks around the edit.
+
+    :type fileobj: file
+    :param fileobj: File-like object to split.
+
+    :type avg_size: int
+    :param avg_size: Average chunk size (rounded to a power of 2),
+        chunks are between avg_size / 4 and avg_size * 4.
+
+    """
+    def __init__(self, fileobj, avg_size=DEFAULT_CHUNK_SIZE):
+        bits = max(1, int(avg_size).bit_length() - 1)
+        self.fileobj = fileobj
+        self.min_size = (1 << bits) // 4
+        self.max_size = (1 << bits) * 4
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def _cut(self, data):
+        """Return the size of the next chunk of data."""
+        size = len(data)
+        if size <= self.min_size:
+            return size
+        end = min(size, self.max_size)
+        mask = self.mask
+        gear = GEAR
+        h = 0
+        i = self.min_size
+        for c in bytearray(data[self.min_size:end]):
+            h = ((h << 1) + gear[c]) & 0xffffffff
+            i += 1
+            if not h & mask:
+                return i
+        return end
+
+    def __iter__(self):
+        data = ""
+        eof = False
+        while 1:
+            if not eof and len(data) < self.max_size:
+                buf = [data]
+                size = len(data)
+                while size < self.max_size:
+                    read = self.fileobj.read(READ_SIZE)
+                    if not read:
+                        eof = True
+                        break
+                    buf.append(read)
+                    size += len(read)
+                data = "".join(buf)
+            if not data:
+                break
+            cut = self._cut(data)
+            yield data[:cut]
+            data = data[cut:]
+
+
+class DedupStore(object):
+    """Content-addressed chunk store on top of a storage backend.
+
+    Each chunk is compressed, encrypted and stored once under CHUNKS_PREFIX + its id,
+    chunks are shared between every host using the same backend_hash (and password),
+    the list of chunks of each backup (the manifest) is stored as the backup itself.
+
+    Chunk ids start with the name of the codec used to compress them (<codec>/<hash>),
+    so backups (or hosts) using different codecs never share chunks, and every
+    chunk is decompressed with its own codec.
+
+    :type storage_backend: BakthatBackend
+    :param storage_backend: S3 or Swift backend.
+
+    :type backend_hash: str
+    :param backend_hash: Backups backend_hash.
+
+    :type codec: Codec
+    :param codec: Chunks compression codec, None to disable compression.
+
+    :type password: str
+    :param password: Chunks encryption password, None to disable encryption.
+
+    :type workers: int
+    :param workers: Number of concurrent chunks uploads/downloads.
+
+    """
+    def __init__(self, storage_backend, backend_hash, codec=None, password=None,
+                 workers=4, chunk_size=DEFAULT_CHUNK_SIZE):
+        if not hasattr(storage_backend, "upload_string"):
+            raise Exception("Deduplication is not supported by the {0} backend.".format(storage_backend.__class__.__name__))
+        self.storage_backend = storage_backend
+        self.backend_hash = backend_hash
+        self.codec = codec
+        self.password = password
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._codecs = {}
+
+    def chunk_id(self, data):
+        """Chunk id, the codec name followed by the chunk hash, keyed with the password
+        for encrypted chunks, so hosts with a different password never share chunks."""
+        if self.password:
+            digest = hmac.new(self.password, data, hashlib.sha256).hexdigest()
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+        return "{0}/{1}".format(self.codec.name if self.codec else "none", digest)
+
+    def chunk_codec(self, chunk_id):
+        """Return the codec of chunk_id, the store codec for chunks
+        created before the codec was part of the id."""
+        if "/" not in chunk_id:
+            return self.codec
+        name = chunk_id.split("/", 1)[0]
+        if name not in self._codecs:
+            self._codecs[name] = get_codec(name)
+        return self._codecs[name]
+
+    def pack(self, data):
+        if self.codec:
+            data = self.codec.compress(data)
+        if self.password:
+            out = StringIO()
+            encrypt(StringIO(data), out, self.password)
+            data = out.getvalue()
+        return data
+
+    def unpack(self, data):
+        return self._unpack(data, self.codec)
+
+    def _unpack(self, data, codec):
+        if self.password:
+            out = StringIO()
+            decrypt(StringIO(data), out, self.password)
+            data = out.getvalue()
+        if codec:
+            data = codec.decompress(data)
+        return data
+
+    def _upload_chunk(self, chunk_id, data):
+        keyname = CHUNKS_PREFIX + chunk_id
+        if self.storage_backend.exists(keyname):
+            log.debug("Chunk {0} already uploaded by another host".format(chunk_id))
+            return None
+        packed = self.pack(data)
+        self.storage_backend.upload_string(keyname, packed)
+        return len(packed)
+
+    def _download_chunk(self, chunk_id):
+        return self._unpack(self.storage_backend.download_string(CHUNKS_PREFIX + chunk_id),
+                            self.chunk_codec(chunk_id))
+
+    def backup(self, fileobj):
+        """Split fileobj in chunks and upload the chunks not already stored.
+
+        :rtype: dict
+        :return: A dict with the manifest (list of (chunk_id, size))
+            and stats (chunks, new_chunks, size, uploaded).
+
+        """
+        known = Chunks.known(self.backend_hash)
+        log.info("{0} chunks already stored".format(len(known)))
+
+        manifest = []
+        pending = {}
+        with WorkerPool(self.workers) as pool:
+            for data in Chunker(fileobj, self.chunk_size):
+                chunk_id = self.chunk_id(data)
+                manifest.append((chunk_id, len(data)))
+                if chunk_id in known or chunk_id in pending:
+                    continue
+                pending[chunk_id] = (len(data), pool.submit(self._upload_chunk, chunk_id, data))
+
+        new_chunks = []
+        uploaded = 0
+        for chunk_id, (size, task) in pending.iteritems():
+            stored_size = task.get()
+            if stored_size is not None:
+                uploaded += stored_size
+            new_chunks.append((chunk_id, size, stored_size))
+        Chunks.add_many(self.backend_hash, new_chunks)
+
+        log.info("{0} chunks, {1} new, {2} bytes uploaded".format(len(manifest), len(new_chunks), uploaded))
+
+        return dict(manifest=manifest,
+                    chunks=len(manifest),
+                    new_chunks=len(new_chunks),
+                    size=sum(size for chunk_id, size in manifest),
+                    uploaded=uploaded)
+
+    def save_manifest(self, keyname, manifest):
+        """Upload the manifest as keyname and index it in the local catalog."""
+        self.storage_backend.upload_string(keyname, self.pack(json.dumps({"chunks": manifest})))
+        ChunkRefs.set_manifest(keyname, manifest)
+
+    def load_manifest(self, keyname):
+        """Return the manifest from the local catalog, or download it."""
+        manifest = ChunkRefs.get_manifest(keyname)
+        if not manifest:
+            manifest = json.loads(self.unpack(self.storage_backend.download_string(keyname)))["chunks"]
+        return manifest
+
+    def restore(self, keyname, dst):
+        """Download the chunks of the keyname manifest in order into dst."""
+        manifest = self.load_manifest(keyname)
+        with WorkerPool(self.workers) as pool:
+            for data in pool.imap(self._download_chunk, [chunk_id for chunk_id, size in manifest]):
+                dst.write(data)
@@ -0,0 +1,223 @@
+# -*- encoding: utf-8 -*-
+import logging
+import os
+import re
+
+from bakthat.conf import EXCLUDE_FILES
+
+log = logging.getLogger(__name__)
+
+
+def _translate(pattern):
+    """Translate a .gitignore glob to a regex matching a relative path,
+    ``*`` and ``?`` never match a ``/``, ``**`` matches across directories."""
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            res.append(".*")
+            i += 2
+            continue
+        i += 1
+        if c == "*":
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "\\" and i < n:
+            res.append(re.escape(pattern[i]))
+            i += 1
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                res.append("\\[")
+            else:
+                stuff = pattern[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if stuff[0] in "!^":
+                    stuff = "^" + stuff[1:]
+                res.append("(?!/)[{0}]".format(stuff))
+        else:
+            res.append(re.escape(c))
+    return "".join(res)
+
+
+class ExcludeRule(object):
+    """A single .gitignore line.
+
+    :type line: str
+    :param line: The raw line.
+
+    """
+    def __init__(self, line):
+        self.negate = False
+        self.dir_only = False
+
+        if line.startswith("!"):
+            self.negate = True
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+
+        if line.endswith("/"):
+            self.dir_only = True
+            line = line.rstrip("/")
+
+        # A pattern with a slash is relative to the directory of the exclude file,
+        # otherwise it matches a name at any depth.
+        anchored = "/" in line
+        line = line.lstrip("/")
+        self.pattern = line
+        self.regex = _translate(line)
+        if not anchored and not line.startswith("**"):
+            self.regex = "(?:.*/)?" + self.regex
+
+    def __repr__(self):
+        return "<ExcludeRule: {0}{1}{2}>".format("!" if self.negate else "",
+                                                 self.pattern,
+                                                 "/" if self.dir_only else "")
+
+    @classmethod
+    def parse(cls, text):
+        """Return the rules of an exclude file content, blank lines and comments are skipped."""
+        rules = []
+        for line in text.splitlines():
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            rules.append(cls(line))
+        return rules
+
+
+class ExcludeRules(object):
+    """Rules of an exclude file compiled in a single regex.
+
+    Alternatives are tried in reverse order, so the first matching one
+    is the last matching line of the file, like git.
+
+    :type rules: list
+    :param rules: List of :class:`ExcludeRule`.
+
+    """
+    def __init__(self, rules):
+        self.rules = list(reversed(rules))
+        self.file_rules = [rule for rule in self.rules if not rule.dir_only]
+        self._all = self._compile(self.rules)
+        self._files = self._compile(self.file_rules)
+
+    def _compile(self, rules):
+        if not rules:
+            return None
+        return re.compile(r"(?:{0})\Z".format("|".join("({0})".format(rule.regex) for rule in rules)), re.S)
+
+    def _rule(self, regex, rules, path):
+        m = regex.match(path) if regex is not None else None
+        if m is None:
+            return None
+        return rules[m.lastindex - 1]
+
+    def match(self, path, isdir):
+        """Return True if path is excluded, False if re-included by a negated rule,
+        None if no rule matches.
+
+        :type path: str
+        :param path: Path relative to the exclude file directory.
+
+        :type isdir: function
+        :param isdir: Function returning True if path is a directory,
+            only called when a directory only rule matches.
+
+        """
+        rule = self._rule(self._all, self.rules, path)
+        if rule is not None and rule.dir_only and not isdir():
+            rule = self._rule(self._files, self.file_rules, path)
+        if rule is None:
+            return None
+        return not rule.negate
+
+
+class ExcludeMatcher(object):
+    """Callable returning True for excluded paths, ready to inject in tar.add(exclude=...).
+
+    Exclude files (the first of EXCLUDE_FILES found in each directory) are loaded once
+    per directory, rules of the deepest directory take precedence, the exclude_file
+    rules (relative to root) come last.
+
+    Excluded directories are not walked (tarfile and :func:`bakthat.incremental.scan_tree`
+    don't descend into them), so files below an excluded directory can't be re-included,
+    like git.
+
+    :type root: str
+    :param root: Directory to backup.
+
+    :type exclude_file: str
+    :param exclude_file: Path to an extra exclude file.
+
+    :type exclude_files: list
+    :param exclude_files: Name of the per-directory exclude files.
+
+    """
+    def __init__(self, root, exclude_file=None, exclude_files=EXCLUDE_FILES):
+        self.root = os.path.abspath(root)
+        self.exclude_files = exclude_files
+        self.base_rules = None
+        if exclude_file:
+            with open(exclude_file) as f:
+                self.base_rules = ExcludeRules(ExcludeRule.parse(f.read()))
+            log.info("Using {0} to exclude files.".format(exclude_file))
+        self._dirs = {}
+
+    def _rules(self, reldir):
+        """Return the ExcludeRules of reldir (relative to root, "" for root), cached."""
+        if reldir not in self._dirs:
+            rules = None
+            for name in self.exclude_files:
+                efile = os.path.join(self.root, reldir, name)
+                if os.path.isfile(efile):
+                    with open(efile) as f:
+                        rules = ExcludeRules(ExcludeRule.parse(f.read()))
+                    log.info("Using {0} to exclude files.".format(efile))
+                    break
+            self._dirs[reldir] = rules
+        return self._dirs[reldir]
+
+    def excluded(self, relpath, isdir):
+        """Return True if relpath (relative to root) is excluded.
+
+        :type isdir: function
+        :param isdir: Function returning True if relpath is a directory.
+
+        """
+        parts = relpath.split("/")
+        for i in range(len(parts) - 1, -1, -1):
+            rules = self._rules("/".join(parts[:i]))
+            if rules is None:
+                continue
+            result = rules.match("/".join(parts[i:]), isdir)
+            if result is not None:
+                return result
+
+        if self.base_rules is not None:
+            return bool(self.base_rules.match(relpath, isdir))
+        return False
+
+    def __call__(self, filename):
+        relpath = os.path.relpath(os.path.abspath(filename), self.root)
+        if relpath == "." or relpath.startswith(".."):
+            return False
+        relpath = relpath.replace(os.sep, "/")
+        if self.excluded(relpath, lambda: os.path.isdir(filename)):
+            log.debug("{0} excluded".format(filename))
+            return True
+        return False
@@ -8,7 +8,6 @@ import time
 import hashlib
 import json
 from StringIO import StringIO
-from gzip import GzipFile
 
 from beefish import encrypt, decrypt
 from boto.s3.key import Key
@@ -17,6 +16,7 @@ import bakthat
 from bakthat.conf import DEFAULT_DESTINATION
 from bakthat.backends import S3Backend
 from bakthat.models import Backups
+from bakthat.compression import get_codec
 
 log = logging.getLogger(__name__)
 
@@ -24,7 +24,7 @@ log = logging.getLogger(__name__)
 class KeyValue(S3Backend):
     """A Key Value store to store/retrieve object/string on S3.
 
-    Data is gzipped and json encoded before uploading,
+    Data is json encoded and compressed (gzip by default) before uploading,
     compression can be disabled.
     """
     def __init__(self, conf={}, profile="default"):
@@ -40,9 +40,9 @@ class KeyValue(S3Backend):
         :type value: str
         :param value: Value to save, will be json encoded.
 
-        :type value: bool
-        :keyword compress: Compress content with gzip,
-            True by default
+        :type compress: bool or str
+        :keyword compress: Compress content, True (gzip) by default,
+            or a codec like zstd:3.
         """
         k = Key(self.bucket)
         k.key = keyname
@@ -57,17 +57,16 @@ class KeyValue(S3Backend):
                       tags="",
                       metadata={"KeyValue": True,
                                 "is_enc": False,
-                                "is_gzipped": False})
+                                "is_gzipped": False,
+                                "compression": None})
 
         fileobj = StringIO(json.dumps(value))
 
-        if kwargs.get("compress", True):
-            backup["metadata"]["is_gzipped"] = True
-            out = StringIO()
-            f = GzipFile(fileobj=out, mode="w")
-            f.write(fileobj.getvalue())
-            f.close()
-            fileobj = StringIO(out.getvalue())
+        codec = get_codec(kwargs.get("compress", True))
+        if codec:
+            backup["metadata"]["is_gzipped"] = codec.name == "gzip"
+            backup["metadata"]["compression"] = codec.name
+            fileobj = StringIO(codec.compress(fileobj.getvalue()))
 
         password = kwargs.get("password")
         if password:
@@ -76,6 +75,7 @@ class KeyValue(S3Backend):
             encrypt(fileobj, out, password)
             fileobj = out
         # Creating the object on S3
+        self.ensure_container()
         k.set_contents_from_string(fileobj.getvalue())
         k.set_acl("private")
         backup["size"] = k.size
@@ -109,11 +109,9 @@ class KeyValue(S3Backend):
                 fileobj = out
                 fileobj.seek(0)
 
-            if backup.is_gzipped():
-                f = GzipFile(fileobj=fileobj, mode="r")
-                out = f.read()
-                f.close()
-                fileobj = StringIO(out)
+            codec = get_codec(backup.get_compression())
+            if codec:
+                fileobj = StringIO(codec.decompress(fileobj.getvalue()))
             return json.loads(fileobj.getvalue())
         return kwargs.get("default")
 
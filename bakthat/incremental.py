@@ -0,0 +1,188 @@
+# -*- encoding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tarfile
+from datetime import datetime
+from StringIO import StringIO
+
+from bakthat.models import Backups, Config, FileManifest
+
+log = logging.getLogger(__name__)
+
+# Name of the file storing deleted paths, at the root of incremental archives
+INCREMENTAL_INFO = ".bakthat_incremental"
+# Incremental backups following a full backup before the next full one
+DEFAULT_MAX_CHAIN = 6
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while 1:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def scan_tree(root, exclude=None):
+    """Walk root and yield (relative path, size, mtime, inode) for each entry,
+    excluded directories are pruned.
+
+    :type root: str
+    :param root: Directory to scan.
+
+    :type exclude: function
+    :param exclude: Function returning True for excluded paths.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        if exclude:
+            dirnames[:] = [d for d in dirnames if not exclude(os.path.join(dirpath, d))]
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if exclude and exclude(path):
+                continue
+            st = os.lstat(path)
+            size = 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+            yield os.path.relpath(path, root), size, st.st_mtime, st.st_ino
+
+
+class IncrementalBackup(object):
+    """Compute what changed in a directory since its last backup.
+
+    The state of the directory (path, size, mtime, inode, optional hash) at the
+    last backup is kept in the file_manifest table, entries with a different
+    (size, mtime, inode) are considered changed, missing entries deleted.
+
+    :type root: str
+    :param root: Directory to backup.
+
+    :type backend_hash: str
+    :param backend_hash: Backups backend_hash (manifests are per destination).
+
+    :type exclude: function
+    :param exclude: Function returning True for excluded paths.
+
+    :type use_hash: bool
+    :param use_hash: Also compare files content hash, files touched
+        without content changes are skipped (slower, each changed file is read twice).
+
+    :type max_chain: int
+    :param max_chain: Perform a full backup after max_chain incremental backups (0 for no limit),
+        so restoring only downloads and extracts up to max_chain + 1 archives.
+
+    :type max_age: int
+    :param max_age: Perform a full backup once the last full backup is older than max_age seconds.
+
+    """
+    def __init__(self, root, backend_hash, exclude=None, use_hash=False, max_chain=DEFAULT_MAX_CHAIN,
+                 max_age=None, now=None):
+        self.root = os.path.abspath(root)
+        self.backend_hash = backend_hash
+        self.target = "{0}:{1}".format(backend_hash, self.root)
+        self.exclude = exclude
+        self.use_hash = use_hash
+        self.parent = Config.get_key("incremental:" + self.target)
+        self.level = 0
+        if self.parent:
+            self.level = self._chain_level(max_chain, max_age, now)
+            if not self.level:
+                self.parent = None
+        self.changed = []
+        self.deleted = []
+        self._updates = []
+
+    def _chain_level(self, max_chain, max_age, now=None):
+        """Return the level of the next backup (the number of backups of its
+        chain, 0 for a full backup) according to the full backup policy."""
+        try:
+            parent = Backups.get(Backups.stored_filename == self.parent, Backups.is_deleted == False)
+        except Backups.DoesNotExist:
+            log.info("Last backup {0} deleted, performing a full backup".format(self.parent))
+            return 0
+        try:
+            chain = parent.get_incremental_chain()
+        except Exception, exc:
+            log.info("{0} Performing a full backup".format(exc))
+            return 0
+
+        if max_chain and len(chain) > max_chain:
+            log.info("{0} incremental backups since the last full backup, "
+                     "performing a full backup".format(len(chain) - 1))
+            return 0
+        if now is None:
+            now = int(datetime.utcnow().strftime("%s"))
+        if max_age and chain[0].backup_date <= now - max_age:
+            log.info("Last full backup {0} is too old, performing a full backup".format(chain[0].stored_filename))
+            return 0
+        return len(chain)
+
+    def scan(self):
+        """Diff the directory against the last manifest."""
+        previous = FileManifest.load(self.target) if self.parent else {}
+        seen = set()
+        for path, size, mtime, inode in scan_tree(self.root, self.exclude):
+            seen.add(path)
+            old = previous.get(path)
+            if old and old[:3] == (size, mtime, inode):
+                continue
+
+            file_hash = None
+            if self.use_hash and os.path.isfile(os.path.join(self.root, path)):
+                file_hash = _file_hash(os.path.join(self.root, path))
+
+            self._updates.append((path, size, mtime, inode, file_hash))
+            if old and file_hash and old[3] == file_hash:
+                continue
+            self.changed.append(path)
+
+        self.deleted = [path for path in previous if path not in seen]
+        log.info("{0} changed, {1} deleted".format(len(self.changed), len(self.deleted)))
+        return self
+
+    def add_to_tar(self, tar, arcname):
+        """Add changed entries (non recursively) and the deleted paths list to tar."""
+        tar.add(self.root, arcname=arcname, recursive=False)
+        for path in self.changed:
+            tar.add(os.path.join(self.root, path), arcname=os.path.join(arcname, path), recursive=False)
+
+        if self.level:
+            info = json.dumps({"deleted": self.deleted, "parent": self.parent})
+            tarinfo = tarfile.TarInfo(os.path.join(arcname, INCREMENTAL_INFO))
+            tarinfo.size = len(info)
+            tar.addfile(tarinfo, StringIO(info))
+
+    def commit(self, stored_filename):
+        """Save the new manifest once the backup is uploaded."""
+        if not self.parent:
+            FileManifest.clear(self.target)
+        FileManifest.update_many(self.target, self._updates, self.deleted)
+        Config.set_key("incremental:" + self.target, stored_filename)
+
+    def metadata(self):
+        return dict(level=self.level, parent=self.parent,
+                    changed=len(self.changed), deleted=len(self.deleted))
+
+
+def apply_deletions(arcname, path="."):
+    """Remove the paths deleted since the parent backup after extracting an incremental archive."""
+    info_path = os.path.join(path, arcname, INCREMENTAL_INFO)
+    if not os.path.isfile(info_path):
+        return
+
+    with open(info_path) as f:
+        deleted = json.load(f)["deleted"]
+    os.remove(info_path)
+
+    for rel_path in sorted(deleted, reverse=True):
+        full_path = os.path.join(path, arcname, rel_path)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path)
+        elif os.path.lexists(full_path):
+            os.remove(full_path)
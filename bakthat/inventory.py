@@ -0,0 +1,228 @@
+# -*- encoding: utf-8 -*-
+import json
+import logging
+import re
+import time
+
+from bakthat.backends import _parse_iso_date
+from bakthat.compression import CODECS
+from bakthat.models import database
+from bakthat.stream import CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+INVENTORY_BATCH_SIZE = 10000
+
+# Stored filenames look like <filename>.<%Y%m%d%H%M%S>[.<codec extension>][.enc]
+STORED_FILENAME_RE = re.compile(r"^(?P<filename>.+)\.(?P<date>\d{14})(?P<ext>(?:\.[a-z0-9]+)*?)(?P<enc>\.enc)?$")
+EXTENSIONS = dict(("." + codec.extension, name) for name, codec in CODECS.items())
+EXTENSIONS[""] = None
+
+
+def parse_stored_filename(stored_filename):
+    """Return the (filename, compression, is_enc) of a bakthat stored filename,
+    None if it wasn't created by bakthat (or is a deduplicated backup manifest)."""
+    m = STORED_FILENAME_RE.match(stored_filename)
+    if m is None or m.group("ext") not in EXTENSIONS:
+        return
+    return m.group("filename"), EXTENSIONS[m.group("ext")], bool(m.group("enc"))
+
+
+class InventoryReader(object):
+    """Iterate over the archives of a Glacier vault inventory document, parsed incrementally.
+
+    Only one archive is decoded at a time, so the memory used doesn't depend
+    on the number of archives. Top-level values preceding ArchiveList
+    (like InventoryDate) are available in header.
+
+    :type fileobj: file
+    :param fileobj: File-like object of the inventory JSON document.
+
+    """
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.header = {}
+
+    def __iter__(self):
+        decoder = json.JSONDecoder()
+        buf = ""
+        while 1:
+            m = re.search(r'"ArchiveList"\s*:\s*\[', buf)
+            if m:
+                break
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                raise Exception("Invalid inventory, no ArchiveList")
+            buf += data
+
+        for key, value in re.findall(r'"(\w+)"\s*:\s*("(?:[^"\\]|\\.)*"|[-\d.]+)', buf[:m.start()]):
+            self.header[key] = json.loads(value)
+
+        buf = buf[m.end():]
+        pos = 0
+        eof = False
+        while 1:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                archive, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The next archive is incomplete
+                if eof:
+                    raise Exception("Invalid or truncated inventory")
+                data = self.fileobj.read(self.chunk_size)
+                eof = not data
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            yield archive
+
+    @property
+    def inventory_date(self):
+        """Timestamp of the inventory (archives uploaded later are not listed), None if unknown."""
+        if self.header.get("InventoryDate"):
+            return _parse_iso_date(self.header["InventoryDate"])
+
+
+def reconcile_inventory(archives, backend_hash, inventory_date=None, batch_size=INVENTORY_BATCH_SIZE):
+    """Reconcile the local catalog with a Glacier vault inventory.
+
+    Archives are loaded in a temporary table in batches, then:
+
+    - the inventory table is updated (archive description => archive id, the latest archive
+      wins when several share the same description),
+    - Glacier backups of archives with a bakthat stored filename missing from
+      the backups table are recovered,
+    - archives not belonging to a backup (unknown description, deleted backups,
+      older duplicates) are reported as orphaned,
+    - backups created before the inventory date without archive are reported as missing.
+
+    :type archives: iterable
+    :param archives: dicts with ArchiveId, ArchiveDescription, CreationDate and Size keys,
+        e.g. an :class:`InventoryReader`.
+
+    :type inventory_date: int
+    :param inventory_date: Timestamp of the inventory, taken from archives
+        inventory_date attribute (once iterated) if None.
+
+    :rtype: dict
+    :return: dict with the number of archives and recovered backups,
+        and the list of orphaned (archive_id, description) and missing stored filenames.
+
+    """
+    cursor = database.get_cursor()
+    for table in ["vault_archives", "latest_archives", "unknown_archives"]:
+        cursor.execute("DROP TABLE IF EXISTS temp.{0}".format(table))
+    # Creation dates are kept as ISO 8601 strings (they sort like dates), converted by SQLite
+    cursor.execute("CREATE TEMP TABLE vault_archives (archive_id TEXT, description TEXT, "
+                   "creation_date TEXT, size INTEGER)")
+
+    count = 0
+    batch = []
+    for archive in archives:
+        batch.append((archive["ArchiveId"], archive.get("ArchiveDescription") or "",
+                      archive["CreationDate"], archive["Size"]))
+        if len(batch) >= batch_size:
+            count += _insert_archives(batch)
+            batch = []
+    count += _insert_archives(batch)
+    log.info("{0} archives in the vault inventory".format(count))
+    if inventory_date is None:
+        inventory_date = getattr(archives, "inventory_date", None)
+
+    cursor.execute("CREATE INDEX temp.vault_archives_description ON vault_archives (description, creation_date)")
+    # The latest archive of each description
+    cursor.execute("CREATE TEMP TABLE latest_archives AS "
+                   "SELECT description, archive_id, MAX(creation_date) AS creation_date, size "
+                   "FROM vault_archives WHERE description != '' GROUP BY description")
+    cursor.execute("CREATE UNIQUE INDEX temp.latest_archives_description ON latest_archives (description)")
+    cursor.execute("CREATE UNIQUE INDEX temp.latest_archives_archive_id ON latest_archives (archive_id)")
+
+    with database.transaction():
+        cursor.execute("DELETE FROM inventory WHERE id IN (SELECT i.id FROM latest_archives l "
+                       "JOIN inventory i ON i.filename = l.description WHERE i.archive_id != l.archive_id)")
+        cursor.execute("INSERT OR IGNORE INTO inventory (archive_id, filename) "
+                       "SELECT archive_id, description FROM latest_archives")
+
+    recovered = _recover_backups(backend_hash, batch_size)
+
+    orphaned = cursor.execute(
+        "SELECT v.archive_id, v.description FROM vault_archives v "
+        "LEFT JOIN latest_archives l ON l.archive_id = v.archive_id "
+        "LEFT JOIN backups b ON b.stored_filename = v.description "
+        "LEFT JOIN backups i ON v.description LIKE '%.index' "
+        "AND i.stored_filename = substr(v.description, 1, length(v.description) - 6) "
+        "WHERE l.archive_id IS NULL "
+        "OR ((b.id IS NULL OR b.is_deleted = 1) AND (i.id IS NULL OR i.is_deleted = 1)) "
+        "ORDER BY v.creation_date").fetchall()
+
+    missing = [row[0] for row in cursor.execute(
+        "SELECT stored_filename FROM backups "
+        "WHERE backend = 'glacier' AND (backend_hash = ? OR backend_hash IS NULL) AND is_deleted = 0 "
+        "AND backup_date < ? AND stored_filename NOT IN (SELECT description FROM latest_archives) "
+        "ORDER BY backup_date", (backend_hash, inventory_date or time.time())).fetchall()]
+
+    cursor.execute("DROP TABLE temp.latest_archives")
+    cursor.execute("DROP TABLE temp.vault_archives")
+
+    return dict(archives=count, recovered=recovered, orphaned=orphaned, missing=missing)
+
+
+def _insert_archives(batch):
+    with database.transaction():
+        database.get_cursor().executemany("INSERT INTO vault_archives (archive_id, description, creation_date, size) "
+                                          "VALUES (?, ?, ?, ?)", batch)
+    return len(batch)
+
+
+def _recover_backups(backend_hash, batch_size):
+    """Create the backups of the latest archives with a bakthat stored filename
+    unknown to the backups table.
+
+    :rtype: int
+    :return: The number of recovered backups.
+
+    """
+    cursor = database.get_cursor()
+    cursor.execute("CREATE TEMP TABLE unknown_archives AS "
+                   "SELECT l.description, CAST(strftime('%s', l.creation_date) AS INTEGER) AS creation_date, "
+                   "l.size FROM latest_archives l "
+                   "LEFT JOIN backups b ON b.stored_filename = l.description "
+                   "WHERE b.id IS NULL ORDER BY l.creation_date")
+
+    now = int(time.time())
+    metadata = {}
+    recovered = 0
+    last = 0
+    while 1:
+        rows = cursor.execute("SELECT rowid, description, creation_date, size FROM unknown_archives "
+                              "WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, batch_size)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+
+        backups = []
+        for rowid, stored_filename, creation_date, size in rows:
+            parsed = parse_stored_filename(stored_filename)
+            if parsed is None:
+                continue
+            filename, compression, is_enc = parsed
+            if (compression, is_enc) not in metadata:
+                metadata[compression, is_enc] = json.dumps(dict(is_enc=is_enc, compression=compression,
+                                                                recovered=True))
+            backups.append(("glacier", backend_hash, creation_date, filename, False, now,
+                            metadata[compression, is_enc], size, stored_filename, ""))
+
+        with database.transaction():
+            database.get_cursor().executemany(
+                "INSERT INTO backups (backend, backend_hash, backup_date, filename, is_deleted, last_updated, "
+                "metadata, size, stored_filename, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", backups)
+        recovered += len(backups)
+
+    cursor.execute("DROP TABLE temp.unknown_archives")
+    if recovered:
+        log.info("{0} backups recovered from the vault inventory".format(recovered))
+    return recovered
@@ -3,14 +3,17 @@ from datetime import datetime
 from bakthat.conf import config, load_config, DATABASE
 import hashlib
 import json
+import re
 import sqlite3
 import os
+import time
 import requests
 import logging
 
 log = logging.getLogger(__name__)
 
-database = peewee.SqliteDatabase(DATABASE)
+# One connection per thread, for concurrent backups (backup_many)
+database = peewee.SqliteDatabase(DATABASE, threadlocals=True)
 
 
 class JsonField(peewee.CharField):
@@ -78,10 +81,13 @@ class Backups(SyncedModel):
 
         try:
             fquery = "{0}*".format(filename)
-            query = Backups.select().where(Backups.filename % fquery |
-                                           Backups.stored_filename % fquery,
-                                           Backups.backend == destination,
-                                           Backups.backend_hash << [s3_key, glacier_key])
+            wheres = [Backups.filename % fquery | Backups.stored_filename % fquery,
+                      Backups.backend == destination,
+                      Backups.backend_hash << [s3_key, glacier_key]]
+            if _indexed(filename):
+                # Candidates containing filename from the full-text index, the GLOB keeps those starting with it
+                wheres.append(_search_match(["{filename stored_filename}: " + _phrase(filename)]))
+            query = Backups.select().where(*wheres)
             query = query.order_by(Backups.backup_date.desc())
             return query.get()
         except Backups.DoesNotExist:
@@ -89,6 +95,12 @@ class Backups(SyncedModel):
 
     @classmethod
     def search(cls, query="", destination="", **kwargs):
+        """Search the backups not deleted, most recently updated first.
+
+        Tags are exact (case sensitive) matches, given as a list or a space separated str:
+        tags keeps the backups with all of them, tags_any with at least one, tags_none with none of them.
+
+        """
         conf = config
         if kwargs.get("config"):
             conf = load_config(kwargs.get("config"))
@@ -98,8 +110,9 @@ class Backups(SyncedModel):
         if isinstance(destination, (str, unicode)):
             destination = [destination]
 
-        query = "*{0}*".format(query)
         wheres = []
+        # Full-text index queries
+        match = []
 
         if kwargs.get("profile"):
             profile = conf.get(kwargs.get("profile"))
@@ -111,8 +124,12 @@ class Backups(SyncedModel):
 
             wheres.append(Backups.backend_hash << [s3_key, glacier_key])
 
-        wheres.append(Backups.filename % query |
-                      Backups.stored_filename % query)
+        if _indexed(query):
+            match.append("{filename stored_filename}: " + _phrase(query))
+        elif query:
+            query = "*{0}*".format(query)
+            wheres.append(Backups.filename % query |
+                          Backups.stored_filename % query)
         wheres.append(Backups.backend << destination)
         wheres.append(Backups.is_deleted == False)
 
@@ -128,27 +145,141 @@ class Backups(SyncedModel):
         if last_updated_gt:
             wheres.append(Backups.last_updated >= last_updated_gt)
 
-        tags = kwargs.get("tags", [])
-        if tags:
-            if isinstance(tags, (str, unicode)):
-                tags = tags.split()
-            tags_query = ["Backups.tags % '*{0}*'".format(tag) for tag in tags]
-            tags_query = eval("({0})".format(" and ".join(tags_query)))
-            wheres.append(tags_query)
+        # tags: all of them, tags_any: at least one, tags_none: none of them
+        for mode in ["all", "any", "none"]:
+            tags = _split_tags(kwargs.get("tags" if mode == "all" else "tags_" + mode))
+            if tags:
+                wheres.append(_tags_match(tags, mode))
+
+        if match:
+            wheres.append(_search_match(match))
 
         return Backups.select().where(*wheres).order_by(Backups.last_updated.desc())
 
+    @classmethod
+    def live_series(cls, destination="", **kwargs):
+        """Load the live backups of every series (backups of the same filename
+        and backend/container) with a single query, filtered like :meth:`search`.
+
+        :type config: str or dict
+        :param config: Path to the config file, or an already loaded config.
+
+        :rtype: dict
+        :return: (backend, backend_hash, filename) => list of (backup_date, id, stored_filename).
+
+        """
+        conf = config
+        if isinstance(kwargs.get("config"), dict):
+            conf = kwargs["config"]
+        elif kwargs.get("config"):
+            conf = load_config(kwargs.get("config"))
+
+        if not destination:
+            destination = ["s3", "glacier", "swift"]
+        if isinstance(destination, (str, unicode)):
+            destination = [destination]
+
+        sql = ("SELECT backend, backend_hash, filename, backup_date, id, stored_filename FROM backups "
+               "WHERE is_deleted = 0 AND backend IN ({0})".format(", ".join("?" * len(destination))))
+        params = list(destination)
+        if kwargs.get("profile"):
+            profile = conf.get(kwargs.get("profile"))
+            sql += " AND backend_hash IN (?, ?)"
+            params += [hashlib.sha512(profile.get("access_key") + profile.get("s3_bucket")).hexdigest(),
+                       hashlib.sha512(profile.get("access_key") + profile.get("glacier_vault")).hexdigest()]
+
+        series = {}
+        for backend, backend_hash, filename, backup_date, backup_id, stored_filename in \
+                database.execute_sql(sql, params, require_commit=False):
+            series.setdefault((backend, backend_hash, filename), []).append((backup_date, backup_id, stored_filename))
+        return series
+
     def set_deleted(self):
         self.is_deleted = True
         self.last_updated = int(datetime.utcnow().strftime("%s"))
         self.save()
 
+    @classmethod
+    def set_deleted_many(cls, backups):
+        """Mark backups as deleted and clear their archive members in a single transaction."""
+        last_updated = int(datetime.utcnow().strftime("%s"))
+        with database.transaction():
+            cursor = database.get_cursor()
+            cursor.executemany("UPDATE backups SET is_deleted = 1, last_updated = ? WHERE id = ?",
+                               [(last_updated, backup.id) for backup in backups])
+            cursor.executemany("DELETE FROM archive_members WHERE stored_filename = ?",
+                               [(backup.stored_filename,) for backup in backups])
+        for backup in backups:
+            backup.is_deleted = True
+            backup.last_updated = last_updated
+
     def is_encrypted(self):
         return self.stored_filename.endswith(".enc") or self.metadata.get("is_enc")
 
     def is_gzipped(self):
         return self.metadata.get("is_gzipped")
 
+    def get_incremental_chain(self):
+        """Return the backups to restore in order, from the last full backup to this one.
+
+        Raise an Exception if a backup of the chain is missing or deleted.
+
+        """
+        chain = [self]
+        parent = (self.metadata.get("incremental") or {}).get("parent")
+        while parent:
+            try:
+                backup = Backups.get(Backups.stored_filename == parent)
+            except Backups.DoesNotExist:
+                raise Exception("{0} is missing from the incremental chain, "
+                                "{1} can't be restored.".format(parent, self.stored_filename))
+            if backup.is_deleted:
+                raise Exception("{0} was deleted, the incremental chain is broken, "
+                                "{1} can't be restored.".format(parent, self.stored_filename))
+            chain.insert(0, backup)
+            parent = (backup.metadata.get("incremental") or {}).get("parent")
+        return chain
+
+    def get_compression(self):
+        """Return the compression codec name, None if not compressed.
+
+        Backups created before the codec was stored in metadata
+        are detected using the stored filename.
+        """
+        if "compression" in self.metadata:
+            return self.metadata["compression"]
+        if self.metadata.get("KeyValue"):
+            return "gzip" if self.is_gzipped() else None
+        if self.stored_filename.endswith((".tgz", ".tgz.enc")):
+            return "gzip"
+
+    @classmethod
+    def chain_ancestors(cls, excluded=()):
+        """Return the stored filenames of the backups needed to restore
+        the incremental backups not deleted, except the excluded ones.
+
+        :type excluded: set
+        :param excluded: Stored filenames of the backups about to be deleted.
+
+        """
+        parents = {}
+        cursor = database.execute_sql("SELECT stored_filename, metadata FROM backups "
+                                      "WHERE is_deleted = 0 AND metadata LIKE '%\"incremental\"%'",
+                                      require_commit=False)
+        for stored_filename, metadata in cursor.fetchall():
+            parent = (json.loads(metadata).get("incremental") or {}).get("parent")
+            if parent:
+                parents[stored_filename] = parent
+
+        needed = set()
+        for stored_filename, parent in parents.iteritems():
+            if stored_filename in excluded:
+                continue
+            while parent and parent not in needed:
+                needed.add(parent)
+                parent = parents.get(parent)
+        return needed
+
     @classmethod
     def upsert(cls, **backup):
         q = Backups.select()
@@ -166,6 +297,16 @@ class Backups(SyncedModel):
         pk = 'stored_filename'
 
 
+class BackupTags(BaseModel):
+    """Tags of the backups, one row per backup and tag, kept in sync with Backups.tags by triggers."""
+    backup_id = peewee.IntegerField(index=True)
+    tag = peewee.CharField()
+
+    class Meta:
+        db_table = 'backup_tags'
+        indexes = ((('tag', 'backup_id'), True),)
+
+
 class Config(BaseModel):
     """key => value config store."""
     key = peewee.CharField(index=True, unique=True)
@@ -206,10 +347,20 @@ class Inventory(SyncedModel):
         pk = 'filename'
 
 
+# Glacier retrieval job states
+JOB_SUBMITTED = "submitted"
+JOB_IN_PROGRESS = "in_progress"
+JOB_COMPLETED = "completed"
+JOB_DOWNLOADED = "downloaded"
+JOB_EXPIRED = "expired"
+
+
 class Jobs(SyncedModel):
-    """filename => job_id mapping for glacier archives."""
+    """filename => job_id mapping for glacier archives, with the job state."""
     filename = peewee.CharField(index=True)
     job_id = peewee.CharField()
+    state = peewee.CharField(default=JOB_SUBMITTED)
+    updated = peewee.IntegerField(null=True)
 
     @classmethod
     def get_job_id(cls, filename):
@@ -228,7 +379,7 @@ class Jobs(SyncedModel):
 
     @classmethod
     def update_job_id(cls, filename, job_id):
-        """Update job_id for the given filename.
+        """Update job_id for the given filename, the job is submitted.
 
         :type filename: str
         :param filename: Filename
@@ -240,19 +391,557 @@ class Jobs(SyncedModel):
         """
         q = Jobs.select().where(Jobs.filename == filename)
         if q.count():
-            Jobs.update(job_id=job_id).where(Jobs.filename == filename).execute()
+            Jobs.update(job_id=job_id, state=JOB_SUBMITTED,
+                        updated=int(time.time())).where(Jobs.filename == filename).execute()
         else:
-            Jobs.create(filename=filename, job_id=job_id)
+            Jobs.create(filename=filename, job_id=job_id, state=JOB_SUBMITTED, updated=int(time.time()))
+
+    @classmethod
+    def set_state(cls, filename, state):
+        """Update the state of the job of filename (see JOB_* constants)."""
+        Jobs.update(state=state, updated=int(time.time())).where(Jobs.filename == filename,
+                                                                 Jobs.state != state).execute()
 
     class Meta:
         db_table = 'jobs'
 
 
-for table in [Backups, Jobs, Inventory, Config, History]:
+class Uploads(BaseModel):
+    """State of the multipart uploads (S3, Glacier and Swift) in progress, to resume them."""
+    backend_hash = peewee.CharField(index=True)
+    fingerprint = peewee.CharField(index=True)
+    backend = peewee.CharField()
+    keyname = peewee.CharField()
+    upload_id = peewee.CharField(index=True, unique=True)
+    part_size = peewee.IntegerField()
+    filename = peewee.CharField(null=True)
+    size = peewee.IntegerField(null=True)
+    created = peewee.IntegerField()
+
+    @classmethod
+    def get_pending(cls, backend_hash, fingerprint, keyname=None):
+        """Return the last upload of the source with the given fingerprint, or None.
+
+        :type fingerprint: str
+        :param fingerprint: Source fingerprint.
+
+        :type keyname: str
+        :param keyname: Only return an upload of this key.
+
+        """
+        q = Uploads.select().where(Uploads.backend_hash == backend_hash, Uploads.fingerprint == fingerprint)
+        if keyname is not None:
+            q = q.where(Uploads.keyname == keyname)
+        try:
+            return q.order_by(Uploads.created.desc()).get()
+        except Uploads.DoesNotExist:
+            return
+
+    def get_parts(self):
+        """Return a dict part number => checksum of the completed parts."""
+        q = UploadParts.select(UploadParts.part_num, UploadParts.checksum)
+        return dict(q.where(UploadParts.upload_id == self.upload_id).tuples())
+
+    def add_part(self, part_num, checksum):
+        UploadParts.create(upload_id=self.upload_id, part_num=part_num, checksum=checksum)
+
+    def done(self):
+        """Forget the upload (completed or aborted)."""
+        with database.transaction():
+            UploadParts.delete().where(UploadParts.upload_id == self.upload_id).execute()
+            self.delete_instance()
+
+    class Meta:
+        db_table = 'uploads'
+
+
+class UploadParts(BaseModel):
+    """Completed parts of the Uploads in progress."""
+    upload_id = peewee.CharField(index=True)
+    part_num = peewee.IntegerField()
+    checksum = peewee.CharField()
+
+    class Meta:
+        db_table = 'upload_parts'
+
+
+class Downloads(BaseModel):
+    """State of the Glacier job output downloads in progress, to resume them."""
+    job_id = peewee.CharField(index=True, unique=True)
+    keyname = peewee.CharField()
+    filename = peewee.CharField()
+    size = peewee.IntegerField()
+    created = peewee.IntegerField()
+
+    @classmethod
+    def start(cls, job_id, keyname, filename, size):
+        """Return the download of job_id, created if needed, the downloads
+        of previous jobs of keyname are forgotten.
+
+        :type filename: str
+        :param filename: Local file the job output is downloaded to.
+
+        """
+        try:
+            download = Downloads.get(Downloads.job_id == job_id)
+            if not os.path.isfile(download.filename):
+                DownloadParts.delete().where(DownloadParts.job_id == job_id).execute()
+            return download
+        except Downloads.DoesNotExist:
+            pass
+
+        for download in Downloads.select().where(Downloads.keyname == keyname):
+            download.done()
+        return Downloads.create(job_id=job_id, keyname=keyname, filename=filename, size=size,
+                                created=int(time.time()))
+
+    def get_parts(self):
+        """Return the set of (start, end) of the downloaded ranges."""
+        q = DownloadParts.select(DownloadParts.start, DownloadParts.end)
+        return set(q.where(DownloadParts.job_id == self.job_id).tuples())
+
+    def add_part(self, start, end):
+        DownloadParts.create(job_id=self.job_id, start=start, end=end)
+
+    def done(self):
+        """Forget the download and remove its file."""
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+        with database.transaction():
+            DownloadParts.delete().where(DownloadParts.job_id == self.job_id).execute()
+            self.delete_instance()
+
+    class Meta:
+        db_table = 'downloads'
+
+
+class DownloadParts(BaseModel):
+    """Downloaded ranges of the Downloads in progress."""
+    job_id = peewee.CharField(index=True)
+    start = peewee.IntegerField()
+    end = peewee.IntegerField()
+
+    class Meta:
+        db_table = 'download_parts'
+
+
+class Chunks(BaseModel):
+    """Deduplicated chunks stored on a backend, shared by hosts with the same backend_hash."""
+    backend_hash = peewee.CharField(index=True)
+    chunk = peewee.CharField()
+    size = peewee.IntegerField()
+    stored_size = peewee.IntegerField(null=True)
+
+    @classmethod
+    def known(cls, backend_hash):
+        """Return the set of chunk ids already stored for backend_hash."""
+        q = Chunks.select(Chunks.chunk).where(Chunks.backend_hash == backend_hash)
+        return set(row[0] for row in q.tuples())
+
+    @classmethod
+    def add_many(cls, backend_hash, chunks):
+        """Insert chunks in a single transaction.
+
+        :type chunks: list
+        :param chunks: List of (chunk, size, stored_size).
+        """
+        with database.transaction():
+            database.get_cursor().executemany(
+                "INSERT INTO chunks (backend_hash, chunk, size, stored_size) VALUES (?, ?, ?, ?)",
+                [(backend_hash, chunk, size, stored_size) for chunk, size, stored_size in chunks])
+
+    @classmethod
+    def unreferenced(cls, backend_hash):
+        """Return the ids of the chunks of backend_hash no manifest references."""
+        cursor = database.execute_sql("SELECT chunk FROM chunks c WHERE backend_hash = ? AND NOT EXISTS "
+                                      "(SELECT 1 FROM chunkrefs r WHERE r.chunk = c.chunk)",
+                                      (backend_hash,), require_commit=False)
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def delete_many(cls, backend_hash, chunks):
+        """Forget chunks (deleted from the backend) in a single transaction."""
+        with database.transaction():
+            database.get_cursor().executemany("DELETE FROM chunks WHERE backend_hash = ? AND chunk = ?",
+                                              [(backend_hash, chunk) for chunk in chunks])
+
+    class Meta:
+        db_table = 'chunks'
+        indexes = ((('backend_hash', 'chunk'), True),)
+
+
+class ChunkRefs(BaseModel):
+    """Ordered chunks list (manifest) of each deduplicated backup."""
+    stored_filename = peewee.CharField(index=True)
+    seq = peewee.IntegerField()
+    chunk = peewee.CharField(index=True)
+    size = peewee.IntegerField()
+
+    @classmethod
+    def get_manifest(cls, stored_filename):
+        q = ChunkRefs.select(ChunkRefs.chunk, ChunkRefs.size)
+        q = q.where(ChunkRefs.stored_filename == stored_filename).order_by(ChunkRefs.seq)
+        return [list(row) for row in q.tuples()]
+
+    @classmethod
+    def set_manifest(cls, stored_filename, manifest):
+        """Replace the manifest of stored_filename in a single transaction.
+
+        :type manifest: list
+        :param manifest: List of (chunk, size).
+        """
+        with database.transaction():
+            ChunkRefs.delete().where(ChunkRefs.stored_filename == stored_filename).execute()
+            database.get_cursor().executemany(
+                "INSERT INTO chunkrefs (stored_filename, seq, chunk, size) VALUES (?, ?, ?, ?)",
+                [(stored_filename, seq, chunk, size) for seq, (chunk, size) in enumerate(manifest)])
+
+    @classmethod
+    def clear_many(cls, stored_filenames):
+        """Delete the manifests of stored_filenames in a single transaction."""
+        with database.transaction():
+            database.get_cursor().executemany("DELETE FROM chunkrefs WHERE stored_filename = ?",
+                                              [(stored_filename,) for stored_filename in stored_filenames])
+
+    @classmethod
+    def missing_manifests(cls, backend_hash):
+        """Return the stored filenames of the deduplicated backups of backend_hash
+        not deleted and without a manifest in the local catalog (e.g. synced from another host)."""
+        cursor = database.execute_sql("SELECT stored_filename FROM backups b WHERE backend_hash = ? "
+                                      "AND is_deleted = 0 AND stored_filename LIKE '%.dedup' AND NOT EXISTS "
+                                      "(SELECT 1 FROM chunkrefs r WHERE r.stored_filename = b.stored_filename)",
+                                      (backend_hash,), require_commit=False)
+        return [row[0] for row in cursor.fetchall()]
+
+    class Meta:
+        db_table = 'chunkrefs'
+
+
+class FileManifest(BaseModel):
+    """State of each file of a directory at its last incremental backup."""
+    target = peewee.CharField()
+    path = peewee.TextField()
+    size = peewee.IntegerField()
+    mtime = peewee.FloatField()
+    inode = peewee.IntegerField()
+    hash = peewee.CharField(null=True)
+
+    @classmethod
+    def load(cls, target):
+        """Return a dict path => (size, mtime, inode, hash) for target."""
+        cursor = database.execute_sql("SELECT path, size, mtime, inode, hash FROM file_manifest WHERE target = ?",
+                                      (target,), require_commit=False)
+        return dict((row[0], row[1:]) for row in cursor)
+
+    @classmethod
+    def clear(cls, target):
+        FileManifest.delete().where(FileManifest.target == target).execute()
+
+    @classmethod
+    def update_many(cls, target, updates, deleted):
+        """Upsert updated entries and remove deleted ones in a single transaction.
+
+        :type updates: list
+        :param updates: List of (path, size, mtime, inode, hash).
+
+        :type deleted: list
+        :param deleted: List of deleted paths.
+        """
+        with database.transaction():
+            cursor = database.get_cursor()
+            cursor.executemany("INSERT OR REPLACE INTO file_manifest (target, path, size, mtime, inode, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                               [(target,) + tuple(update) for update in updates])
+            cursor.executemany("DELETE FROM file_manifest WHERE target = ? AND path = ?",
+                               [(target, path) for path in deleted])
+
+    class Meta:
+        db_table = 'file_manifest'
+        indexes = ((('target', 'path'), True),)
+
+
+class ArchiveMembers(BaseModel):
+    """Listing of each backup archive (path, size, mtime and mode of every member)."""
+    stored_filename = peewee.CharField(index=True)
+    path = peewee.TextField(index=True)
+    name = peewee.TextField(index=True)
+    size = peewee.IntegerField()
+    mtime = peewee.IntegerField()
+    mode = peewee.IntegerField()
+
+    @classmethod
+    def add_many(cls, stored_filename, members):
+        """Insert the members of stored_filename in a single transaction.
+
+        :type members: list
+        :param members: List of (path, size, mtime, mode).
+        """
+        with database.transaction():
+            database.get_cursor().executemany(
+                "INSERT INTO archive_members (stored_filename, path, name, size, mtime, mode) VALUES (?, ?, ?, ?, ?, ?)",
+                [(stored_filename, path, path.rstrip("/").split("/")[-1], size, mtime, mode)
+                 for path, size, mtime, mode in members])
+
+    @classmethod
+    def clear(cls, stored_filename):
+        ArchiveMembers.delete().where(ArchiveMembers.stored_filename == stored_filename).execute()
+
+    @classmethod
+    def list(cls, stored_filename):
+        """Return the members of stored_filename as a list of (path, size, mtime, mode), sorted by path."""
+        cursor = database.execute_sql("SELECT path, size, mtime, mode FROM archive_members "
+                                      "WHERE stored_filename = ? ORDER BY path",
+                                      (stored_filename,), require_commit=False)
+        return cursor.fetchall()
+
+    @classmethod
+    def find(cls, pattern, destination=None, backend_hashes=None):
+        """Search members of the backups not deleted.
+
+        :type pattern: str
+        :param pattern: Glob pattern (SQLite GLOB, * also matches /) matched against the full path
+            if it contains a /, else against the file name (indexed lookups unless it starts with a wildcard).
+
+        :type destination: list
+        :param destination: Only search backups of these backends.
+
+        :type backend_hashes: list
+        :param backend_hashes: Only search backups with these backend hashes.
+
+        :rtype: list
+        :return: A list of (stored_filename, backup_date, path, size, mtime, mode), newest backups first.
+        """
+        column = "m.path" if "/" in pattern else "m.name"
+        if "/" in pattern:
+            pattern = pattern.strip("/")
+        if isinstance(pattern, str):
+            pattern = pattern.decode("utf-8")
+        wheres = ["{0} GLOB ?".format(column), "b.is_deleted = 0"]
+        params = [pattern]
+
+        # SQLite only uses the index for GLOB with a literal, the literal prefix is matched as a range,
+        # CROSS JOIN makes SQLite look members up first, backups by their unique stored_filename
+        prefix = re.match(r"[^*?\[]*", pattern).group(0)
+        if prefix:
+            wheres.append("{0} >= ? AND {0} < ?".format(column))
+            params.extend([prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)])
+        for field, values in [("b.backend", destination), ("b.backend_hash", backend_hashes)]:
+            if values:
+                wheres.append("{0} IN ({1})".format(field, ", ".join("?" * len(values))))
+                params.extend(values)
+
+        cursor = database.execute_sql("SELECT b.stored_filename, b.backup_date, m.path, m.size, m.mtime, m.mode "
+                                      "FROM archive_members m CROSS JOIN backups b ON b.stored_filename = m.stored_filename "
+                                      "WHERE {0} ORDER BY b.backup_date DESC, m.path".format(" AND ".join(wheres)),
+                                      params, require_commit=False)
+        return cursor.fetchall()
+
+    class Meta:
+        db_table = 'archive_members'
+
+
+for table in [Backups, BackupTags, Jobs, Inventory, Config, History, Uploads, UploadParts, Downloads, DownloadParts,
+              Chunks, ChunkRefs, FileManifest, ArchiveMembers]:
     if not table.table_exists():
         table.create_table()
 
 
+def _add_missing_columns(table, columns):
+    """Add the columns created after table to an existing database.
+
+    :type columns: dict
+    :param columns: column name => SQL definition.
+
+    """
+    existing = set(row[1] for row in database.execute_sql("PRAGMA table_info({0})".format(table)).fetchall())
+    for name, definition in sorted(columns.items()):
+        if name not in existing:
+            database.execute_sql("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table, name, definition))
+
+
+_add_missing_columns("jobs", {"state": "VARCHAR(255) NOT NULL DEFAULT '{0}'".format(JOB_SUBMITTED),
+                              "updated": "INTEGER"})
+
+
+def _execute_atomic(statements):
+    """Execute the SQL statements in a single transaction, database.transaction()
+    doesn't cover schema changes (the sqlite3 module commits before them)."""
+    conn = database.get_conn()
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def _create_search_index():
+    """Create the backups_fts full-text index over the filename, stored_filename and tags of backups,
+    kept in sync by triggers.
+
+    It uses the SQLite FTS5 trigram tokenizer, so any substring of at least
+    3 characters can be looked up without scanning the backups table.
+
+    :rtype: bool
+    :return: False if SQLite doesn't support it, searches then scan the backups table.
+
+    """
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS backups_fts USING fts5(filename, stored_filename, tags, "
+        "content='backups', content_rowid='id', tokenize='trigram case_sensitive 1')",
+        "CREATE TRIGGER IF NOT EXISTS backups_fts_delete AFTER DELETE ON backups BEGIN "
+        "INSERT INTO backups_fts (backups_fts, rowid, filename, stored_filename, tags) "
+        "VALUES ('delete', old.id, old.filename, old.stored_filename, old.tags); END",
+        "CREATE TRIGGER IF NOT EXISTS backups_fts_update AFTER UPDATE OF filename, stored_filename, tags ON backups "
+        "BEGIN INSERT INTO backups_fts (backups_fts, rowid, filename, stored_filename, tags) "
+        "VALUES ('delete', old.id, old.filename, old.stored_filename, old.tags); "
+        "INSERT INTO backups_fts (rowid, filename, stored_filename, tags) "
+        "VALUES (new.id, new.filename, new.stored_filename, new.tags); END",
+        "CREATE TRIGGER IF NOT EXISTS backups_fts_insert AFTER INSERT ON backups BEGIN "
+        "INSERT INTO backups_fts (rowid, filename, stored_filename, tags) "
+        "VALUES (new.id, new.filename, new.stored_filename, new.tags); END",
+    ]
+    # The insert trigger is created last in the same transaction, its presence means the index is complete
+    if database.execute_sql("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name = 'backups_fts_insert'",
+                            require_commit=False).fetchone():
+        return True
+    # Index the existing backups before creating the insert trigger
+    statements.insert(-1, "INSERT INTO backups_fts (backups_fts) VALUES ('rebuild')")
+    try:
+        _execute_atomic(statements)
+    except Exception, exc:
+        log.info("Full-text search index not available ({0})".format(exc))
+        return False
+    return True
+
+
+SEARCH_INDEX = _create_search_index()
+
+
+def _indexed(text):
+    """Return True if text can be looked up in the full-text index (trigrams
+    need at least 3 characters, GLOB wildcards are not supported)."""
+    if not SEARCH_INDEX or not text:
+        return False
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return len(text) >= 3 and not re.search(r"[*?\[]", text)
+
+
+def _phrase(text):
+    """Quote text as a full-text query phrase."""
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return u'"{0}"'.format(text.replace('"', '""'))
+
+
+def _search_match(match):
+    """Return a where clause keeping the backups matching all the match full-text queries."""
+    return _sql("id IN (SELECT rowid FROM backups_fts WHERE backups_fts MATCH ?)", [u" AND ".join(match)])
+
+
+def _tags_select(row, tables=""):
+    """Return a SELECT of the (backup id, tag) of row, its space separated tags are split
+    as a JSON array (no tag if one can't be part of a JSON string)."""
+    tags = "replace(replace(replace({0}.tags, char(9), ' '), char(10), ' '), char(13), ' ')".format(row)
+    tags = """'["' || replace(replace(replace({0}, '\\', '\\\\'), '"', '\\"'), ' ', '","') || '"]'""".format(tags)
+    return ("SELECT {0}.id, value FROM {1}json_each(CASE WHEN json_valid({2}) THEN {2} ELSE '[]' END) "
+            "WHERE value != ''".format(row, tables, tags))
+
+
+def _create_tags_index():
+    """Create the triggers keeping the backup_tags table in sync with the tags of backups,
+    and fill it with the tags of the existing backups.
+
+    Tags are split with the SQLite JSON functions, so backups inserted
+    without the models (inventory recovery, sync) are indexed too.
+
+    :rtype: bool
+    :return: False if SQLite doesn't support it, tags are then matched against the backups table.
+
+    """
+    rows = _tags_select("new")
+    statements = [
+        "CREATE TRIGGER IF NOT EXISTS backup_tags_delete AFTER DELETE ON backups BEGIN "
+        "DELETE FROM backup_tags WHERE backup_id = old.id; END",
+        "CREATE TRIGGER IF NOT EXISTS backup_tags_update AFTER UPDATE OF tags ON backups "
+        "WHEN old.tags IS NOT new.tags BEGIN "
+        "DELETE FROM backup_tags WHERE backup_id = old.id; "
+        "INSERT OR IGNORE INTO backup_tags (backup_id, tag) {0}; END".format(rows),
+        "CREATE TRIGGER IF NOT EXISTS backup_tags_insert AFTER INSERT ON backups BEGIN "
+        "INSERT OR IGNORE INTO backup_tags (backup_id, tag) {0}; END".format(rows),
+    ]
+    # The insert trigger is created last in the same transaction, its presence means the table is complete
+    if database.execute_sql("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name = 'backup_tags_insert'",
+                            require_commit=False).fetchone():
+        return True
+    try:
+        database.execute_sql("SELECT json_valid('[]')", require_commit=False)
+    except Exception, exc:
+        log.info("Tags index not available ({0})".format(exc))
+        return False
+    # Index the tags of the existing backups before creating the insert trigger
+    statements[-1:-1] = ["DELETE FROM backup_tags",
+                         "INSERT OR IGNORE INTO backup_tags (backup_id, tag) " + _tags_select("backups", "backups, ")]
+    _execute_atomic(statements)
+    return True
+
+
+TAGS_INDEX = _create_tags_index()
+
+# Enough to tell a rare tag from a common one
+TAG_COUNT_LIMIT = 10000
+
+
+def _split_tags(tags):
+    """Return tags (a list or a space separated str) as a list of unicode tags."""
+    if not tags:
+        return []
+    if isinstance(tags, (str, unicode)):
+        tags = tags.split()
+    return [tag.decode("utf-8", "replace") if isinstance(tag, str) else tag for tag in tags]
+
+
+def _tags_match(tags, mode="all"):
+    """Return a where clause keeping the backups with all (mode all), at least one (any)
+    or none (none) of tags, looked up in the backup_tags table."""
+    if not TAGS_INDEX:
+        # Tags surrounded by spaces in the space separated tags
+        match = " {0} ".format("AND" if mode == "all" else "OR").join(
+            ["instr(' ' || tags || ' ', ?) > 0"] * len(tags))
+        return _sql("{0}({1})".format("NOT " if mode == "none" else "", match),
+                    [u" {0} ".format(tag) for tag in tags])
+    if mode == "all":
+        # Backups of the rarest tag, the other tags are checked with index lookups
+        tags = sorted(set(tags), key=_tag_count)
+        select = "SELECT t.backup_id FROM backup_tags t WHERE t.tag = ?" + "".join(
+            [" AND EXISTS (SELECT 1 FROM backup_tags WHERE tag = ? AND backup_id = t.backup_id)"] * (len(tags) - 1))
+    else:
+        select = "SELECT backup_id FROM backup_tags WHERE tag IN ({0})".format(", ".join("?" * len(tags)))
+    return _sql("id {0} ({1})".format("NOT IN" if mode == "none" else "IN", select), tags)
+
+
+def _tag_count(tag):
+    """Return the number of backups tagged with tag, up to TAG_COUNT_LIMIT."""
+    return database.execute_sql("SELECT COUNT(*) FROM (SELECT 1 FROM backup_tags WHERE tag = ? LIMIT ?)",
+                                (tag, TAG_COUNT_LIMIT), require_commit=False).fetchone()[0]
+
+
+def _sql(sql, params):
+    """Return a where clause of raw sql, its ? placeholders bound to params."""
+    parts = sql.split("?")
+    nodes = [peewee.SQL(parts[0])]
+    for param, part in zip(params, parts[1:]):
+        nodes.extend([peewee.Param(param), peewee.SQL(part)])
+    return peewee.Clause(*nodes)
+
+
 def backup_sqlite(filename):
     """Backup bakthat SQLite database to file."""
     con = sqlite3.connect(DATABASE)
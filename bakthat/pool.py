@@ -0,0 +1,110 @@
+# -*- encoding: utf-8 -*-
+import logging
+import threading
+from collections import deque
+from Queue import Queue
+
+log = logging.getLogger(__name__)
+
+
+class Task(object):
+    """Result of a function submitted to a :class:`WorkerPool`."""
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception, exc:
+            self.error = exc
+        finally:
+            # release the arguments (possibly large buffers) as soon as possible
+            self.args = self.kwargs = None
+            self._done.set()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self):
+        """Wait for the task and return its result, re-raise its exception if it failed."""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class WorkerPool(object):
+    """Fixed size pool of worker threads.
+
+    The number of pending tasks is bounded, ``submit`` blocks when the queue is full,
+    so a fast producer can't buffer an unbounded amount of data.
+
+    :type workers: int
+    :param workers: Number of worker threads.
+
+    :type max_pending: int
+    :param max_pending: Maximum number of queued tasks (workers * 2 by default).
+
+    """
+    def __init__(self, workers=4, max_pending=None):
+        self.workers = max(1, int(workers))
+        self.max_pending = max_pending or self.workers * 2
+        self._queue = Queue(self.max_pending)
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while 1:
+            task = self._queue.get()
+            if task is None:
+                break
+            task.run()
+
+    def submit(self, func, *args, **kwargs):
+        task = Task(func, args, kwargs)
+        self._queue.put(task)
+        return task
+
+    def imap(self, func, iterable):
+        """Ordered lazy map, at most max_pending items are in flight."""
+        pending = deque()
+        for item in iterable:
+            pending.append(self.submit(func, item))
+            while len(pending) >= self.max_pending or (pending and pending[0].ready()):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        """Stop the workers once the queued tasks are processed."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NullSlot(object):
+    """No-op context manager, used in place of an unbounded semaphore."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SLOT = NullSlot()
@@ -0,0 +1,130 @@
+# -*- encoding: utf-8 -*-
+import logging
+import time
+from collections import OrderedDict
+
+from bakthat.models import Jobs, JOB_DOWNLOADED
+
+log = logging.getLogger(__name__)
+
+DEFAULT_JOB_INTERVAL = 15 * 60
+DEFAULT_JOB_MAX_INTERVAL = 2 * 3600
+
+
+class JobScheduler(object):
+    """Submit Glacier retrieval jobs for several archives and poll them in a single loop.
+
+    Every check lists the vault jobs once, instead of fetching each job, the
+    check interval doubles while no job completes (up to max_interval) and
+    goes back to interval as soon as one does.
+
+    Job states are saved in the jobs table, so jobs submitted by a previous
+    run are reused.
+
+    :type storage_backend: GlacierBackend
+    :param storage_backend: Backend with the initiate_job, update_job_state and list_jobs methods.
+
+    :type interval: int
+    :param interval: Seconds between the first checks.
+
+    :type max_interval: int
+    :param max_interval: Maximum seconds between two checks.
+
+    """
+    def __init__(self, storage_backend, interval=DEFAULT_JOB_INTERVAL, max_interval=DEFAULT_JOB_MAX_INTERVAL):
+        self.storage_backend = storage_backend
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        # keyname => job id, in submission order
+        self.pending = OrderedDict()
+        self.failed = []
+        self._jobs = None
+
+    def submit(self, keynames):
+        """Initiate the retrieval jobs of keynames, unless a job of a previous run is still available."""
+        self._jobs = self.storage_backend.list_jobs()
+        for keyname in keynames:
+            if keyname in self.pending:
+                continue
+            job = self._jobs.get(Jobs.get_job_id(keyname))
+            if job is None or job.status_code == "Failed":
+                log.info("Initiating {0} retrieval job".format(keyname))
+                job = self.storage_backend.initiate_job(keyname)
+                if job is None:
+                    self.failed.append(keyname)
+                    continue
+                self._jobs[job.id] = job
+            self.pending[keyname] = job.id
+
+    def poll(self):
+        """Refresh the state of the pending jobs.
+
+        Expired jobs (their output is only available for 24 hours) are initiated again,
+        failed ones are dropped.
+
+        :rtype: list
+        :return: (keyname, job) of the completed jobs, in submission order.
+
+        """
+        jobs = self._jobs if self._jobs is not None else self.storage_backend.list_jobs()
+        self._jobs = None
+
+        completed = []
+        for keyname, job_id in self.pending.items():
+            job = jobs.get(job_id)
+            if job is None:
+                log.info("{0} retrieval job expired, initiating a new one".format(keyname))
+                self.storage_backend.update_job_state(keyname, None)
+                job = self.storage_backend.initiate_job(keyname)
+                if job is None:
+                    del self.pending[keyname]
+                    self.failed.append(keyname)
+                else:
+                    self.pending[keyname] = job.id
+                continue
+
+            self.storage_backend.update_job_state(keyname, job)
+            if job.status_code == "Failed":
+                log.error("{0} retrieval job failed: {1}".format(keyname, job.status_message))
+                del self.pending[keyname]
+                self.failed.append(keyname)
+            elif job.completed:
+                completed.append((keyname, job))
+        return completed
+
+    def run(self, callback):
+        """Poll the jobs until every one is handled.
+
+        callback is called with (keyname, job) for each completed job, in submission order,
+        the job is done once callback returns True, it's called again on the next check
+        otherwise. A failing callback fails the job.
+
+        :rtype: list
+        :return: The keynames of the failed jobs.
+
+        """
+        delay = self.interval
+        while self.pending:
+            progress = False
+            for keyname, job in self.poll():
+                try:
+                    done = callback(keyname, job)
+                except Exception, exc:
+                    log.exception("{0} restore failed".format(keyname))
+                    del self.pending[keyname]
+                    self.failed.append(keyname)
+                    continue
+                if done:
+                    Jobs.set_state(keyname, JOB_DOWNLOADED)
+                    del self.pending[keyname]
+                    progress = True
+
+            if not self.pending:
+                break
+            if progress:
+                delay = self.interval
+            log.info("{0} jobs pending, next check in {1}s".format(len(self.pending), delay))
+            time.sleep(delay)
+            delay = min(self.max_interval, delay * 2)
+
+        return self.failed
@@ -0,0 +1,300 @@
+# -*- encoding: utf-8 -*-
+import logging
+import threading
+from collections import deque
+
+from beefish import encrypt, get_cipher
+from Crypto.Cipher import Blowfish
+
+from bakthat.compression import write_tarball
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STREAM_MEMORY = 64 * 1024 * 1024
+MIN_BUFFER_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class PipeAborted(IOError):
+    """Raised on both ends of a pipe when one of the stages failed."""
+
+
+class Pipe(object):
+    """Bounded in-memory pipe connecting two pipeline stages.
+
+    ``write`` blocks while the buffer is full (backpressure),
+    ``read(n)`` blocks until n bytes are available or the writer is closed,
+    so a consumer always gets full reads until EOF, like a regular file.
+
+    :type maxsize: int
+    :param maxsize: Maximum number of bytes buffered in the pipe.
+
+    """
+    def __init__(self, maxsize=DEFAULT_STREAM_MEMORY):
+        self.maxsize = max(1, maxsize)
+        self.bytes_written = 0
+        self._chunks = deque()
+        self._size = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        while data:
+            with self._cond:
+                while self._size >= self.maxsize and self._error is None:
+                    self._cond.wait()
+                if self._error is not None:
+                    raise PipeAborted("Pipe aborted: {0}".format(self._error))
+                room = self.maxsize - self._size
+                chunk, data = data[:room], data[room:]
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+                self.bytes_written += len(chunk)
+                self._cond.notify_all()
+
+    def read(self, size=-1):
+        with self._cond:
+            while self._error is None and not self._closed and \
+                    (size < 0 or self._size < size):
+                self._cond.wait()
+            if self._error is not None:
+                raise PipeAborted("Pipe aborted: {0}".format(self._error))
+
+            if size < 0:
+                size = self._size
+            out = []
+            remaining = size
+            while remaining and self._chunks:
+                chunk = self._chunks.popleft()
+                if len(chunk) > remaining:
+                    chunk, rest = chunk[:remaining], chunk[remaining:]
+                    self._chunks.appendleft(rest)
+                out.append(chunk)
+                remaining -= len(chunk)
+            self._size -= size - remaining
+            self._cond.notify_all()
+            return "".join(out)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Signal EOF to the reader (called by the writing stage)."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self, error):
+        """Unblock both ends, pending and further calls will raise PipeAborted."""
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+
+class StreamPipeline(object):
+    """Chain of stages running in their own thread, connected by bounded pipes.
+
+    Each stage is a callable taking (src, dst) where src is the previous
+    stage pipe (None for the first stage) and dst the pipe to write to.
+
+    :type memory: int
+    :param memory: Memory budget shared between the pipes.
+
+    """
+    def __init__(self, memory=DEFAULT_STREAM_MEMORY):
+        self.memory = memory
+        self.stages = []
+        self.pipes = []
+        self.threads = []
+        self.error = None
+
+    def add_stage(self, func):
+        self.stages.append(func)
+        return self
+
+    def _run(self, func, src, dst):
+        try:
+            func(src, dst)
+        except Exception, exc:
+            log.exception(exc)
+            self.abort(exc)
+        finally:
+            dst.close()
+
+    def start(self):
+        """Start every stage and return the output of the last one as a file-like object."""
+        buffer_size = max(MIN_BUFFER_SIZE, self.memory // max(1, len(self.stages)))
+        src = None
+        for func in self.stages:
+            dst = Pipe(buffer_size)
+            thread = threading.Thread(target=self._run, args=(func, src, dst))
+            thread.daemon = True
+            self.pipes.append(dst)
+            self.threads.append(thread)
+            src = dst
+
+        for thread in self.threads:
+            thread.start()
+
+        return src
+
+    def abort(self, error):
+        if self.error is None:
+            self.error = error
+        for pipe in self.pipes:
+            pipe.abort(error)
+
+    def join(self):
+        """Wait for every stage and re-raise the first error, if any."""
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def bytes_written(self):
+        """Number of bytes produced by the last stage."""
+        return self.pipes[-1].bytes_written
+
+
+def copy_stream(src, dst, chunk_size=CHUNK_SIZE):
+    """Copy src file-like object to dst, chunk by chunk."""
+    while 1:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        dst.write(data)
+
+
+def tar_stage(filename, arcname, exclude=None, codec=None, workers=1, add=None, frame_size=None, result=None,
+              members=None):
+    """Stage writing a tarball of filename, compressed with codec if any.
+
+    The index of seekable tarballs (frame_size set) is stored in the result dict,
+    members is extended with the tarball listing (see :func:`write_tarball`).
+
+    """
+    def _tar(src, dst):
+        index = write_tarball(dst, filename, arcname, exclude, codec, workers, add,
+                              frame_size=frame_size, members=members)
+        if result is not None:
+            result["index"] = index
+    return _tar
+
+
+def file_stage(filename):
+    """Stage streaming the content of filename."""
+    def _file(src, dst):
+        with open(filename, "rb") as f:
+            copy_stream(f, dst)
+    return _file
+
+
+def encrypt_stage(password):
+    """Stage encrypting the previous stage output with beefish."""
+    def _encrypt(src, dst):
+        encrypt(src, dst, password)
+    return _encrypt
+
+
+def decrypt_stream(src, dst, password, chunk_size=CHUNK_SIZE, padding=True):
+    """Decrypt a beefish encrypted stream chunk by chunk.
+
+    Unlike :func:`beefish.decrypt`, dst doesn't need to be seekable:
+    the last block is held back until EOF to strip the padding.
+
+    Blowfish is used in CBC mode, so a range of blocks can be decrypted
+    on its own, src then starts with the previous encrypted block (used as IV)
+    and padding must be False unless the range ends the stream.
+
+    """
+    block_size = Blowfish.block_size
+    chunk_size -= chunk_size % block_size
+    iv = src.read(block_size)
+    cipher = get_cipher(password, iv)
+    last = ""
+    while 1:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        data = last + cipher.decrypt(data)
+        dst.write(data[:-block_size])
+        last = data[-block_size:]
+
+    if last and padding:
+        dst.write(last[:-((ord(last[-1]) % block_size) or block_size)])
+    elif last:
+        dst.write(last)
+
+
+def encrypted_range(start, end):
+    """Return the range of a beefish encrypted stream (end excluded) to fetch
+    to decrypt the bytes start-end, and the number of decrypted bytes to skip."""
+    block_size = Blowfish.block_size
+    aligned = start - start % block_size
+    # the IV takes the first block, each block is preceded by the one used as its IV
+    return aligned, block_size + end + (-end % block_size), start - aligned
+
+
+def download_stage(storage_backend, keyname, **kwargs):
+    """Stage streaming keyname with the backend download_stream."""
+    def _download(src, dst):
+        storage_backend.download_stream(keyname, dst, **kwargs)
+    return _download
+
+
+def decrypt_stage(password, padding=True):
+    """Stage decrypting the previous stage output."""
+    def _decrypt(src, dst):
+        decrypt_stream(src, dst, password, padding=padding)
+    return _decrypt
+
+
+def slice_stage(skip, size):
+    """Stage dropping the first skip bytes of the previous stage output
+    and forwarding the next size bytes."""
+    def _slice(src, dst):
+        if skip:
+            src.read(skip)
+        remaining = size
+        while remaining:
+            data = src.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            dst.write(data)
+            remaining -= len(data)
+        # drain the previous stage
+        while src.read(CHUNK_SIZE):
+            pass
+    return _slice
+
+
+def consume(pipeline, func, *args, **kwargs):
+    """Run the pipeline and call func with its output as first argument,
+    stop every stage if func fails.
+
+    :return: func result.
+
+    """
+    fileobj = pipeline.start()
+    try:
+        result = func(fileobj, *args, **kwargs)
+    except Exception, exc:
+        pipeline.abort(exc)
+        pipeline.join()
+        raise
+    pipeline.join()
+    return result
+
+
+def stream_upload(storage_backend, keyname, pipeline, **kwargs):
+    """Run the pipeline and upload its output with the backend upload_stream.
+
+    :rtype: int
+    :return: The number of bytes uploaded.
+
+    """
+    consume(pipeline, lambda fileobj: storage_backend.upload_stream(keyname, fileobj, **kwargs))
+    return pipeline.bytes_written
@@ -53,3 +53,27 @@ def _interval_string_to_seconds(interval_string):
         else:
             raise Exception(interval_exc)
     return seconds
+
+
+def _size_string_to_bytes(size_string):
+    """Convert size string like 64M, 512K, 1G to bytes.
+
+    :type size_string: str or int
+    :param size_string: Size string like 512K, 64M, 1G
+        (K => kilobytes, M => megabytes, G => gigabytes), or a number of bytes.
+
+    :rtype: int
+    :return: The conversion in bytes of size_string.
+
+    """
+    if isinstance(size_string, (int, long)):
+        return size_string
+
+    size_exc = "Bad size format for {0}".format(size_string)
+    size_dict = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    match = re.match("^(?P<num>[0-9]+)(?P<ext>[KMG]?)$", str(size_string).strip())
+    if not match:
+        raise Exception(size_exc)
+
+    return int(match.group("num")) * size_dict[match.group("ext")]
@@ -0,0 +1,77 @@
+# -*- encoding: utf-8 -*-
+"""Compare the legacy fnmatch exclude function with ExcludeMatcher
+on a tree with a huge node_modules directory.
+
+Usage: python benchmarks/bench_exclude.py [node_modules files]
+"""
+import fnmatch
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bakthat.exclude import ExcludeMatcher
+
+PATTERNS = ["*.pyc", "*.pyo", "*.log", "*.swp", "*~", ".DS_Store", "*.egg-info/",
+            "build/", "dist/", ".cache/", ".tox/", "coverage/", "tmp/", "node_modules/"]
+
+
+def legacy_exclude(patterns):
+    """The exclude function bakthat 0.6 built from an exclude file."""
+    def _exclude(filename):
+        for pattern in patterns:
+            if re.search(fnmatch.translate(pattern), filename):
+                return True
+        return False
+    return _exclude
+
+
+def make_tree(root, node_modules_files):
+    for i in range(200):
+        path = os.path.join(root, "src", "pkg{0}".format(i // 20))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for ext in ("py", "pyc"):
+            with open(os.path.join(path, "mod{0}.{1}".format(i, ext)), "w") as f:
+                f.write("x")
+    for i in range(node_modules_files):
+        path = os.path.join(root, "node_modules", "pkg{0}".format(i // 50), "lib")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, "file{0}.js".format(i)), "w") as f:
+            f.write("x")
+    with open(os.path.join(root, ".bakthatexclude"), "w") as f:
+        f.write("\n".join(PATTERNS))
+
+
+def bench(name, root, exclude):
+    start = time.time()
+    count = [0]
+
+    def _filter(tarinfo):
+        count[0] += 1
+        return tarinfo
+
+    with open(os.devnull, "wb") as out:
+        with closing(tarfile.open(fileobj=out, mode="w|")) as tar:
+            tar.add(root, arcname="root", exclude=exclude, filter=_filter)
+    print "{0:<16} {1:>8} members {2:>8.3f}s".format(name, count[0], time.time() - start)
+
+
+if __name__ == "__main__":
+    node_modules_files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    root = tempfile.mkdtemp()
+    try:
+        make_tree(root, node_modules_files)
+        bench("legacy fnmatch", root, legacy_exclude(PATTERNS))
+        # without the trailing slashes the legacy engine matches (and prunes) directories
+        bench("legacy, no /", root, legacy_exclude([p.rstrip("/") for p in PATTERNS]))
+        bench("ExcludeMatcher", root, ExcludeMatcher(root))
+    finally:
+        shutil.rmtree(root)
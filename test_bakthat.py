@@ -34,6 +34,1687 @@ class BakthatTestCase(unittest.TestCase):
         self.assertEqual(bakthat._interval_string_to_seconds("2D1h"), 86400 * 2 + 3600)
         self.assertEqual(bakthat._interval_string_to_seconds("3M"), 3*30*86400)
 
+        self.assertEqual(bakthat._size_string_to_bytes("64M"), 64 * 1024 * 1024)
+        self.assertEqual(bakthat._size_string_to_bytes(1024), 1024)
+
+    def test_stream_pipeline(self):
+        import tarfile
+        from StringIO import StringIO
+        from beefish import decrypt
+        from bakthat.stream import StreamPipeline, stream_upload, tar_stage, encrypt_stage
+        from bakthat.compression import get_codec
+
+        class MemoryBackend(object):
+            def upload_stream(self, keyname, fileobj, **kwargs):
+                self.out = StringIO()
+                while 1:
+                    data = fileobj.read(1000)
+                    if not data:
+                        break
+                    self.out.write(data)
+
+        backend = MemoryBackend()
+        pipeline = StreamPipeline(1024 * 1024)
+        pipeline.add_stage(tar_stage(self.test_file.name, self.test_filename, codec=get_codec("gzip")))
+        pipeline.add_stage(encrypt_stage(self.password))
+        size = stream_upload(backend, "test", pipeline)
+        self.assertEqual(size, len(backend.out.getvalue()))
+
+        backend.out.seek(0)
+        decrypted_out = tempfile.TemporaryFile()
+        decrypt(backend.out, decrypted_out, self.password)
+        decrypted_out.seek(0)
+        tar = tarfile.open(fileobj=decrypted_out, mode="r:gz")
+        restored = tar.extractfile(self.test_filename).read()
+        self.assertEqual(self.test_hash, hashlib.sha1(restored).hexdigest())
+
+    def test_codecs(self):
+        import tarfile
+        from bakthat.compression import get_codec, write_tarball, CODECS
+
+        self.assertEqual(get_codec(False), None)
+        self.assertEqual(get_codec(True).name, "gzip")
+        self.assertEqual(get_codec("zstd:19").level, 19)
+        with self.assertRaises(Exception):
+            get_codec("rar")
+
+        data = "Bakthat Test str" * 10000
+        gzip_data = get_codec("gzip").compress(data)
+        self.assertEqual(get_codec("gzip").decompress(gzip_data + gzip_data), data + data)
+
+        for name in CODECS:
+            codec = get_codec(name)
+            try:
+                compressed = codec.compress(data)
+            except Exception:
+                log.info("{0} not available, skipping".format(name))
+                continue
+            self.assertEqual(codec.decompress(compressed), data)
+
+            out = tempfile.TemporaryFile()
+            write_tarball(out, self.test_file.name, self.test_filename, codec=codec)
+            out.seek(0)
+            tar = tarfile.open(fileobj=codec.decompressor(out), mode="r|")
+            restored = tar.extractfile(tar.next()).read()
+            self.assertEqual(self.test_hash, hashlib.sha1(restored).hexdigest())
+
+    def test_incompressible_members(self):
+        import gzip
+        import shutil
+        from bakthat.compression import get_codec, write_tarball, extract_tarball, is_compressible
+
+        self.assertFalse(is_compressible("\xff\xd8\xff\xe0" + "a" * 100))
+        self.assertFalse(is_compressible(os.urandom(8192)))
+        self.assertTrue(is_compressible("Bakthat Test str" * 1000))
+
+        src = tempfile.mkdtemp()
+        dst = tempfile.mkdtemp()
+        random_data = os.urandom(512 * 1024)
+        text_data = "Bakthat Test str" * 32 * 1024
+        with open(os.path.join(src, "random.bin"), "wb") as f:
+            f.write(random_data)
+        with open(os.path.join(src, "text.txt"), "wb") as f:
+            f.write(text_data)
+
+        for spec, workers in [("gzip", 1), ("gzip", 2), ("zstd", 1)]:
+            codec = get_codec(spec)
+            out = tempfile.TemporaryFile()
+            try:
+                write_tarball(out, src, "src", codec=codec, workers=workers)
+            except Exception:
+                log.info("{0} not available, skipping".format(spec))
+                continue
+            # the random member is stored, the text member compressed
+            self.assertTrue(out.tell() < len(random_data) + len(text_data) / 10)
+
+            if spec == "gzip":
+                out.seek(0)
+                self.assertEqual(len(gzip.GzipFile(fileobj=out, mode="rb").read()) % 512, 0)
+
+            out.seek(0)
+            extract_tarball(codec.decompressor(out), dst)
+            self.assertEqual(open(os.path.join(dst, "src", "random.bin"), "rb").read(), random_data)
+            self.assertEqual(open(os.path.join(dst, "src", "text.txt"), "rb").read(), text_data)
+
+        shutil.rmtree(src)
+        shutil.rmtree(dst)
+
+    def test_s3_parallel_multipart(self):
+        import threading
+        import uuid
+        import mock
+        from StringIO import StringIO
+        from bakthat.backends import S3Backend, S3_MIN_PART_SIZE
+        from bakthat.models import Uploads
+
+        class FakeBucket(object):
+            def __init__(self, fail_parts=()):
+                self.lock = threading.Lock()
+                self.fail_parts = list(fail_parts)
+                self.attempts = {}
+                self.uploads = {}
+                self.objects = {}
+                self.cancelled = False
+
+            def initiate_multipart_upload(self, keyname, **kwargs):
+                upload = mock.Mock(id=str(uuid.uuid4()))
+                self.uploads[upload.id] = {}
+                return upload
+
+            def set_acl(self, acl, keyname):
+                pass
+
+        class FakeMultiPartUpload(object):
+            def __init__(self, bucket):
+                self.bucket = bucket
+
+            def upload_part_from_file(self, fp, part_num, md5=None):
+                data = fp.read()
+                with self.bucket.lock:
+                    self.bucket.attempts[part_num] = self.bucket.attempts.get(part_num, 0) + 1
+                    if part_num in self.bucket.fail_parts:
+                        self.bucket.fail_parts.remove(part_num)
+                        raise IOError("Connection reset")
+                self.bucket.uploads[self.id][part_num] = data
+                return mock.Mock(etag='"{0}"'.format(hashlib.md5(data).hexdigest()))
+
+            def __iter__(self):
+                for part_num, data in self.bucket.uploads[self.id].items():
+                    yield mock.Mock(part_number=part_num, etag='"{0}"'.format(hashlib.md5(data).hexdigest()))
+
+            def complete_upload(self):
+                parts = [data for part_num, data in sorted(self.bucket.uploads.pop(self.id).items())]
+                self.bucket.objects[self.key_name] = "".join(parts)
+                digests = "".join(hashlib.md5(part).digest() for part in parts)
+                return mock.Mock(etag='"{0}-{1}"'.format(hashlib.md5(digests).hexdigest(), len(parts)))
+
+            def cancel_upload(self):
+                self.bucket.cancelled = True
+
+        def get_backend(bucket, retries):
+            backend = S3Backend.__new__(S3Backend)
+            backend._get_bucket = lambda: bucket
+            backend.ensure_container = lambda container=None: None
+            backend.part_size = S3_MIN_PART_SIZE
+            backend.upload_workers = 3
+            backend.part_retries = retries
+            return backend
+
+        data = os.urandom(S3_MIN_PART_SIZE * 3 + 1234)
+        with mock.patch("bakthat.backends.MultiPartUpload", FakeMultiPartUpload):
+            # a failed part is retried
+            bucket = FakeBucket(fail_parts=[2])
+            with mock.patch("bakthat.backends.time.sleep"):
+                get_backend(bucket, 1).upload_stream("key", StringIO(data))
+            self.assertEqual(bucket.objects["key"], data)
+            self.assertEqual(bucket.attempts, {1: 1, 2: 2, 3: 1, 4: 1})
+            self.assertFalse(bucket.cancelled)
+
+            # a part failing more than part_retries times cancels the upload
+            bucket = FakeBucket(fail_parts=[2])
+            with self.assertRaises(IOError):
+                get_backend(bucket, 0).upload_stream("key", StringIO(data))
+            self.assertTrue(bucket.cancelled)
+            self.assertFalse("key" in bucket.objects)
+
+            # unless it can be resumed
+            backend_hash, fingerprint = str(uuid.uuid4()), str(uuid.uuid4())
+            bucket = FakeBucket(fail_parts=[3])
+            with self.assertRaises(IOError):
+                get_backend(bucket, 0).upload_stream("key", StringIO(data), backend_hash=backend_hash,
+                                                     fingerprint=fingerprint)
+            self.assertFalse(bucket.cancelled)
+            upload = Uploads.get_pending(backend_hash, fingerprint)
+            uploaded = sorted(upload.get_parts())
+            self.assertEqual(uploaded, sorted(bucket.uploads[upload.upload_id]))
+            self.assertEqual(uploaded[:2], [1, 2])
+
+            get_backend(bucket, 0).upload_stream("key", StringIO(data), backend_hash=backend_hash,
+                                                 fingerprint=fingerprint)
+            self.assertEqual(bucket.objects["key"], data)
+            # only the missing parts are uploaded again
+            for part_num in uploaded:
+                self.assertEqual(bucket.attempts[part_num], 1)
+            self.assertEqual(bucket.attempts[3], 2)
+            self.assertEqual(Uploads.get_pending(backend_hash, fingerprint), None)
+
+    def test_source_fingerprint(self):
+        import shutil
+        from bakthat import _source_fingerprint, _source_changed
+
+        src = tempfile.mkdtemp()
+        os.makedirs(os.path.join(src, "sub"))
+        with open(os.path.join(src, "sub", "a"), "w") as f:
+            f.write("a")
+        past = time.time() - 60
+        for path in [os.path.join(src, "sub", "a"), os.path.join(src, "sub"), src]:
+            os.utime(path, (past, past))
+
+        fingerprint = _source_fingerprint(src, "s3", None)
+        self.assertEqual(fingerprint, _source_fingerprint(src, "s3", None))
+        self.assertNotEqual(fingerprint, _source_fingerprint(src, "glacier", None))
+        self.assertFalse(_source_changed(src, None, past + 1))
+
+        # the key doesn't walk the tree, an interrupted upload is checked on resume
+        with open(os.path.join(src, "sub", "a"), "w") as f:
+            f.write("b")
+        os.utime(os.path.join(src, "sub", "a"), (past + 2, past + 2))
+        self.assertEqual(fingerprint, _source_fingerprint(src, "s3", None))
+        self.assertTrue(_source_changed(src, None, past + 1))
+        self.assertFalse(_source_changed(src, lambda path: path.endswith("sub"), past + 1))
+
+        shutil.rmtree(src)
+
+    def test_stream_part_size(self):
+        import math
+        import threading
+        from StringIO import StringIO
+        from bakthat.backends import _stream_part_size, upload_parts, S3_MAX_PARTS, S3_MIN_PART_SIZE, \
+            S3_MAX_PART_SIZE
+
+        MB = 1024 * 1024
+
+        def part_size(memory=None, expected_size=None):
+            return _stream_part_size(64 * MB, S3_MAX_PARTS, S3_MIN_PART_SIZE, S3_MAX_PART_SIZE,
+                                     memory, expected_size)
+
+        # parts are only lowered to fit in memory, the memory limits the parts in flight
+        self.assertEqual(part_size(32 * MB), (32 * MB, 1))
+        self.assertEqual(part_size(512 * MB), (64 * MB, 8))
+        self.assertEqual(part_size(), (64 * MB, None))
+        # 10000 parts hold the expected size
+        self.assertEqual(part_size(512 * MB, 1024 * 1024 * MB), (int(math.ceil(1024 * 1024 * MB / 10000.0)), 4))
+        self.assertRaises(Exception, part_size, 32 * MB, 1024 * 1024 * MB)
+        self.assertRaises(Exception, part_size, None, 100 * 1024 * 1024 * MB)
+
+        lock = threading.Lock()
+        in_memory = [0, 0]
+
+        class Source(object):
+            def __init__(self):
+                self.data = StringIO(os.urandom(10 * 1000))
+
+            def read(self, size):
+                data = self.data.read(size)
+                if data:
+                    with lock:
+                        in_memory[0] += 1
+                        in_memory[1] = max(in_memory)
+                return data
+
+        def upload_part(part_num, data, checksum):
+            time.sleep(0.01)
+            with lock:
+                in_memory[0] -= 1
+
+        parts = upload_parts(Source(), 1000, upload_part, lambda data: hashlib.md5(data).hexdigest(),
+                             workers=4, max_in_memory=2)
+        self.assertEqual(len(parts), 10)
+        self.assertEqual(in_memory[1], 2)
+        self.assertRaises(Exception, upload_parts, Source(), 1000, upload_part, len, max_parts=5)
+
+    def test_glacier_resumable_upload(self):
+        import threading
+        import uuid
+        import mock
+        from StringIO import StringIO
+        from boto.glacier.utils import chunk_hashes, tree_hash, bytes_to_hex
+        from bakthat.backends import GlacierBackend, GLACIER_MIN_PART_SIZE
+        from bakthat.models import Inventory, Uploads
+
+        class FakeLayer1(object):
+            def __init__(self, fail_parts=()):
+                self.lock = threading.Lock()
+                self.fail_parts = list(fail_parts)
+                self.attempts = {}
+                self.uploads = {}
+                self.archives = {}
+                self.part_sizes = []
+
+            def initiate_multipart_upload(self, vault_name, part_size, description):
+                self.part_sizes.append(part_size)
+                upload_id = str(uuid.uuid4())
+                self.uploads[upload_id] = {}
+                return {"UploadId": upload_id}
+
+            def upload_part(self, vault_name, upload_id, linear_hash, part_tree_hash, byte_range, data):
+                assert part_tree_hash == bytes_to_hex(tree_hash(chunk_hashes(data)))
+                assert linear_hash == hashlib.sha256(data).hexdigest()
+                with self.lock:
+                    self.attempts[byte_range[0]] = self.attempts.get(byte_range[0], 0) + 1
+                    if byte_range[0] in self.fail_parts:
+                        self.fail_parts.remove(byte_range[0])
+                        raise IOError("Connection reset")
+                    self.uploads[upload_id][byte_range] = data
+
+            def list_parts(self, vault_name, upload_id, marker=None):
+                return {"Parts": [{"RangeInBytes": "{0}-{1}".format(*byte_range),
+                                   "SHA256TreeHash": bytes_to_hex(tree_hash(chunk_hashes(data)))}
+                                  for byte_range, data in self.uploads[upload_id].items()], "Marker": None}
+
+            def complete_multipart_upload(self, vault_name, upload_id, archive_tree_hash, size):
+                data = "".join(data for byte_range, data in sorted(self.uploads.pop(upload_id).items()))
+                assert len(data) == size
+                assert archive_tree_hash == bytes_to_hex(tree_hash(chunk_hashes(data)))
+                archive_id = str(uuid.uuid4())
+                self.archives[archive_id] = data
+                return {"ArchiveId": archive_id}
+
+            def abort_multipart_upload(self, vault_name, upload_id):
+                del self.uploads[upload_id]
+
+        data = os.urandom(GLACIER_MIN_PART_SIZE * 3 + 1234)
+        backend = GlacierBackend.__new__(GlacierBackend)
+        backend.vault = mock.Mock()
+        backend.vault.layer1 = layer1 = FakeLayer1(fail_parts=[GLACIER_MIN_PART_SIZE * 2])
+        backend.ensure_container = lambda container=None: None
+        backend.part_size = GLACIER_MIN_PART_SIZE
+        backend.upload_workers = 3
+        backend.part_retries = 0
+        keyname = str(uuid.uuid4())
+        backend_hash, fingerprint = str(uuid.uuid4()), str(uuid.uuid4())
+
+        with self.assertRaises(IOError):
+            backend.upload_stream(keyname, StringIO(data), backend_hash=backend_hash, fingerprint=fingerprint)
+        upload = Uploads.get_pending(backend_hash, fingerprint)
+        self.assertEqual(sorted(upload.get_parts()), [start // GLACIER_MIN_PART_SIZE + 1
+                                                      for start, end in sorted(layer1.uploads[upload.upload_id])])
+
+        # the stream is read again, only the missing parts are uploaded
+        backend.upload_stream(keyname, StringIO(data), backend_hash=backend_hash, fingerprint=fingerprint)
+        self.assertEqual(layer1.archives[Inventory.get_archive_id(keyname)], data)
+        self.assertEqual(layer1.attempts[GLACIER_MIN_PART_SIZE * 2], 2)
+        self.assertEqual(sum(layer1.attempts.values()), 5)
+        self.assertEqual(Uploads.get_pending(backend_hash, fingerprint), None)
+
+        # parts fit in the memory budget, rounded down to a power of 2 megabytes
+        backend.part_size = GLACIER_MIN_PART_SIZE * 4
+        keyname = str(uuid.uuid4())
+        backend.upload_stream(keyname, StringIO(data), memory=GLACIER_MIN_PART_SIZE * 3)
+        self.assertEqual(layer1.part_sizes[-1], GLACIER_MIN_PART_SIZE * 2)
+        self.assertEqual(layer1.archives[Inventory.get_archive_id(keyname)], data)
+
+    def test_s3_paginated_ls(self):
+        import threading
+        import mock
+        from boto.resultset import ResultSet
+        from bakthat.backends import S3Backend
+
+        class FakeBucket(object):
+            """Bucket listing keys by pages like S3 (keys first, then common prefixes)."""
+            def __init__(self, names):
+                self.names = sorted(names)
+                self.requests = 0
+                self.lock = threading.Lock()
+
+            def get_all_keys(self, prefix="", delimiter="", marker="", max_keys=1000):
+                with self.lock:
+                    self.requests += 1
+                keys, prefixes = [], []
+                rs = ResultSet()
+                for name in self.names:
+                    if not name.startswith(prefix) or name <= marker:
+                        continue
+                    common_prefix = None
+                    if delimiter and delimiter in name[len(prefix):]:
+                        common_prefix = name[:name.index(delimiter, len(prefix)) + 1]
+                        if common_prefix <= marker or common_prefix in prefixes:
+                            continue
+                    if len(keys) + len(prefixes) == max_keys:
+                        rs.is_truncated = True
+                        if delimiter:
+                            rs.next_marker = max(keys + prefixes)
+                        break
+                    if common_prefix:
+                        prefixes.append(common_prefix)
+                    else:
+                        keys.append(name)
+                rs.extend(mock.Mock(name=name) for name in keys + prefixes)
+                for key, name in zip(rs, keys + prefixes):
+                    key.name = name
+                return rs
+
+        names = [u"0", u"a", u"a/1", u"a/2", u"ab", u"b/c/d", u"Zz", u"-x", u"~x", u"\xe9t\xe9"]
+        names += [u"logs/{0:04d}".format(i) for i in range(250)]
+        root = [u"-x", u"0", u"Zz", u"a", u"a/", u"ab", u"b/", u"logs/", u"~x", u"\xe9t\xe9"]
+        bucket = FakeBucket(names)
+        backend = S3Backend.__new__(S3Backend)
+        backend._get_bucket = lambda: bucket
+        backend.container = "bucket"
+        backend.part_retries = 0
+
+        # every page is fetched, lazily
+        listing = backend.ls(page_size=10)
+        self.assertEqual(bucket.requests, 0)
+        self.assertEqual(list(listing), sorted(names))
+        self.assertEqual(bucket.requests, 26)
+
+        self.assertEqual(list(backend.ls("a", page_size=2)), [u"a", u"a/1", u"a/2", u"ab"])
+        self.assertEqual(list(backend.ls(delimiter="/", page_size=2)), root)
+        self.assertEqual(list(backend.ls("logs/", delimiter="/", page_size=7))[-1], u"logs/0249")
+
+        # concurrent listing of the keyspace ranges
+        self.assertEqual(sorted(backend.ls(workers=4, page_size=10)), sorted(names))
+        self.assertEqual(sorted(backend.ls(delimiter="/", workers=3, shards="ab", page_size=1)), root)
+        self.assertEqual(sorted(backend.ls("logs/", workers=3, shards="01", page_size=7)), names[10:])
+
+        # an interrupted listing stops the workers
+        listing = backend.ls(workers=4, page_size=1)
+        next(listing)
+        listing.close()
+
+    def test_batched_deletes(self):
+        import json
+        import threading
+        import urllib
+        import uuid
+        import mock
+        from bakthat.backends import S3Backend, GlacierBackend, SwiftBackend
+        from bakthat.models import Backups, Inventory, ArchiveMembers
+
+        # S3 multi-object deletes, up to 1000 keys per request
+        keynames = ["key{0}".format(i) for i in range(2500)]
+        requests = []
+
+        def delete_keys(keys, quiet=False):
+            requests.append(len(keys))
+            errors = [mock.Mock(key=key, code="AccessDenied", message="Access Denied") for key in keys
+                      if key == "key1234"]
+            return mock.Mock(errors=errors)
+
+        backend = S3Backend.__new__(S3Backend)
+        backend._get_bucket = lambda: mock.Mock(delete_keys=delete_keys)
+        backend.part_retries = 0
+        self.assertEqual(backend.delete_many(keynames), {"key1234": "AccessDenied: Access Denied"})
+        self.assertEqual(requests, [1000, 1000, 500])
+
+        # concurrent Glacier deletes, inventory entries of the deleted archives are removed
+        prefix = uuid.uuid4().hex
+        for i in range(20):
+            Inventory.create(archive_id="{0}-archive{1}".format(prefix, i), filename="{0}-key{1}".format(prefix, i))
+        deleted = []
+        lock = threading.Lock()
+
+        def delete_archive(vault, archive_id):
+            if archive_id.endswith("archive7"):
+                raise IOError("Connection reset")
+            with lock:
+                deleted.append(archive_id)
+
+        backend = GlacierBackend.__new__(GlacierBackend)
+        backend.vault = mock.Mock()
+        backend.vault.layer1.delete_archive = delete_archive
+        backend.delete_workers = 4
+        backend.part_retries = 0
+        errors = backend.delete_many(["{0}-key{1}".format(prefix, i) for i in range(21)])
+        self.assertEqual(errors, {"{0}-key7".format(prefix): "Connection reset",
+                                  "{0}-key20".format(prefix): "No archive in the inventory"})
+        self.assertEqual(len(deleted), 19)
+        self.assertEqual([ivt.filename for ivt in Inventory.select().where(Inventory.archive_id % (prefix + "*"))],
+                         ["{0}-key7".format(prefix)])
+        Inventory.delete().where(Inventory.archive_id % (prefix + "*")).execute()
+
+        # Swift bulk deletes, then the segments of Static Large Objects
+        class FakeSwift(object):
+            def __init__(self, objects):
+                self.objects = objects
+                self.requests = []
+                self.listings = []
+
+            def get_capabilities(self):
+                return {"bulk_delete": {"max_deletes_per_request": 3}}
+
+            def post_account(self, headers, query_string=None, data=None):
+                paths = [urllib.unquote(path) for path in data.split("\n")]
+                self.requests.append(paths)
+                errors = [[path, "403 Forbidden"] for path in paths if path.endswith("denied")]
+                for path in paths:
+                    if [path, "403 Forbidden"] not in errors:
+                        self.objects.discard(path)
+                return {}, json.dumps({"Errors": errors, "Response Status": "400 Bad Request" if errors else "200 OK"})
+
+            def get_container(self, container, prefix="", full_listing=False):
+                self.listings.append(prefix)
+                return {}, [dict(name=path.split("/", 2)[2]) for path in sorted(self.objects)
+                            if path.startswith("/{0}/{1}".format(container, prefix.encode("utf-8")))]
+
+        objects = set([u"/bakthat/a", u"/bakthat/big", u"/bakthat/\xe9t\xe9", u"/bakthat/denied",
+                       u"/bakthat/big2", u"/bakthat/big/nested", u"/bakthat_segments/big/1234/00000001",
+                       u"/bakthat_segments/big/1234/00000002", u"/bakthat_segments/big2/5678/00000001",
+                       u"/bakthat_segments/big/nested/9012/00000001"])
+        con = FakeSwift(set(path.encode("utf-8") for path in objects))
+        backend = SwiftBackend.__new__(SwiftBackend)
+        backend._local = threading.local()
+        backend._connect = lambda: con
+        backend._bulk_delete = None
+        backend.container = "bakthat"
+        backend.segment_container = "bakthat_segments"
+        backend.part_retries = 0
+        # swiftclient is an optional dependency
+        with mock.patch.dict("sys.modules", swiftclient=mock.Mock(ClientException=type("ClientException",
+                                                                                        (Exception,), {}))):
+            errors = backend.delete_many([u"a", u"big", u"\xe9t\xe9", u"denied"])
+        self.assertEqual(errors, {u"denied": "403 Forbidden"})
+        self.assertEqual(sorted(con.objects), ["/bakthat/big/nested", "/bakthat/big2", "/bakthat/denied",
+                                               "/bakthat_segments/big/nested/9012/00000001",
+                                               "/bakthat_segments/big2/5678/00000001"])
+        self.assertEqual([len(paths) for paths in con.requests], [3, 1, 2])
+        # only the segments of the deleted objects are listed
+        self.assertEqual(sorted(con.listings), [u"a/", u"big/", u"\xe9t\xe9/"])
+
+        # the catalog is updated once every backend delete is done
+        backend_hash = str(uuid.uuid4())
+        backups = []
+        for name, metadata in [("a", {}), ("b", {"seekable": {"index": "b.index"}}), ("failed", {})]:
+            backups.append(Backups.create(backend="s3", backend_hash=backend_hash, backup_date=0, filename=name,
+                                          is_deleted=False, last_updated=0, metadata=metadata, size=1,
+                                          stored_filename=backend_hash + name, tags=""))
+            ArchiveMembers.add_many(backend_hash + name, [(name, 1, 0, 0o644)])
+        storage_backend = mock.Mock()
+        storage_backend.delete_many.side_effect = [{backend_hash + "failed": "Access Denied"}, {}]
+        deleted, errors = bakthat._delete_backups(storage_backend, backups)
+        self.assertEqual([backup.filename for backup in deleted], ["a", "b"])
+        self.assertEqual(errors, {backend_hash + "failed": "Access Denied"})
+        storage_backend.delete_many.assert_called_with(["b.index"])
+        self.assertEqual(dict((backup.filename, backup.is_deleted) for backup in
+                              Backups.select().where(Backups.backend_hash == backend_hash)),
+                         {"a": True, "b": True, "failed": False})
+        self.assertEqual(ArchiveMembers.list(backend_hash + "a"), [])
+        self.assertEqual(len(ArchiveMembers.list(backend_hash + "failed")), 1)
+        Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+        ArchiveMembers.clear(backend_hash + "failed")
+
+    def test_rotate_all(self):
+        import uuid
+        import mock
+        import yaml
+        from bakthat.models import Backups
+
+        bucket = str(uuid.uuid4())
+        config_file = tempfile.NamedTemporaryFile(suffix=".yml")
+        conf = {"default": dict(access_key="key", secret_key="secret", s3_bucket=bucket, glacier_vault=bucket,
+                                region_name="us-east-1", rotation=dict(days=7, weeks=0, months=0, first_week_day=5))}
+        yaml.dump(conf, config_file)
+        config_file.flush()
+        backend_hash = hashlib.sha512("key" + bucket).hexdigest()
+
+        now = int(time.time())
+        for filename, days in [("a", 10), ("b", 3)]:
+            for day in range(days):
+                Backups.create(backend="s3", backend_hash=backend_hash, backup_date=now - day * 86400 - 60,
+                               filename=filename, is_deleted=False, last_updated=now, metadata={}, size=1,
+                               stored_filename="{0}-{1}-{2}".format(bucket, filename, day), tags="")
+        # backups of the same date are deleted together
+        Backups.create(backend="s3", backend_hash=backend_hash, backup_date=now - 9 * 86400 - 60,
+                       filename="a", is_deleted=False, last_updated=now, metadata={}, size=1,
+                       stored_filename="{0}-a-9-bis".format(bucket), tags="")
+        expected = ["{0}-a-9".format(bucket), "{0}-a-9-bis".format(bucket), "{0}-a-8".format(bucket),
+                    "{0}-a-7".format(bucket)]
+
+        storage_backend = mock.Mock()
+        storage_backend.delete_many.return_value = {"{0}-a-8".format(bucket): "Access Denied"}
+        try:
+            with mock.patch("bakthat._get_store_backend", return_value=(storage_backend, "s3", {})):
+                plan = bakthat.rotate_all(config=config_file.name, dry_run=True)
+                self.assertEqual(plan, dict(keep=10, delete=expected, errors={}))
+                self.assertFalse(storage_backend.delete_many.called)
+                # an already loaded config works too
+                self.assertEqual(bakthat.rotate_all(config=conf, dry_run=True), plan)
+
+                plan = bakthat.rotate_all(config=config_file.name)
+                self.assertEqual(sorted(storage_backend.delete_many.call_args[0][0]), sorted(expected))
+                self.assertEqual(plan["errors"], {"{0}-a-8".format(bucket): "Access Denied"})
+
+                self.assertEqual(bakthat.rotate_all(config=config_file.name, dry_run=True)["delete"],
+                                 ["{0}-a-8".format(bucket)])
+        finally:
+            Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+
+    def test_search_index(self):
+        import uuid
+        import yaml
+        from bakthat.models import Backups, SEARCH_INDEX, _execute_atomic, database
+
+        bucket = str(uuid.uuid4())
+        config_file = tempfile.NamedTemporaryFile(suffix=".yml")
+        yaml.dump({"default": dict(access_key="key", s3_bucket=bucket, glacier_vault=bucket)}, config_file)
+        config_file.flush()
+        backend_hash = hashlib.sha512("key" + bucket).hexdigest()
+
+        for i, (filename, tags) in enumerate([("mysql-prod", "daily db"), ("mysql-dev", "weekly db"),
+                                              ("www", "daily"), (u"\xe9t\xe9-photos", "")]):
+            Backups.create(backend="s3", backend_hash=backend_hash, backup_date=i, filename=filename,
+                           is_deleted=False, last_updated=i, metadata={}, size=1, tags=tags,
+                           stored_filename=u"{0}.{1}.{2}.tgz".format(filename, bucket, i))
+
+        def search(query, **kwargs):
+            return sorted(backup.filename for backup in Backups.search(query, "s3", profile="default",
+                                                                       config=config_file.name, **kwargs))
+
+        try:
+            self.assertTrue(SEARCH_INDEX)
+            self.assertEqual(search("sql"), ["mysql-dev", "mysql-prod"])
+            self.assertEqual(search("SQL"), [])
+            self.assertEqual(search("ww"), ["www"])
+            self.assertEqual(search("mysql*prod"), ["mysql-prod"])
+            self.assertEqual(search(u"\xe9t\xe9"), [u"\xe9t\xe9-photos"])
+            self.assertEqual(search(bucket[:8]), ["mysql-dev", "mysql-prod", "www", u"\xe9t\xe9-photos"])
+            self.assertEqual(search("", tags=["daily"]), ["mysql-prod", "www"])
+            self.assertEqual(search("mysql", tags="daily db"), ["mysql-prod"])
+            self.assertEqual(Backups.match_filename("mysql-d", "s3", config=config_file.name).filename, "mysql-dev")
+            self.assertEqual(Backups.match_filename("sql-d", "s3", config=config_file.name), None)
+
+            # the index is kept up to date
+            backup = Backups.get(Backups.filename == "www", Backups.backend_hash == backend_hash)
+            backup.tags = "weekly"
+            backup.save()
+            self.assertEqual(search("", tags=["weekly"]), ["mysql-dev", "www"])
+            backup.delete_instance()
+            self.assertEqual(search("www"), [])
+        finally:
+            Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+        self.assertEqual(search(bucket[:8]), [])
+
+        # the index is created in a single transaction, schema changes included
+        with self.assertRaises(Exception):
+            _execute_atomic(["CREATE TABLE test_atomic (a)", "CREATE TRIGGER test_atomic_insert AFTER INSERT ON "
+                             "test_atomic BEGIN SELECT 1; END", "INSERT INTO test_atomic_missing VALUES (1)"])
+        self.assertEqual(database.execute_sql("SELECT name FROM sqlite_master WHERE name LIKE 'test_atomic%'",
+                                              require_commit=False).fetchall(), [])
+
+    def test_tags_index(self):
+        import uuid
+        import yaml
+        from bakthat.models import Backups, BackupTags, TAGS_INDEX, database
+
+        bucket = str(uuid.uuid4())
+        config_file = tempfile.NamedTemporaryFile(suffix=".yml")
+        yaml.dump({"default": dict(access_key="key", s3_bucket=bucket, glacier_vault=bucket)}, config_file)
+        config_file.flush()
+        backend_hash = hashlib.sha512("key" + bucket).hexdigest()
+
+        for i, (filename, tags) in enumerate([("mysql", "daily db"), ("pgsql", "weekly  db"), ("www", "daily"),
+                                              ("logs", "daily-old"), ("photos", "")]):
+            Backups.create(backend="s3", backend_hash=backend_hash, backup_date=i, filename=filename,
+                           is_deleted=False, last_updated=i, metadata={}, size=1, tags=tags,
+                           stored_filename="{0}.{1}.{2}.tgz".format(filename, bucket, i))
+        # inserted without the models
+        database.execute_sql("INSERT INTO backups (backend, backend_hash, backup_date, filename, is_deleted, "
+                             "last_updated, metadata, size, stored_filename, tags) "
+                             "VALUES ('s3', ?, 5, 'mongo', 0, 5, '{}', 1, ?, 'db\tmonthly')",
+                             (backend_hash, "mongo.{0}.5.tgz".format(bucket)))
+
+        def search(**kwargs):
+            return sorted(backup.filename for backup in Backups.search("", "s3", profile="default",
+                                                                       config=config_file.name, **kwargs))
+
+        try:
+            self.assertTrue(TAGS_INDEX)
+            # exact matches, daily-old isn't daily
+            self.assertEqual(search(tags="daily"), ["mysql", "www"])
+            self.assertEqual(search(tags="db daily"), ["mysql"])
+            self.assertEqual(search(tags=["db", "monthly"]), ["mongo"])
+            self.assertEqual(search(tags="dai"), [])
+            self.assertEqual(search(tags_any="weekly daily-old"), ["logs", "pgsql"])
+            self.assertEqual(search(tags_none="db"), ["logs", "photos", "www"])
+            self.assertEqual(search(tags="db", tags_none="daily weekly"), ["mongo"])
+
+            # the table is kept up to date
+            backup = Backups.get(Backups.filename == "www", Backups.backend_hash == backend_hash)
+            backup.tags = "weekly"
+            backup.save()
+            self.assertEqual(search(tags="weekly"), ["pgsql", "www"])
+            self.assertEqual(search(tags="daily"), ["mysql"])
+            backup_id = backup.id
+            backup.delete_instance()
+            self.assertEqual(BackupTags.select().where(BackupTags.backup_id == backup_id).count(), 0)
+        finally:
+            Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+        self.assertEqual(search(tags_any="daily weekly db monthly"), [])
+
+    def test_backend_registry(self):
+        import uuid
+        import mock
+        from bakthat.backends import get_backend, clear_backends, S3Backend, GlacierBackend
+
+        conf = dict(access_key="key", secret_key="secret", s3_bucket="bucket-" + str(uuid.uuid4()),
+                    glacier_vault="vault", region_name="us-east-1")
+        try:
+            # creating a backend doesn't make any request
+            with mock.patch("boto.connection.AWSAuthConnection.make_request") as make_request:
+                backend = get_backend(S3Backend, conf)
+                self.assertTrue(get_backend(S3Backend, dict(conf)) is backend)
+                self.assertFalse(get_backend(S3Backend, dict(conf, s3_bucket="other")) is backend)
+                self.assertFalse(get_backend(GlacierBackend, conf) is backend)
+                self.assertFalse(make_request.called)
+
+            # the bucket is checked once per process
+            with mock.patch.object(S3Backend, "_create_container") as create_container:
+                backend.ensure_container()
+                get_backend(S3Backend, conf).ensure_container()
+                create_container.assert_called_once_with(conf["s3_bucket"])
+        finally:
+            clear_backends()
+        self.assertFalse(get_backend(S3Backend, conf) is backend)
+        clear_backends()
+
+    def test_swift_segmented_upload(self):
+        import json
+        import threading
+        import uuid
+        import mock
+        from StringIO import StringIO
+        from bakthat.backends import SwiftBackend, MIN_RANGE_SIZE
+        from bakthat.models import Uploads
+
+        class FakeSwift(object):
+            """Swift connection with Static Large Object support, shared by every thread."""
+            def __init__(self, fail_segments=()):
+                self.lock = threading.Lock()
+                self.fail_segments = list(fail_segments)
+                self.attempts = {}
+                self.containers = {}
+                self.manifests = {}
+
+            def put_container(self, container):
+                self.containers.setdefault(container, {})
+
+            def put_object(self, container, name, contents, etag=None, query_string=None):
+                if query_string == "multipart-manifest=put":
+                    segments = json.loads(contents)
+                    data = ""
+                    for segment in segments:
+                        segment_container, segment_name = segment["path"][1:].split("/", 1)
+                        segment_data = self.containers[segment_container][segment_name]
+                        assert hashlib.md5(segment_data).hexdigest() == segment["etag"]
+                        assert len(segment_data) == segment["size_bytes"]
+                        data += segment_data
+                    self.manifests[name] = segments
+                    self.containers[container][name] = data
+                    return
+                assert etag is None or etag == hashlib.md5(contents).hexdigest()
+                with self.lock:
+                    part_num = int(name.rsplit("/", 1)[-1]) if container.endswith("_segments") else 0
+                    self.attempts[part_num] = self.attempts.get(part_num, 0) + 1
+                    if part_num in self.fail_segments:
+                        self.fail_segments.remove(part_num)
+                        raise IOError("Connection reset")
+                    self.containers[container][name] = contents
+
+            def get_container(self, container, prefix="", full_listing=False):
+                return {}, [dict(name=name, hash=hashlib.md5(data).hexdigest())
+                            for name, data in sorted(self.containers[container].items()) if name.startswith(prefix)]
+
+            def head_object(self, container, name):
+                headers = {"content-length": str(len(self.containers[container][name]))}
+                if name in self.manifests:
+                    headers["x-static-large-object"] = "True"
+                return headers
+
+            def delete_object(self, container, name, query_string=None):
+                del self.containers[container][name]
+                if query_string == "multipart-manifest=delete":
+                    for segment in self.manifests.pop(name):
+                        segment_container, segment_name = segment["path"][1:].split("/", 1)
+                        del self.containers[segment_container][segment_name]
+
+        def get_backend(con, retries):
+            backend = SwiftBackend.__new__(SwiftBackend)
+            backend._local = threading.local()
+            backend._connect = lambda: con
+            backend.ensure_container = lambda container=None: con.put_container(container or "bakthat")
+            backend.container = "bakthat"
+            backend.segment_container = "bakthat_segments"
+            backend.segment_size = MIN_RANGE_SIZE
+            backend.upload_workers = 3
+            backend.part_retries = retries
+            con.put_container("bakthat")
+            return backend
+
+        data = os.urandom(MIN_RANGE_SIZE * 3 + 1234)
+
+        # small objects are uploaded with a single PUT
+        con = FakeSwift()
+        get_backend(con, 0).upload_stream("small", StringIO(data[:1000]))
+        self.assertEqual(con.containers["bakthat"]["small"], data[:1000])
+        self.assertFalse(con.manifests)
+
+        # a segment failing more than swift_part_retries times removes the uploaded segments
+        con = FakeSwift(fail_segments=[2])
+        with self.assertRaises(IOError):
+            get_backend(con, 0).upload_stream("key", StringIO(data))
+        self.assertEqual(con.containers["bakthat_segments"], {})
+
+        # unless the upload can be resumed
+        backend_hash, fingerprint = str(uuid.uuid4()), str(uuid.uuid4())
+        con = FakeSwift(fail_segments=[3])
+        backend = get_backend(con, 0)
+        with self.assertRaises(IOError):
+            backend.upload_stream("key", StringIO(data), backend_hash=backend_hash, fingerprint=fingerprint)
+        self.assertEqual(sorted(Uploads.get_pending(backend_hash, fingerprint).get_parts()),
+                         sorted(backend._list_segments("key", Uploads.get_pending(backend_hash, fingerprint).upload_id)))
+
+        backend.upload_stream("key", StringIO(data), backend_hash=backend_hash, fingerprint=fingerprint)
+        self.assertEqual(con.containers["bakthat"]["key"], data)
+        self.assertEqual(len(con.manifests["key"]), 4)
+        # only the missing segments are uploaded again
+        self.assertEqual(con.attempts, {1: 1, 2: 1, 3: 2, 4: 1})
+        self.assertEqual(Uploads.get_pending(backend_hash, fingerprint), None)
+
+        # deleting the manifest deletes the segments
+        backend.delete("key")
+        self.assertEqual(con.containers["bakthat_segments"], {})
+
+        # gc_uploads deletes the segments and the temporary archive of interrupted uploads
+        backend.conf = {"access_key": "key"}
+        backend_hash = hashlib.sha512("key" + "bakthat").hexdigest()
+        con.fail_segments = [3]
+        tmp_archive = tempfile.NamedTemporaryFile(delete=False)
+        tmp_archive.close()
+        with self.assertRaises(IOError):
+            backend.upload_stream("gc", StringIO(data), backend_hash=backend_hash, fingerprint=fingerprint,
+                                  local_filename=tmp_archive.name)
+        self.assertTrue(con.containers["bakthat_segments"])
+        upload_id = Uploads.get_pending(backend_hash, fingerprint).upload_id
+        self.assertEqual([upload["upload_id"] for upload in backend.list_uploads()], [upload_id])
+        with mock.patch("bakthat._get_store_backend", return_value=(backend, "swift", {})):
+            self.assertEqual(bakthat.gc_uploads("1W", destination="swift"), [])
+            Uploads.update(created=int(time.time()) - 8 * 86400).where(Uploads.upload_id == upload_id).execute()
+            self.assertEqual([upload["upload_id"] for upload in bakthat.gc_uploads("1W", destination="swift")],
+                             [upload_id])
+        self.assertEqual(con.containers["bakthat_segments"], {})
+        self.assertFalse(os.path.exists(tmp_archive.name))
+        self.assertEqual(Uploads.get_pending(backend_hash, fingerprint), None)
+        self.assertEqual(backend.list_uploads(), [])
+
+        # the segment size is raised to keep under the segments limit
+        con = FakeSwift()
+        get_backend(con, 0).upload_stream("big", StringIO(data), expected_size=MIN_RANGE_SIZE * 2000)
+        self.assertEqual(con.containers["bakthat"]["big"], data)
+        self.assertEqual([segment["size_bytes"] for segment in con.manifests["big"]],
+                         [MIN_RANGE_SIZE * 2, len(data) - MIN_RANGE_SIZE * 2])
+
+        # and fails before uploading anything if it doesn't fit in the memory budget
+        con = FakeSwift()
+        with self.assertRaises(Exception):
+            get_backend(con, 0).upload_stream("big", StringIO(data), expected_size=MIN_RANGE_SIZE * 2000,
+                                              memory=MIN_RANGE_SIZE)
+        self.assertEqual(con.attempts, {})
+
+    def test_parallel_ranged_download(self):
+        import threading
+        import mock
+        from StringIO import StringIO
+        from bakthat.backends import S3Backend, download_ranges, MIN_RANGE_SIZE
+
+        data = os.urandom(MIN_RANGE_SIZE * 5 + 1234)
+        lock = threading.Lock()
+        attempts = {}
+
+        def fetch_range(start, end):
+            with lock:
+                attempts[start] = attempts.get(start, 0) + 1
+                first = attempts[start] == 1
+            if first and start == MIN_RANGE_SIZE:
+                raise IOError("Connection reset")
+            if first and start == MIN_RANGE_SIZE * 3:
+                # truncated response
+                return data[start:end]
+            return data[start:end + 1]
+
+        with mock.patch("bakthat.backends.time.sleep"):
+            # written in place after the existing content of a regular file
+            out = tempfile.TemporaryFile()
+            out.write("header")
+            download_ranges(len(data), fetch_range, out, MIN_RANGE_SIZE, workers=3, retries=1)
+            self.assertEqual(out.tell(), len(data) + 6)
+            out.seek(0)
+            self.assertEqual(out.read(), "header" + data)
+            self.assertEqual(attempts[MIN_RANGE_SIZE], 2)
+            self.assertEqual(attempts[MIN_RANGE_SIZE * 3], 2)
+            self.assertEqual(attempts[0], 1)
+
+            # written in order to a stream
+            attempts.clear()
+            out = StringIO()
+            download_ranges(len(data), fetch_range, out, MIN_RANGE_SIZE, workers=3, retries=1)
+            self.assertEqual(out.getvalue(), data)
+
+            # a range failing more than retries times fails the download
+            attempts.clear()
+            with self.assertRaises(IOError):
+                download_ranges(len(data), fetch_range, StringIO(), MIN_RANGE_SIZE, workers=3, retries=0)
+
+        # S3 objects bigger than a range are downloaded with ranged GETs
+        backend = S3Backend.__new__(S3Backend)
+        bucket = mock.Mock()
+        backend._get_bucket = lambda: bucket
+        backend.download_part_size = MIN_RANGE_SIZE
+        backend.download_workers = 3
+        backend.part_retries = 0
+        backend.download_range = lambda keyname, start, end, etag=None: data[start:end + 1]
+        backend.bucket.get_key.return_value = mock.Mock(size=len(data), etag='"etag"')
+        out = StringIO()
+        backend.download_stream("key", out)
+        self.assertEqual(out.getvalue(), data)
+
+        # smaller ones with a single GET
+        key = mock.Mock(size=100, etag='"etag"')
+        backend.bucket.get_key.return_value = key
+        backend.download_stream("key", out)
+        key.get_contents_to_file.assert_called_once_with(out)
+
+    def test_glacier_resumable_download(self):
+        import shutil
+        import threading
+        import uuid
+        import mock
+        from StringIO import StringIO
+        from boto.glacier.utils import chunk_hashes, tree_hash, bytes_to_hex
+        from bakthat.backends import GlacierBackend, MIN_RANGE_SIZE
+        from bakthat.models import Downloads
+
+        data = os.urandom(MIN_RANGE_SIZE * 4 + 1234)
+        lock = threading.Lock()
+        requests = []
+        failures = {MIN_RANGE_SIZE: 1, MIN_RANGE_SIZE * 3: 1}
+
+        class Output(dict):
+            def __init__(self, body, checksum):
+                dict.__init__(self, TreeHash=checksum)
+                self.body = body
+
+            def read(self):
+                return self.body
+
+        def get_output(byte_range):
+            start, end = byte_range
+            body = data[start:end + 1]
+            checksum = bytes_to_hex(tree_hash(chunk_hashes(body)))
+            with lock:
+                requests.append(start)
+                if failures.get(start):
+                    failures[start] -= 1
+                    # corrupted range
+                    body = body[:-1] + chr((ord(body[-1]) + 1) % 256)
+            return Output(body, checksum)
+
+        job = mock.Mock(id=uuid.uuid4().hex, archive_size=len(data), completed=True)
+        job.get_output.side_effect = get_output
+
+        backend = GlacierBackend.__new__(GlacierBackend)
+        backend.download_dir = tempfile.mkdtemp()
+        backend.download_part_size = MIN_RANGE_SIZE
+        backend.download_workers = 2
+        backend.part_retries = 0
+
+        try:
+            with mock.patch("bakthat.backends.time.sleep"):
+                # corrupted ranges fail the download, the other ones are kept
+                with self.assertRaises(Exception):
+                    backend.download_stream("key", StringIO(), job=job)
+                download = Downloads.get(Downloads.job_id == job.id)
+                self.assertEqual(download.get_parts(), set([(0, MIN_RANGE_SIZE - 1),
+                                                            (MIN_RANGE_SIZE * 2, MIN_RANGE_SIZE * 3 - 1),
+                                                            (MIN_RANGE_SIZE * 4, len(data) - 1)]))
+
+                # only the missing ranges are downloaded on resume
+                del requests[:]
+                out = StringIO()
+                backend.download_stream("key", out, job=job)
+                self.assertEqual(out.getvalue(), data)
+                self.assertEqual(sorted(requests), [MIN_RANGE_SIZE, MIN_RANGE_SIZE * 3])
+                self.assertFalse(os.listdir(backend.download_dir))
+                self.assertEqual(Downloads.select().where(Downloads.job_id == job.id).count(), 0)
+        finally:
+            shutil.rmtree(backend.download_dir)
+
+    def test_glacier_job_scheduler(self):
+        import uuid
+        import mock
+        from bakthat.models import Jobs, JOB_COMPLETED, JOB_DOWNLOADED, JOB_EXPIRED, JOB_IN_PROGRESS
+        from bakthat.scheduler import JobScheduler
+
+        keys = ["{0}-{1}".format(name, uuid.uuid4().hex) for name in ["a", "b", "c"]]
+
+        class FakeJob(object):
+            def __init__(self):
+                self.id = uuid.uuid4().hex
+                self.status_code = "InProgress"
+                self.completed = False
+
+            def complete(self):
+                self.status_code = "Succeeded"
+                self.completed = True
+
+        class FakeGlacierBackend(object):
+            def __init__(self):
+                self.jobs = {}
+                self.initiated = []
+                self.listings = 0
+
+            def initiate_job(self, keyname):
+                job = FakeJob()
+                self.jobs[job.id] = job
+                self.initiated.append(keyname)
+                Jobs.update_job_id(keyname, job.id)
+                return job
+
+            def update_job_state(self, keyname, job):
+                state = JOB_EXPIRED if job is None else JOB_COMPLETED if job.completed else JOB_IN_PROGRESS
+                Jobs.set_state(keyname, state)
+                return state
+
+            def list_jobs(self):
+                self.listings += 1
+                return dict(self.jobs)
+
+            def job(self, keyname):
+                return self.jobs.get(Jobs.get_job_id(keyname))
+
+        backend = FakeGlacierBackend()
+        # a job submitted by a previous run is reused
+        backend.initiate_job(keys[0])
+        del backend.initiated[:]
+
+        scheduler = JobScheduler(backend, interval=10, max_interval=30)
+        scheduler.submit(keys)
+        self.assertEqual(backend.initiated, keys[1:])
+
+        restored = []
+        delays = []
+
+        def callback(keyname, job):
+            # keys are restored in order
+            if restored != keys[:keys.index(keyname)]:
+                return False
+            restored.append(keyname)
+            return True
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == 3:
+                backend.job(keys[1]).complete()
+            elif len(delays) == 4:
+                # the job output expired before being downloaded
+                del backend.jobs[Jobs.get_job_id(keys[0])]
+            elif len(delays) == 5:
+                backend.job(keys[0]).complete()
+                backend.job(keys[2]).complete()
+
+        with mock.patch("bakthat.scheduler.time.sleep", side_effect=sleep):
+            self.assertEqual(scheduler.run(callback), [])
+
+        self.assertEqual(restored, keys)
+        self.assertEqual(backend.initiated, keys[1:] + keys[:1])
+        # the interval doubles while no job completes
+        self.assertEqual(delays, [10, 20, 30, 30, 30])
+        self.assertEqual(backend.listings, len(delays) + 1)
+        for key in keys:
+            self.assertEqual(Jobs.get(Jobs.filename == key).state, JOB_DOWNLOADED)
+
+    def test_inventory_reconciliation(self):
+        import json
+        import uuid
+        from StringIO import StringIO
+        from bakthat.inventory import InventoryReader, reconcile_inventory
+        from bakthat.models import Backups, Inventory
+
+        backend_hash = uuid.uuid4().hex
+        prefix = uuid.uuid4().hex
+        now = int(time.time())
+
+        def stored(name, date="20130101000000", ext=".tgz.enc"):
+            return "{0}-{1}.{2}{3}".format(prefix, name, date, ext)
+
+        for name, is_deleted, backup_date in [("live", False, now - 3600), ("deleted", True, now - 3600),
+                                              ("missing", False, now - 3600), ("recent", False, now + 3600)]:
+            Backups.create(backend="glacier", backend_hash=backend_hash, backup_date=backup_date,
+                           filename=name, is_deleted=is_deleted, last_updated=now, metadata={},
+                           size=1, stored_filename=stored(name), tags="")
+
+        archives = [("live-old", stored("live"), "2013-01-01T00:00:00Z"),
+                    ("live", stored("live"), "2013-01-02T00:00:00Z"),
+                    ("live-index", stored("live") + ".index", "2013-01-02T00:00:00Z"),
+                    ("deleted", stored("deleted"), "2013-01-01T00:00:00Z"),
+                    ("lost", stored("lost", ext=".tar.zst"), "2013-01-03T00:00:00Z"),
+                    ("raw", stored("raw", ext=""), "2013-01-03T00:00:00Z"),
+                    ("foreign", "", "2013-01-03T00:00:00Z")]
+        inventory = {"VaultARN": "arn:aws:glacier:us-east-1:012345678901:vaults/test",
+                     "InventoryDate": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
+                     "ArchiveList": [{"ArchiveId": prefix + archive_id, "ArchiveDescription": description,
+                                      "CreationDate": date, "Size": 42, "SHA256TreeHash": "0" * 64}
+                                     for archive_id, description, date in archives]}
+
+        reader = InventoryReader(StringIO(json.dumps(inventory, indent=2)), chunk_size=50)
+        report = reconcile_inventory(reader, backend_hash, batch_size=3)
+
+        self.assertEqual(reader.header["VaultARN"], inventory["VaultARN"])
+        self.assertEqual(report["archives"], len(archives))
+        self.assertEqual(report["recovered"], 2)
+        self.assertEqual([archive_id[len(prefix):] for archive_id, description in report["orphaned"]
+                          if archive_id.startswith(prefix)], ["live-old", "deleted", "foreign"])
+        self.assertIn(stored("missing"), report["missing"])
+        self.assertNotIn(stored("recent"), report["missing"])
+
+        self.assertEqual(Inventory.get_archive_id(stored("live")), prefix + "live")
+        lost = Backups.get(Backups.stored_filename == stored("lost", ext=".tar.zst"))
+        self.assertEqual((lost.filename, lost.get_compression(), lost.is_encrypted()),
+                         (prefix + "-lost", "zstd", False))
+        raw = Backups.get(Backups.stored_filename == stored("raw", ext=""))
+        self.assertEqual(raw.get_compression(), None)
+
+        Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+        Inventory.delete().where(Inventory.archive_id << [prefix + archive[0] for archive in archives]).execute()
+
+        # truncated inventories are rejected
+        with self.assertRaises(Exception):
+            list(InventoryReader(StringIO(json.dumps(inventory)[:-100])))
+
+    def test_backup_many(self):
+        import shutil
+        import uuid
+        import mock
+
+        class MemoryBackend(object):
+            thread_safe = True
+            container_key = "s3_bucket"
+
+            def __init__(self):
+                self.conf = {"access_key": "unittest", "s3_bucket": str(uuid.uuid4()), "compress": "gzip"}
+                self.objects = {}
+
+            def upload(self, keyname, filename, **kwargs):
+                with open(filename, "rb") as f:
+                    self.objects[keyname] = f.read()
+
+        root = tempfile.mkdtemp()
+        for name in ["a1", "a2", "b"]:
+            os.mkdir(os.path.join(root, name))
+            with open(os.path.join(root, name, "file"), "w") as f:
+                f.write(name)
+
+        backend = MemoryBackend()
+        with mock.patch("bakthat._get_store_backend", return_value=(backend, "s3", backend.conf)):
+            results = bakthat.backup_many([os.path.join(root, "a*"), os.path.join(root, "b"),
+                                           os.path.join(root, "missing")],
+                                          prompt="no", cpu_workers=2, network_workers=2)
+
+        self.assertEqual([os.path.basename(r["filename"]) for r in results], ["a1", "a2", "b", "missing"])
+        self.assertEqual([r["error"] is None for r in results], [True, True, True, False])
+        self.assertEqual(sorted(backend.objects), sorted(r["stored_filename"] for r in results[:3]))
+
+        shutil.rmtree(root)
+
+    def test_streaming_restore(self):
+        import shutil
+        from StringIO import StringIO
+        from beefish import encrypt
+        from bakthat.compression import get_codec, write_tarball
+        from bakthat.models import Backups
+        from bakthat.stream import decrypt_stream
+
+        # Every padding length is stripped like beefish.decrypt
+        for size in [0, 1, 7, 8, 9, 64 * 1024 - 1, 64 * 1024, 100000]:
+            data = os.urandom(size)
+            encrypted = StringIO()
+            encrypt(StringIO(data), encrypted, self.password)
+            encrypted.seek(0)
+            out = StringIO()
+            decrypt_stream(encrypted, out, self.password, chunk_size=1000)
+            self.assertEqual(out.getvalue(), data)
+
+        class MemoryBackend(object):
+            def __init__(self):
+                self.objects = {}
+
+            def download_stream(self, keyname, dst, **kwargs):
+                data = self.objects[keyname]
+                for i in range(0, len(data), 1000):
+                    dst.write(data[i:i + 1000])
+
+        tarball = StringIO()
+        write_tarball(tarball, self.test_file.name, self.test_filename, codec=get_codec("gzip"))
+        tarball.seek(0)
+        encrypted = StringIO()
+        encrypt(tarball, encrypted, self.password)
+
+        backend = MemoryBackend()
+        backend.objects["test.tgz.enc"] = encrypted.getvalue()
+        backend.objects["test.txt"] = "Bakthat Test File"
+        backup = Backups(stored_filename="test.tgz.enc", filename=self.test_filename,
+                         metadata={"compression": "gzip", "is_enc": True})
+        raw_backup = Backups(stored_filename="test.txt", filename="test.txt", metadata={"compression": None})
+
+        cwd = os.getcwd()
+        root = tempfile.mkdtemp()
+        os.chdir(root)
+        try:
+            self.assertTrue(bakthat._restore_backup(backend, backup, self.password, {"stream_memory": "64K"}))
+            self.assertTrue(bakthat._restore_backup(backend, raw_backup, None, {}))
+            with open(self.test_filename) as f:
+                self.assertEqual(self.test_hash, hashlib.sha1(f.read()).hexdigest())
+            with open("test.txt") as f:
+                self.assertEqual(f.read(), "Bakthat Test File")
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+
+    def test_streaming_restore_memory(self):
+        import shutil
+        import subprocess
+        import sys
+
+        # Restore a 2GB archive generated on the fly, peak RSS must stay
+        # far below the archive size.
+        script = """
+import gzip, resource, tarfile
+import bakthat
+from bakthat.models import Backups
+
+SIZE = 2 * 1024 ** 3
+
+class Zeros(object):
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, n):
+        n = min(n, self.remaining)
+        self.remaining -= n
+        return "\\0" * n
+
+class GeneratingBackend(object):
+    def download_stream(self, keyname, dst, **kwargs):
+        gz = gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=1)
+        tar = tarfile.open(fileobj=gz, mode="w|")
+        info = tarfile.TarInfo("big")
+        info.size = SIZE
+        tar.addfile(info, Zeros(SIZE))
+        tar.close()
+        gz.close()
+
+backup = Backups(stored_filename="big.tgz", filename="big", metadata={"compression": "gzip"})
+bakthat._restore_backup(GeneratingBackend(), backup, None, {"stream_memory": "16M"})
+import os
+assert os.path.getsize("big") == SIZE
+print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+        root = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(bakthat.__file__))))
+            output = subprocess.check_output([sys.executable, "-c", script], cwd=root, env=env)
+            max_rss = int(output.strip().splitlines()[-1]) * 1024
+            self.assertTrue(max_rss < 150 * 1024 * 1024, "peak RSS {0}".format(max_rss))
+        finally:
+            shutil.rmtree(root)
+
+    def test_seekable_archive(self):
+        import shutil
+        import uuid
+        import mock
+        from StringIO import StringIO
+        from bakthat.compression import get_codec, write_tarball, extract_tarball, index_lookup
+
+        root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(root, "data", "etc"))
+        big = os.urandom(300 * 1024)
+        with open(os.path.join(root, "data", "big"), "wb") as f:
+            f.write(big)
+        for i in range(20):
+            with open(os.path.join(root, "data", "etc", "file{0}".format(i)), "w") as f:
+                f.write("config {0}\n".format(i) * 1000)
+
+        # The seekable tarball is still a standard tarball
+        for spec in ["gzip", "zstd"]:
+            codec = get_codec(spec)
+            out = StringIO()
+            index = write_tarball(out, os.path.join(root, "data"), "data", codec=codec, frame_size=64 * 1024)
+            self.assertEqual(index["size"], len(out.getvalue()))
+            self.assertTrue(len(index["frames"]) > 5)
+            self.assertEqual(len(index["members"]), 23)
+            out.seek(0)
+            dest = tempfile.mkdtemp()
+            extract_tarball(codec.decompressor(out), dest)
+            with open(os.path.join(dest, "data", "big"), "rb") as f:
+                self.assertEqual(f.read(), big)
+            shutil.rmtree(dest)
+
+        names, start, end, skip = index_lookup(index, "data/etc/")
+        self.assertEqual(len(names), 21)
+        self.assertEqual(index_lookup(index, "data/missing"), None)
+
+        class MemoryBackend(object):
+            container_key = "s3_bucket"
+
+            def __init__(self):
+                self.conf = {"access_key": "unittest", "s3_bucket": str(uuid.uuid4()),
+                             "compress": "gzip", "seekable_frame_size": "64K"}
+                self.objects = {}
+                self.downloaded = 0
+
+            def upload(self, keyname, filename, **kwargs):
+                with open(filename, "rb") as f:
+                    self.objects[keyname] = f.read()
+
+            def upload_stream(self, keyname, fileobj, **kwargs):
+                self.objects[keyname] = fileobj.read()
+
+            def download_stream(self, keyname, dst, byte_range=None, **kwargs):
+                start, end = byte_range or (0, len(self.objects[keyname]))
+                self.downloaded += end - start
+                dst.write(self.objects[keyname][start:end])
+
+            def delete(self, keyname):
+                del self.objects[keyname]
+
+        cwd = os.getcwd()
+        for password in ["", self.password]:
+            backend = MemoryBackend()
+            with mock.patch("bakthat._get_store_backend", return_value=(backend, "s3", backend.conf)):
+                backup = bakthat.backup(os.path.join(root, "data"), prompt="no", password=password, seekable=True)
+            self.assertEqual(sorted(backend.objects), sorted([backup.stored_filename, backup.stored_filename + ".index"]))
+            self.assertEqual(backup.metadata["seekable"]["members"], 23)
+
+            dest = tempfile.mkdtemp()
+            os.chdir(dest)
+            try:
+                restored = bakthat._restore_member(backend, backup, "data/etc/file3", password, {})
+                self.assertEqual(restored, ["data/etc/file3"])
+                self.assertEqual(os.listdir(os.path.join(dest, "data", "etc")), ["file3"])
+                with open(os.path.join(dest, "data", "etc", "file3")) as f:
+                    self.assertEqual(f.read(), "config 3\n" * 1000)
+                # only the frames holding the member are downloaded
+                self.assertTrue(backend.downloaded < len(backend.objects[backup.stored_filename]) // 2)
+                self.assertEqual(bakthat._restore_member(backend, backup, "data/missing", password, {}), None)
+
+                # members spanning several frames
+                bakthat._restore_member(backend, backup, "data/big", password, {})
+                with open(os.path.join(dest, "data", "big"), "rb") as f:
+                    self.assertEqual(f.read(), big)
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(dest)
+
+            bakthat._delete_backup(backend, backup)
+            self.assertEqual(backend.objects, {})
+
+        shutil.rmtree(root)
+
+    def test_archive_catalog(self):
+        import shutil
+        import stat
+        import uuid
+        import mock
+        from bakthat.models import ArchiveMembers
+
+        class MemoryBackend(object):
+            container_key = "s3_bucket"
+
+            def __init__(self):
+                self.conf = {"access_key": "unittest", "s3_bucket": str(uuid.uuid4()), "compress": "gzip"}
+                self.objects = {}
+
+            def upload(self, keyname, filename, **kwargs):
+                with open(filename, "rb") as f:
+                    self.objects[keyname] = f.read()
+
+            def delete(self, keyname):
+                del self.objects[keyname]
+
+        root = tempfile.mkdtemp()
+        name = str(uuid.uuid4())
+        os.makedirs(os.path.join(root, name, "nginx", "sites"))
+        for path in ["nginx/nginx.conf", "nginx/sites/default.conf", "README"]:
+            with open(os.path.join(root, name, path), "w") as f:
+                f.write(path)
+
+        backend = MemoryBackend()
+        with mock.patch("bakthat._get_store_backend", return_value=(backend, "s3", backend.conf)):
+            backup = bakthat.backup(os.path.join(root, name), prompt="no", password="")
+
+        members = ArchiveMembers.list(backup.stored_filename)
+        self.assertEqual([member[0] for member in members],
+                         [name, name + "/README", name + "/nginx", name + "/nginx/nginx.conf",
+                          name + "/nginx/sites", name + "/nginx/sites/default.conf"])
+        self.assertTrue(stat.S_ISDIR(members[0][3]))
+        self.assertEqual(members[1][1], len("README"))
+
+        self.assertEqual([r[2] for r in ArchiveMembers.find("nginx.conf", backend_hashes=[backup.backend_hash])],
+                         [name + "/nginx/nginx.conf"])
+        self.assertEqual(len(ArchiveMembers.find("*.conf", ["s3"], [backup.backend_hash])), 2)
+        self.assertEqual([r[2] for r in ArchiveMembers.find("/" + name + "/nginx/sites/*")],
+                         [name + "/nginx/sites/default.conf"])
+        self.assertEqual(ArchiveMembers.find("*.conf", ["glacier"], [backup.backend_hash]), [])
+
+        bakthat._delete_backup(backend, backup)
+        self.assertEqual(ArchiveMembers.find("*.conf", backend_hashes=[backup.backend_hash]), [])
+        shutil.rmtree(root)
+
+    def test_dedup_store(self):
+        import uuid
+        from StringIO import StringIO
+        from bakthat.compression import get_codec
+        from bakthat.dedup import DedupStore
+
+        class MemoryBackend(object):
+            def __init__(self):
+                self.objects = {}
+
+            def upload_string(self, keyname, data):
+                self.objects[keyname] = data
+
+            def download_string(self, keyname):
+                return self.objects[keyname]
+
+            def exists(self, keyname):
+                return keyname in self.objects
+
+        backend = MemoryBackend()
+        store = DedupStore(backend, str(uuid.uuid4()), get_codec("gzip"), self.password,
+                           chunk_size=64 * 1024)
+        data = os.urandom(1024 * 1024)
+
+        result = store.backup(StringIO(data))
+        self.assertEqual(result["size"], len(data))
+        self.assertEqual(result["chunks"], result["new_chunks"])
+        store.save_manifest("test.dedup", result["manifest"])
+
+        # Inserting data at the beginning only changes the first chunks
+        result = store.backup(StringIO("Bakthat" + data))
+        self.assertTrue(result["new_chunks"] <= 2)
+
+        out = StringIO()
+        store.restore("test.dedup", out)
+        self.assertEqual(out.getvalue(), data)
+
+    def test_dedup_codecs_and_gc(self):
+        import uuid
+        from StringIO import StringIO
+        from bakthat.compression import get_codec
+        from bakthat.dedup import DedupStore, CHUNKS_PREFIX
+        from bakthat.models import Backups, Chunks
+
+        class MemoryBackend(object):
+            def __init__(self):
+                self.objects = {}
+
+            def upload_string(self, keyname, data):
+                self.objects[keyname] = data
+
+            def download_string(self, keyname):
+                return self.objects[keyname]
+
+            def exists(self, keyname):
+                return keyname in self.objects
+
+            def delete(self, keyname):
+                del self.objects[keyname]
+
+        backend = MemoryBackend()
+        backend_hash = str(uuid.uuid4())
+        data = os.urandom(512 * 1024)
+
+        backups = []
+        for i, (compress, content) in enumerate([("gzip", data), ("zstd", data + os.urandom(1024)), ("gzip", data)]):
+            store = DedupStore(backend, backend_hash, get_codec(compress), self.password, chunk_size=64 * 1024)
+            stored_filename = "{0}.{1}.dedup".format(backend_hash, i)
+            result = store.backup(StringIO(content))
+            store.save_manifest(stored_filename, result["manifest"])
+            backups.append(Backups.create(backend="s3", backend_hash=backend_hash, backup_date=i, filename="dedup",
+                                          is_deleted=False, last_updated=i, size=result["uploaded"], tags="",
+                                          stored_filename=stored_filename, metadata=dict(dedup=result)))
+            # chunks are only shared by backups using the same codec
+            self.assertEqual(result["new_chunks"], 0 if i == 2 else result["chunks"])
+
+        # each chunk is decompressed with its own codec
+        out = StringIO()
+        DedupStore(backend, backend_hash, None, self.password).restore(backups[1].stored_filename, out)
+        self.assertTrue(out.getvalue().startswith(data))
+
+        try:
+            # the gzip chunks are still referenced by the third backup
+            bakthat._delete_backups(backend, backups[:2])
+            chunks = [keyname for keyname in backend.objects if keyname.startswith(CHUNKS_PREFIX)]
+            self.assertTrue(chunks)
+            self.assertTrue(all(keyname.startswith(CHUNKS_PREFIX + "gzip/") for keyname in chunks))
+            self.assertEqual(len(Chunks.known(backend_hash)), len(chunks))
+
+            bakthat._delete_backups(backend, backups[2:])
+            self.assertEqual(backend.objects, {})
+            self.assertEqual(Chunks.known(backend_hash), set())
+        finally:
+            Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+
+    def test_exclude(self):
+        import shutil
+        from bakthat.exclude import ExcludeMatcher
+        from bakthat.incremental import scan_tree
+
+        root = tempfile.mkdtemp()
+        for path in ["a.pyc", "keep.pyc", "src/b.py", "src/c.log", "src/build/x",
+                     "build", "node_modules/lib/index.js", "docs/tmp/y"]:
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(path)
+
+        with open(os.path.join(root, ".bakthatexclude"), "w") as f:
+            f.write("# comment\n*.pyc\n!keep.pyc\nbuild/\nnode_modules\n/tmp\ndocs/**/y\n")
+        with open(os.path.join(root, "src", ".gitignore"), "w") as f:
+            f.write("*.log\n")
+
+        matcher = ExcludeMatcher(root)
+        paths = sorted(path for path, size, mtime, inode in scan_tree(root, matcher))
+        self.assertEqual(paths, [".bakthatexclude", "build", "docs", "docs/tmp",
+                                 "keep.pyc", "src", "src/.gitignore", "src/b.py"])
+
+        self.assertTrue(matcher(os.path.join(root, "node_modules")))
+        self.assertFalse(matcher(root))
+
+        shutil.rmtree(root)
+
+    def test_incremental(self):
+        import uuid
+        import shutil
+        from bakthat.compression import write_tarball, extract_tarball, get_codec
+        from bakthat.incremental import IncrementalBackup, apply_deletions
+        from bakthat.models import Backups
+
+        backend_hash = str(uuid.uuid4())
+        src = tempfile.mkdtemp()
+        dst = tempfile.mkdtemp()
+        os.mkdir(os.path.join(src, "b"))
+        for name in ["a", "b/c", "b/d"]:
+            with open(os.path.join(src, name), "w") as f:
+                f.write(name)
+
+        archives = []
+        for i in range(2):
+            inc = IncrementalBackup(src, backend_hash).scan()
+            self.assertEqual(inc.level, i)
+            out = tempfile.TemporaryFile()
+            write_tarball(out, src, "src", codec=get_codec("gzip"), add=inc.add_to_tar)
+            archives.append(out)
+
+            stored_filename = "bakthat-unittest-{0}".format(uuid.uuid4())
+            Backups.create(filename="src", stored_filename=stored_filename, backup_date=0, last_updated=0,
+                           backend="s3", backend_hash=backend_hash, is_deleted=False, tags="",
+                           size=0, metadata={})
+            inc.commit(stored_filename)
+
+            if i == 0:
+                self.assertEqual(sorted(inc.changed), ["a", "b", "b/c", "b/d"])
+                time.sleep(0.01)
+                with open(os.path.join(src, "a"), "w") as f:
+                    f.write("new a")
+                os.remove(os.path.join(src, "b/c"))
+            else:
+                self.assertEqual(sorted(inc.changed), ["a", "b"])
+                self.assertEqual(inc.deleted, ["b/c"])
+
+        for out in archives:
+            out.seek(0)
+            extract_tarball(get_codec("gzip").decompressor(out), dst)
+            apply_deletions("src", dst)
+
+        self.assertEqual(open(os.path.join(dst, "src/a")).read(), "new a")
+        self.assertFalse(os.path.exists(os.path.join(dst, "src/b/c")))
+        self.assertTrue(os.path.exists(os.path.join(dst, "src/b/d")))
+
+        shutil.rmtree(src)
+        shutil.rmtree(dst)
+
+    def test_incremental_full_policy(self):
+        import uuid
+        import shutil
+        from bakthat.incremental import IncrementalBackup
+        from bakthat.models import Backups
+
+        backend_hash = str(uuid.uuid4())
+        src = tempfile.mkdtemp()
+        levels = []
+        try:
+            for i in range(5):
+                with open(os.path.join(src, "a"), "w") as f:
+                    f.write(str(i))
+                inc = IncrementalBackup(src, backend_hash, max_chain=2, now=1000 + i).scan()
+                levels.append(inc.level)
+                stored_filename = "{0}-{1}".format(backend_hash, i)
+                Backups.create(filename="src", stored_filename=stored_filename, backup_date=1000 + i,
+                               last_updated=0, backend="s3", backend_hash=backend_hash, is_deleted=False,
+                               tags="", size=0, metadata=dict(incremental=inc.metadata()))
+                inc.commit(stored_filename)
+            # a full backup every 2 incremental backups
+            self.assertEqual(levels, [0, 1, 2, 0, 1])
+
+            # the last full backup (1003) is too old
+            self.assertEqual(IncrementalBackup(src, backend_hash, max_age=100, now=1050).level, 2)
+            self.assertEqual(IncrementalBackup(src, backend_hash, max_age=100, now=1103).level, 0)
+        finally:
+            Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+            shutil.rmtree(src)
+
+    def test_incremental_chain_deletes(self):
+        import uuid
+        import mock
+        from bakthat.models import Backups
+
+        backend_hash = str(uuid.uuid4())
+        backups = []
+        parent = None
+        for i in range(4):
+            stored_filename = "{0}-{1}".format(backend_hash, i)
+            backups.append(Backups.create(filename="src", stored_filename=stored_filename, backup_date=i,
+                                          last_updated=0, backend="s3", backend_hash=backend_hash,
+                                          is_deleted=False, tags="", size=0,
+                                          metadata=dict(incremental=dict(level=int(bool(parent)), parent=parent))))
+            parent = stored_filename
+
+        storage_backend = mock.Mock()
+        storage_backend.delete_many.return_value = {}
+        try:
+            # the full and first incremental backups are needed by the live ones
+            deleted, errors = bakthat._delete_backups(storage_backend, backups[:2])
+            self.assertEqual((deleted, errors), ([], {}))
+            self.assertFalse(storage_backend.delete_many.called)
+            self.assertRaises(Exception, bakthat._delete_backup, storage_backend, backups[0])
+
+            # the last backup isn't needed, whole chains are deleted together
+            deleted, errors = bakthat._delete_backups(storage_backend, [backups[3]])
+            self.assertEqual(deleted, [backups[3]])
+            deleted, errors = bakthat._delete_backups(storage_backend, backups[:3])
+            self.assertEqual(deleted, backups[:3])
+
+            Backups.update(is_deleted=False).where(Backups.stored_filename << [backups[2].stored_filename,
+                                                                               backups[3].stored_filename]).execute()
+            with self.assertRaises(Exception) as cm:
+                Backups.get(Backups.stored_filename == backups[3].stored_filename).get_incremental_chain()
+            self.assertTrue("incremental chain is broken" in str(cm.exception))
+        finally:
+            Backups.delete().where(Backups.backend_hash == backend_hash).execute()
+
+    def test_parallel_gzip(self):
+        import tarfile
+        from gzip import GzipFile
+        from StringIO import StringIO
+        from contextlib import closing
+        from bakthat.compression import ParallelGzipFile, write_tarball, get_codec
+
+        data = "".join(os.urandom(64) * 200 for i in range(100))
+        out = StringIO()
+        with closing(ParallelGzipFile(out, workers=4, block_size=100000)) as gz:
+            gz.write(data[:12345])
+            gz.write(data[12345:])
+        self.assertEqual(GzipFile(fileobj=StringIO(out.getvalue())).read(), data)
+
+        out = tempfile.TemporaryFile()
+        write_tarball(out, self.test_file.name, self.test_filename, codec=get_codec("gzip"), workers=4)
+        out.seek(0)
+        tar = tarfile.open(fileobj=out, mode="r:gz")
+        restored = tar.extractfile(self.test_filename).read()
+        self.assertEqual(self.test_hash, hashlib.sha1(restored).hexdigest())
+
     def test_keyvalue_helper(self):
         from bakthat.helper import KeyValue
         kv = KeyValue()